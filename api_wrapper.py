@@ -1,44 +1,280 @@
+import asyncio
+import json
 import requests
-from random import choice
+import requests_async
+from random import random, sample
+from requests.adapters import HTTPAdapter
+from threading import Lock
+from time import monotonic, sleep
+from zlib import crc32
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+# statuses worth retrying, the instance was unavailable
+RETRY_STATUSES = (502, 503, 504)
+
+# status of a node refusing requests while shutting down, before processing them
+QUEUE_CLOSED = 503
+
+# compact binary encoding of requests and pages
+MSGPACK = 'application/msgpack'
+
+
+def _rows(obj):
+    """ decode columnar pages of a msgpack response back to rows """
+    if obj.keys() == {'fields', 'values'}:
+        return [dict(zip(obj['fields'], values)) for values in obj['values']]
+    return obj
+
+
+class EndpointPool:
+
+    def __init__(self, endpoints, failure_threshold: int = 3, ejection_time: float = 30.0):
+        """
+        initialize a pool of service endpoints with passive health checks
+        :param endpoints: list of 'host:port' endpoints
+        :param failure_threshold: consecutive failures before ejecting an endpoint
+        :param ejection_time: seconds an ejected endpoint receives no traffic
+        """
+        self._endpoints = list(endpoints)
+        self._failure_threshold = failure_threshold
+        self._ejection_time = ejection_time
+        self._outstanding = dict.fromkeys(self._endpoints, 0)
+        self._failures = dict.fromkeys(self._endpoints, 0)
+        self._ejected_until = dict.fromkeys(self._endpoints, 0.0)
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._endpoints)
+
+    def _healthy(self):
+        """ endpoints that are not ejected, or the one ejected the longest ago """
+        now = monotonic()
+        healthy = [endpoint for endpoint in self._endpoints if self._ejected_until[endpoint] <= now]
+        return healthy or [min(self._endpoints, key=self._ejected_until.get)]
+
+    def acquire(self, affinity: str = None, exclude=()):
+        """
+        pick an endpoint for a new request, the less loaded of two random
+        healthy endpoints, or a stable endpoint per affinity key
+        :param affinity: optional key, e.g. a consumer id
+        :param exclude: endpoints to avoid while others are healthy, e.g. failed attempts
+        :return: endpoint
+        """
+        with self._lock:
+            healthy = self._healthy()
+            healthy = [endpoint for endpoint in healthy if endpoint not in exclude] or healthy
+            if affinity is not None:
+                endpoint = max(healthy, key=lambda e: crc32(f"{affinity}@{e}".encode()))
+            elif len(healthy) == 1:
+                endpoint = healthy[0]
+            else:
+                first, second = sample(healthy, 2)
+                endpoint = first if self._outstanding[first] <= self._outstanding[second] else second
+
+            self._outstanding[endpoint] += 1
+            return endpoint
+
+    def release(self, endpoint, failed: bool = False):
+        """
+        report a finished request
+        :param endpoint: endpoint used by the request
+        :param failed: whether the endpoint failed to serve it
+        """
+        with self._lock:
+            self._outstanding[endpoint] -= 1
+            if not failed:
+                self._failures[endpoint] = 0
+                return
+
+            self._failures[endpoint] += 1
+            if self._failures[endpoint] >= self._failure_threshold:
+                self._ejected_until[endpoint] = monotonic() + self._ejection_time
+                # a single failure ejects it again once it is back
+                self._failures[endpoint] = self._failure_threshold - 1
 
 
 class BaseEventStream:
 
-    def __init__(self, host, ports, version: str = 'v1'):
+    def __init__(self, host, ports=None, version: str = 'v1', timeout: float = 5.0,
+                 retries: int = 2, backoff: float = 0.1, pool_size: int = 10,
+                 failure_threshold: int = 3, ejection_time: float = 30.0, binary: bool = False):
         """
         initialize a new FeedStreamClient
-        :param host: client's host
-        :param ports: client's port list
+        :param host: client's host, or a list of 'host:port' endpoints
+        :param ports: client's port list, when a single host is given
         :param version: version of the api
-        """
-        self._host = host
-        self._ports = ports
+        :param timeout: seconds to wait for a connection or a response
+        :param retries: number of retries of a failed request
+        :param backoff: base delay in seconds between retries
+        :param pool_size: keep-alive connections kept per instance
+        :param failure_threshold: consecutive failures before ejecting an instance
+        :param ejection_time: seconds an ejected instance receives no traffic
+        :param binary: send requests and receive pages as msgpack, requires msgpack
+        """
+        if binary and msgpack is None:
+            raise Exception('binary requires msgpack')
+
+        endpoints = host if ports is None else [f"{host}:{port}" for port in ports]
+        self._endpoints = EndpointPool(endpoints, failure_threshold, ejection_time)
         self._version = version
+        self._timeout = timeout
+        self._retries = retries
+        self._backoff = backoff
+        self._pool_size = pool_size
+        self._binary = binary
+        self._session = self._create_session()
+        if binary:
+            self._session.headers['Accept'] = f"{MSGPACK}, application/json"
+
+    def _url(self, endpoint, method):
+        return f"http://{endpoint}/{self._version}/{method}"
+
+    def _create_session(self):
+        """ create a session reusing pooled keep-alive connections """
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=len(self._endpoints), pool_maxsize=self._pool_size)
+        session.mount('http://', adapter)
+        return session
+
+    def _retry_delay(self, attempt):
+        """ exponential backoff with full jitter """
+        return self._backoff * (2 ** attempt) * random()
+
+    def _retryable(self, error, http_method):
+        """
+        whether a failed request may be sent again; requests that may
+        have reached the server are only retried when idempotent
+        """
+        if isinstance(error, (requests.exceptions.ConnectionError, ConnectionError)):
+            return True
+        return http_method == 'GET'
+
+    @staticmethod
+    def _retryable_status(status, http_method):
+        """
+        whether a failed response may be sent again; a node shutting down
+        refuses requests before processing them, other gateway errors
+        may follow a processed request and are only retried when idempotent
+        """
+        return status == QUEUE_CLOSED or (status in RETRY_STATUSES and http_method == 'GET')
+
+    def _request(self, http_method, method, stream=False, affinity=None, **kwargs):
+        """
+        make a new request, retrying failures with backoff
+        :param http_method: http method
+        :param method: request method
+        :param stream: stream the response body
+        :param affinity: prefer the same instance for the same key
+        :param kwargs: request arguments
+        :return: response
+        """
 
-    @property
-    def _port(self):
-        return choice(self._ports)
+        tried = []
+        for attempt in range(self._retries + 1):
+            # retries avoid the endpoints that already failed, affinity included
+            endpoint = self._endpoints.acquire(affinity, exclude=tried)
+            tried.append(endpoint)
+            failed = True
+            try:
+                response = self._session.request(http_method, self._url(endpoint, method),
+                                                 timeout=self._timeout, stream=stream, **kwargs)
+                failed = response.status_code in RETRY_STATUSES
+                if (not failed or attempt == self._retries or
+                        not self._retryable_status(response.status_code, http_method)):
+                    return response
+                response.close()
+            except requests.exceptions.RequestException as e:
+                if attempt == self._retries or not self._retryable(e, http_method):
+                    raise
+            finally:
+                self._endpoints.release(endpoint, failed)
 
-    def _post_request(self, method, payload: dict):
+            sleep(self._retry_delay(attempt))
+
+    def _body(self, payload: dict):
+        """
+        request arguments sending a payload
+        :param payload: request payload
+        :return: json or msgpack request arguments
+        """
+
+        if self._binary:
+            return {'data': msgpack.packb(payload, use_bin_type=True), 'headers': {'Content-Type': MSGPACK}}
+        return {'json': payload}
+
+    @staticmethod
+    def _is_packed(response):
+        """ whether the server answered with msgpack """
+        return response.headers.get('Content-Type', '').startswith(MSGPACK)
+
+    def _decode(self, response):
+        """
+        decode a json or msgpack response
+        :param response: response
+        :return: response body
+        """
+
+        if self._is_packed(response):
+            return msgpack.unpackb(response.content, raw=False, object_hook=_rows)
+        return response.json()
+
+    def _post_request(self, method, payload: dict, key: str = None, affinity: str = None):
         """
         make a new post request
         :param method: request method
         :param payload: json payload
+        :param key: if provided, only this field of the response is returned
+        :param affinity: prefer the same instance for the same key
         :return: response json
         """
 
-        url = f"http://{self._host}:{self._port}/{self._version}/{method}"
-        return requests.post(url, json=payload).json()
+        response = self._decode(self._request('POST', method, affinity=affinity, **self._body(payload)))
+        return response[key] if key else response
 
-    def _get_request(self, method, args):
+    def _stream_request(self, method, payload: dict, keys: tuple):
+        """
+        make a new post request with a streamed, line delimited response
+        :param method: request method
+        :param payload: json payload
+        :param keys: fields returned of every line
+        :return: generator of tuples of the fields
+        """
+
+        with self._request('POST', method, stream=True, **self._body(payload)) as response:
+            if self._is_packed(response):
+                lines = msgpack.Unpacker(raw=False, object_hook=_rows)
+                for chunk in response.iter_content(chunk_size=65536):
+                    lines.feed(chunk)
+                    for line in lines:
+                        yield tuple(line[key] for key in keys)
+                return
+
+            for line in response.iter_lines():
+                if line:
+                    line = json.loads(line)
+                    yield tuple(line[key] for key in keys)
+
+    def _get_request(self, method, args, key: str = None, affinity: str = None):
         """
         make a new get request
         :param method: request methods
         :param args: request arguments
+        :param key: if provided, only this field of the response is returned
+        :param affinity: prefer the same instance for the same key
         :return: response json
         """
-        url = f"http://{self._host}:{self._port}/{self._version}/{method}"
-        return requests.get(url, params=args).json()
+
+        response = self._decode(self._request('GET', method, affinity=affinity, params=args))
+        return response[key] if key else response
+
+    def close(self):
+        """ close the pooled connections """
+        self._session.close()
 
     def _publish(self, producer_id: str, item_id: str, verb: str,
                  timestamp: int, consumer_id: str = None):
@@ -62,8 +298,7 @@ class BaseEventStream:
         if consumer_id is not None:
             payload['consumer_id'] = str(consumer_id)
 
-        response = self._post_request('publish', payload=payload)
-        return response['published']
+        return self._post_request('publish', payload=payload, key='published')
 
     def _retract(self, producer_id: str, item_id: str, verb: str,
                  consumer_id: str = None):
@@ -87,8 +322,7 @@ class BaseEventStream:
 
         # todo fix issue in retract
         # Invalid input of type: 'NoneType'. Convert to a byte, string or number first.
-        response = self._post_request('retract', payload=payload)
-        return response['retracted']
+        return self._post_request('retract', payload=payload, key='retracted')
 
     def _subscribe(self, event_name: str, producer_id: str, consumer_id: str):
         """
@@ -105,8 +339,24 @@ class BaseEventStream:
             "consumer_id": str(consumer_id)
         }
 
-        response = self._post_request('subscribe', payload=payload)
-        return response['subscribed']
+        return self._post_request('subscribe', payload=payload, key='subscribed')
+
+    def _subscribe_many(self, event_name: str, producer_ids: list, consumer_id: str):
+        """
+        subscribe a consumer to many producers at once
+        :param event_name: feed's name
+        :param producer_ids: producers' unique ids
+        :param consumer_id: consumer's unique id
+        :return: True on success
+        """
+
+        payload = {
+            "event_name": event_name,
+            "producer_ids": [str(producer_id) for producer_id in producer_ids],
+            "consumer_id": str(consumer_id)
+        }
+
+        return self._post_request('subscribe/batch', payload=payload, key='subscribed')
 
     def _unsubscribe(self, event_name: str, producer_id: str, consumer_id: str):
         """
@@ -123,11 +373,12 @@ class BaseEventStream:
             "consumer_id": str(consumer_id)
         }
 
-        response = self._post_request('unsubscribe', payload=payload)
-        return response['unsubscribed']
+        return self._post_request('unsubscribe', payload=payload, key='unsubscribed')
 
     def _consume(self, event_name: str, consumer_id: str, limit: int = 20,
-                 after: str = None, before: str = None):
+                 after: str = None, before: str = None, ranked: bool = False,
+                 since: float = None, until: float = None,
+                 since_id: str = None, until_id: str = None):
         """
         consume a feed for a user
         :param event_name: feed's name
@@ -135,6 +386,11 @@ class BaseEventStream:
         :param limit: limit on result
         :param after: result after specific id
         :param before: result before specific id
+        :param ranked: consume the ranked feed
+        :param since: result newer than specific timestamp
+        :param until: result older than specific timestamp
+        :param since_id: tie-breaker id for items at since
+        :param until_id: tie-breaker id for items at until
         :return: list of {'item_id', 'verb' }
         """
 
@@ -148,21 +404,125 @@ class BaseEventStream:
             args['after'] = after
         if before is not None:
             args['before'] = before
+        if ranked:
+            args['ranked'] = 'true'
+        if since is not None:
+            args['since'] = repr(float(since))
+        if until is not None:
+            args['until'] = repr(float(until))
+        if since_id is not None:
+            args['since_id'] = str(since_id)
+        if until_id is not None:
+            args['until_id'] = str(until_id)
+
+        return self._get_request('consume', args=args, key='data', affinity=args['consumer_id'])
+
+
+    def _rescore(self, event_name: str, producer_id: str, item_id: str, engagement: float):
+        """
+        update an item's engagement and ranking score
+        :param event_name: feed's name
+        :param producer_id: producer's id
+        :param item_id: item's id
+        :param engagement: item's new engagement
+        :return: True on success
+        """
+
+        payload = {
+            "event_name": event_name,
+            "producer_id": str(producer_id),
+            "item_id": str(item_id),
+            "engagement": float(engagement)
+        }
+
+        return self._post_request('rescore', payload=payload, key='rescored')
+
+    def _consume_batch(self, event_name: str, consumer_ids: list, limit: int = 20):
+        """
+        consume a feed for many users, for server-side jobs
+        :param event_name: feed's name
+        :param consumer_ids: consumers' ids
+        :param limit: limit on result per consumer
+        :return: generator of (consumer_id, list of {'item_id', 'verb' })
+        """
+
+        payload = {
+            "event_name": event_name,
+            "consumer_ids": [str(consumer_id) for consumer_id in consumer_ids],
+            "limit": limit
+        }
+
+        return self._stream_request('consume/batch', payload=payload, keys=('consumer_id', 'data'))
+
+    def _mark_seen(self, event_name: str, consumer_id: str, item_id: str = None,
+                   timestamp: float = None):
+        """
+        mark a feed as seen by a user
+        :param event_name: feed's name
+        :param consumer_id: consumer's id
+        :param item_id: last seen item, defaults to the newest item
+        :param timestamp: last seen timestamp instead of an item
+        :return: True on success
+        """
+
+        payload = {
+            "event_name": event_name,
+            "consumer_id": str(consumer_id)
+        }
+
+        if item_id is not None:
+            payload['item_id'] = str(item_id)
+        if timestamp is not None:
+            payload['timestamp'] = float(timestamp)
+
+        return self._post_request('mark_seen', payload=payload, key='seen',
+                                  affinity=payload['consumer_id'])
+
+    def _unread_count(self, event_name: str, consumer_id: str):
+        """
+        count the unseen items of a feed for a user
+        :param event_name: feed's name
+        :param consumer_id: consumer's id
+        :return: unread count
+        """
+
+        args = {
+            "event_name": event_name,
+            "consumer_id": str(consumer_id)
+        }
+
+        return self._get_request('unread', args=args, key='unread', affinity=args['consumer_id'])
 
-        response = self._get_request('consume', args=args)
-        return response['data']
+    def _consume_many(self, consumer_id: str, events: dict):
+        """
+        consume several feeds for a user in one request
+        :param consumer_id: consumer's id
+        :param events: { event_name: { 'limit', 'after', 'before' } }
+        :return: { event_name: list of {'item_id', 'verb' } }
+        """
+
+        payload = {
+            "consumer_id": str(consumer_id),
+            "events": dict((event_name, dict((key, value) for key, value in (page or {}).items()
+                                             if value is not None))
+                           for event_name, page in events.items())
+        }
+
+        return self._post_request('consume/multi', payload=payload, key='data',
+                                  affinity=payload['consumer_id'])
 
 
 class FlatEventStream(BaseEventStream):
 
-    def __init__(self, event_name, host, port):
+    def __init__(self, event_name, host, port=None, **options):
         """
         initialize a custom flat event stream
         :param event_name: event's name
-        :param host: service host
-        :param port: service port
+        :param host: service host, or a list of 'host:port' endpoints
+        :param port: service port list
+        :param options: client options, see BaseEventStream
         """
-        super().__init__(host, port)
+        super().__init__(host, port, **options)
         self._event_name = event_name
 
     def publish(self, producer_id: str, item_id: str, verb: str, timestamp: int):
@@ -198,6 +558,16 @@ class FlatEventStream(BaseEventStream):
 
         return self._subscribe(self._event_name, producer_id, consumer_id)
 
+    def subscribe_many(self, producer_ids: list, consumer_id: str):
+        """
+        subscribe a consumer to many producers at once
+        :param producer_ids: producers' unique ids
+        :param consumer_id: consumer's unique id
+        :return: True on success
+        """
+
+        return self._subscribe_many(self._event_name, producer_ids, consumer_id)
+
     def unsubscribe(self, producer_id: str, consumer_id: str):
         """
         unsubscribe a consumer from a producer
@@ -209,29 +579,79 @@ class FlatEventStream(BaseEventStream):
         return self._unsubscribe(self._event_name, producer_id, consumer_id)
 
     def consume(self, consumer_id: str, limit: int = 20,
-                after: str = None, before: str = None):
+                after: str = None, before: str = None, ranked: bool = False,
+                since: float = None, until: float = None,
+                since_id: str = None, until_id: str = None):
         """
         consume a feed for a user
         :param consumer_id: consumer's id
         :param limit: limit on result
         :param after: result after specific id
         :param before: result before specific id
+        :param ranked: consume the ranked feed
+        :param since: result newer than specific timestamp
+        :param until: result older than specific timestamp
+        :param since_id: tie-breaker id for items at since
+        :param until_id: tie-breaker id for items at until
         :return: list of {'item_id', 'verb' }
         """
 
-        return self._consume(self._event_name, consumer_id, limit, after, before)
+        return self._consume(self._event_name, consumer_id, limit, after, before, ranked,
+                             since, until, since_id, until_id)
+
+    def rescore(self, producer_id: str, item_id: str, engagement: float):
+        """
+        update an item's engagement and ranking score
+        :param producer_id: producer's id
+        :param item_id: item's id
+        :param engagement: item's new engagement
+        :return: True on success
+        """
+
+        return self._rescore(self._event_name, producer_id, item_id, engagement)
+
+    def consume_batch(self, consumer_ids: list, limit: int = 20):
+        """
+        consume a feed for many users, streamed as the server produces it
+        :param consumer_ids: consumers' ids
+        :param limit: limit on result per consumer
+        :return: generator of (consumer_id, list of {'item_id', 'verb' })
+        """
+
+        return self._consume_batch(self._event_name, consumer_ids, limit)
+
+    def mark_seen(self, consumer_id: str, item_id: str = None, timestamp: float = None):
+        """
+        mark the feed as seen by a user
+        :param consumer_id: consumer's id
+        :param item_id: last seen item, defaults to the newest item
+        :param timestamp: last seen timestamp instead of an item
+        :return: True on success
+        """
+
+        return self._mark_seen(self._event_name, consumer_id, item_id, timestamp)
+
+    def unread_count(self, consumer_id: str):
+        """
+        count the unseen items of the feed for a user
+        :param consumer_id: consumer's id
+        :return: unread count
+        """
+
+        return self._unread_count(self._event_name, consumer_id)
 
 
 class ActivityEventStream(BaseEventStream):
 
-    def __init__(self, event_name, host, port):
+    def __init__(self, event_name, host, port=None, **options):
         """
         initialize a custom flat event stream
         :param event_name: event's name
-        :param host: service host
-        :param port: service port
+        :param host: service host, or a list of 'host:port' endpoints
+        :param port: service port list
+        :param options: client options, see BaseEventStream
         """
-        super().__init__(host, port)
+        super().__init__(host, port, **options)
         self._event_name = event_name
 
     def publish(self, producer_id: str, item_id: str, verb: str, timestamp: int, consumer_id: str):
@@ -269,6 +689,16 @@ class ActivityEventStream(BaseEventStream):
 
         return self._subscribe(self._event_name, producer_id, consumer_id)
 
+    def subscribe_many(self, producer_ids: list, consumer_id: str):
+        """
+        subscribe a consumer to many producers at once
+        :param producer_ids: producers' unique ids
+        :param consumer_id: consumer's unique id
+        :return: True on success
+        """
+
+        return self._subscribe_many(self._event_name, producer_ids, consumer_id)
+
     def unsubscribe(self, producer_id: str, consumer_id: str):
         """
         unsubscribe a consumer from a producer
@@ -280,14 +710,197 @@ class ActivityEventStream(BaseEventStream):
         return self._unsubscribe(self._event_name, producer_id, consumer_id)
 
     def consume(self, consumer_id: str, limit: int = 20,
-                after: str = None, before: str = None):
+                after: str = None, before: str = None, ranked: bool = False,
+                since: float = None, until: float = None,
+                since_id: str = None, until_id: str = None):
         """
         consume a feed for a user
         :param consumer_id: consumer's id
         :param limit: limit on result
         :param after: result after specific id
         :param before: result before specific id
+        :param ranked: consume the ranked feed
+        :param since: result newer than specific timestamp
+        :param until: result older than specific timestamp
+        :param since_id: tie-breaker id for items at since
+        :param until_id: tie-breaker id for items at until
         :return: list of {'item_id', 'verb' }
         """
 
-        return self._consume(self._event_name, consumer_id, limit, after, before)
+        return self._consume(self._event_name, consumer_id, limit, after, before, ranked,
+                             since, until, since_id, until_id)
+
+    def rescore(self, producer_id: str, item_id: str, engagement: float):
+        """
+        update an item's engagement and ranking score
+        :param producer_id: producer's id
+        :param item_id: item's id
+        :param engagement: item's new engagement
+        :return: True on success
+        """
+
+        return self._rescore(self._event_name, producer_id, item_id, engagement)
+
+    def consume_batch(self, consumer_ids: list, limit: int = 20):
+        """
+        consume a feed for many users, streamed as the server produces it
+        :param consumer_ids: consumers' ids
+        :param limit: limit on result per consumer
+        :return: generator of (consumer_id, list of {'item_id', 'verb' })
+        """
+
+        return self._consume_batch(self._event_name, consumer_ids, limit)
+
+    def mark_seen(self, consumer_id: str, item_id: str = None, timestamp: float = None):
+        """
+        mark the feed as seen by a user
+        :param consumer_id: consumer's id
+        :param item_id: last seen item, defaults to the newest item
+        :param timestamp: last seen timestamp instead of an item
+        :return: True on success
+        """
+
+        return self._mark_seen(self._event_name, consumer_id, item_id, timestamp)
+
+    def unread_count(self, consumer_id: str):
+        """
+        count the unseen items of the feed for a user
+        :param consumer_id: consumer's id
+        :return: unread count
+        """
+
+        return self._unread_count(self._event_name, consumer_id)
+
+
+class MultiEventStream(BaseEventStream):
+
+    def __init__(self, host, port=None, **options):
+        """
+        initialize a stream reading several events at once
+        :param host: service host, or a list of 'host:port' endpoints
+        :param port: service port list
+        :param options: client options, see BaseEventStream
+        """
+        super().__init__(host, port, **options)
+
+    def consume(self, consumer_id: str, events: dict):
+        """
+        consume several feeds for a user in one request
+        :param consumer_id: consumer's id
+        :param events: { event_name: { 'limit', 'after', 'before' } }
+        :return: { event_name: list of {'item_id', 'verb' } }
+        """
+
+        return self._consume_many(consumer_id, events)
+
+
+class AsyncEventStreamMixin:
+    """ asyncio variant of an event stream, every call returns a coroutine """
+
+    def _create_session(self):
+        """ create an async session reusing keep-alive connections """
+        return requests_async.Session()
+
+    async def _request(self, http_method, method, stream=False, affinity=None, **kwargs):
+        """
+        make a new request, retrying failures with backoff
+        :param http_method: http method
+        :param method: request method
+        :param stream: stream the response body
+        :param affinity: prefer the same instance for the same key
+        :param kwargs: request arguments
+        :return: response
+        """
+
+        tried = []
+        for attempt in range(self._retries + 1):
+            endpoint = self._endpoints.acquire(affinity, exclude=tried)
+            tried.append(endpoint)
+            failed = True
+            try:
+                response = await self._session.request(http_method, self._url(endpoint, method),
+                                                       timeout=self._timeout, stream=stream, **kwargs)
+                failed = response.status_code in RETRY_STATUSES
+                if (not failed or attempt == self._retries or
+                        not self._retryable_status(response.status_code, http_method)):
+                    return response
+            except (OSError, asyncio.TimeoutError) as e:
+                if attempt == self._retries or not self._retryable(e, http_method):
+                    raise
+            finally:
+                self._endpoints.release(endpoint, failed)
+
+            await asyncio.sleep(self._retry_delay(attempt))
+
+    async def _post_request(self, method, payload: dict, key: str = None, affinity: str = None):
+        """
+        make a new post request
+        :param method: request method
+        :param payload: json payload
+        :param key: if provided, only this field of the response is returned
+        :param affinity: prefer the same instance for the same key
+        :return: response json
+        """
+
+        response = self._decode(await self._request('POST', method, affinity=affinity, **self._body(payload)))
+        return response[key] if key else response
+
+    async def _stream_request(self, method, payload: dict, keys: tuple):
+        """
+        make a new post request with a streamed, line delimited response
+        :param method: request method
+        :param payload: json payload
+        :param keys: fields returned of every line
+        :return: async generator of tuples of the fields
+        """
+
+        response = await self._request('POST', method, stream=True, **self._body(payload))
+        if self._is_packed(response):
+            lines = msgpack.Unpacker(raw=False, object_hook=_rows)
+            async for chunk in response.iter_content(65536):
+                lines.feed(chunk)
+                for line in lines:
+                    yield tuple(line[key] for key in keys)
+            return
+
+        # lines are yielded as they arrive, the body is never held whole
+        pending = b''
+        async for chunk in response.iter_content(65536):
+            *lines, pending = (pending + chunk).split(b'\n')
+            for line in lines:
+                if line:
+                    line = json.loads(line)
+                    yield tuple(line[key] for key in keys)
+
+        if pending.strip():
+            line = json.loads(pending)
+            yield tuple(line[key] for key in keys)
+
+    async def _get_request(self, method, args, key: str = None, affinity: str = None):
+        """
+        make a new get request
+        :param method: request methods
+        :param args: request arguments
+        :param key: if provided, only this field of the response is returned
+        :param affinity: prefer the same instance for the same key
+        :return: response json
+        """
+
+        response = self._decode(await self._request('GET', method, affinity=affinity, params=args))
+        return response[key] if key else response
+
+    async def close(self):
+        """ close the pooled connections """
+        await self._session.close()
+
+
+class AsyncFlatEventStream(AsyncEventStreamMixin, FlatEventStream):
+    """ asyncio variant of FlatEventStream """
+
+
+class AsyncActivityEventStream(AsyncEventStreamMixin, ActivityEventStream):
+    """ asyncio variant of ActivityEventStream """
+
+
+class AsyncMultiEventStream(AsyncEventStreamMixin, MultiEventStream):
+    """ asyncio variant of MultiEventStream """
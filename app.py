@@ -1,8 +1,18 @@
-from controllers import Activity, Flat, EventProcessor, TaskQueue
-from models import ActivityEvent, FlatEvent, Relation, BaseModel
+from controllers import Activity, Flat, EventProcessor, TaskQueue, Verifier, hot_score
+from models import ActivityEvent, FlatEvent, Relation, EventArchive, BaseModel
 from sanic import Sanic
 from routes import mod
-from utils import db, clear_cache_ns
+from threading import Thread
+from time import sleep
+from utils import db, config, redis, clear_cache_ns, Orange, MemoryStore
+from utils.IngestLog import IngestLog
+from utils.Coordinator import Coordinator
+from utils.GraphIndex import GraphIndex
+import os
+
+
+# redis hash holding the state of the cached timelines
+CACHE_META = 'fs:meta'
 
 
 # classes that are required
@@ -25,7 +35,8 @@ def setup_system():
     (EventProcessor.register_event_handler(
         Flat(name='feed', dataset=FeedPosts,
              relations=UserRelations, verbs=['podcast'],
-             include_actor=True, max_cache=500)
+             include_actor=True, max_cache=500,
+             score=hot_score())
     ))
 
     (EventProcessor.register_event_handler(
@@ -38,16 +49,201 @@ def setup_system():
 def setup_workers(workers=1):
     """ Setup task queue and workers """
 
-    task_queue = TaskQueue(workers=workers)
+    options = config.get('task_queue') or {}
+    dead_letters, spill = options.get('dead_letters'), options.get('spill')
+
+    task_queue = TaskQueue(workers=workers,
+                           max_attempts=options.get('max_attempts', 5),
+                           backoff=options.get('backoff', 0.5),
+                           max_backoff=options.get('max_backoff', 60.0),
+                           dead_letters=Orange(dead_letters, journal=True) if dead_letters else None,
+                           spill=Orange(spill, journal=True) if spill else None)
     EventProcessor.register_task_queue(task_queue)
     task_queue.start_workers()
 
 
-def preload_data():
-    """ preloads redis with server data """
+def setup_ingest_log():
+    """ acknowledge publishes once written to a local write-ahead log """
+
+    ingest_log = config.get('ingest_log')
+    if not ingest_log:
+        return False
+
+    return EventProcessor.register_ingest_log(
+        IngestLog(ingest_log['path'], size=ingest_log.get('size', 64 * 1024 * 1024),
+                  sync=ingest_log.get('sync', True)))
+
+
+def setup_graph_index():
+    """ serve the relations from in-memory graph indexes """
+
+    graph_index = config.get('graph_index')
+    if not graph_index:
+        return False
+
+    directory = os.path.expanduser(graph_index['path'])
+    os.makedirs(directory, exist_ok=True)
+
+    # the nodes of an in-process store have no one to share changes with
+    shared = None if isinstance(redis, MemoryStore) else redis
+    for relations in set(event.relations for event in EventProcessor.events):
+        table_name = relations._meta.table_name
+        EventProcessor.register_graph_index(
+            relations, GraphIndex(os.path.join(directory, f"{table_name}.graph"),
+                                  redis=shared, channel=f"fs_graph:{table_name}",
+                                  fold_after=graph_index.get('fold_after', 10000)))
+
+    return True
+
+
+def setup_verifier():
+    """ check and repair the cached timelines in the background """
+
+    verifier = config.get('verifier')
+    if not verifier:
+        return False
+
+    return EventProcessor.register_verifier(
+        Verifier(EventProcessor.events, rate=verifier.get('rate', 10.0),
+                 batch=verifier.get('batch', 100), interval=verifier.get('interval', 60.0),
+                 repair=verifier.get('repair', True)))
+
+
+def drain():
+    """
+    stop taking new work, drain the queued jobs up to the
+    drain timeout and persist the ones left for the next process
+    :return: number of jobs left over
+    """
+
+    # publishes still in flight are refused with QueueClosed,
+    # the log is unmapped once the server stopped taking requests
+    if EventProcessor.ingest_log is not None:
+        EventProcessor.ingest_log.stop()
+
+    if EventProcessor.verifier is not None:
+        EventProcessor.verifier.stop()
+
+    options = config.get('task_queue') or {}
+    return EventProcessor.task_queue.shutdown(timeout=options.get('drain_timeout', 10.0))
+
+
+def setup_retention():
+    """ periodically move events past the retention horizon to the archive """
+
+    retention = config.get('retention')
+    if not retention:
+        return False
+
+    def archive_loop():
+        while not EventProcessor.task_queue.closed:
+            EventProcessor.archive_events(horizon=retention['horizon'],
+                                          bucket_size=retention.get('bucket', 86400))
+            sleep(retention.get('interval', 3600))
+
+    Thread(target=archive_loop, daemon=True).start()
+    return True
+
+
+def setup_sweeper():
+    """ periodically sweep the retracted items from the cached timelines """
+
+    sweeper = config.get('sweeper')
+    if not sweeper:
+        return False
+
+    def sweep_loop():
+        while not EventProcessor.task_queue.closed:
+            EventProcessor.sweep_tombstones(batch=sweeper.get('batch', 500))
+            sleep(sweeper.get('interval', 60.0))
+
+    Thread(target=sweep_loop, daemon=True).start()
+    return True
+
+
+def preload_data(warm=False):
+    """
+    preloads redis with server data, once for all the nodes sharing
+    the redis, blocks until the cache is ready
+    :param warm: keep the cached timelines if they were left by a clean
+        shutdown with the same epoch and only load newer events
+    """
+
+    epoch = EventProcessor.cache_epoch()
+    cluster = config.get('cluster') or {}
+    coordinator = Coordinator(redis, ttl=cluster.get('ttl', 30.0), shards=cluster.get('shards', 64))
+
+    def prepare():
+        """ run by the elected node, returns True if a full rebuild is needed """
+        meta = dict((k.decode(), v.decode()) for k, v in redis.hgetall(CACHE_META).items())
+        warm_start = warm and meta.get('epoch') == epoch and meta.get('clean') == '1'
+
+        if warm_start:
+            marks = dict((k[len('hwm:'):], int(v)) for k, v in meta.items() if k.startswith('hwm:'))
+            EventProcessor.preload_data(high_water_marks=marks)
+        else:
+            clear_cache_ns('fs:*')
+            clear_cache_ns('fs_outbox*')
+
+        # the cache is dirty until the next clean shutdown
+        pipe = redis.pipeline()
+        pipe.hset(CACHE_META, 'epoch', epoch)
+        pipe.hdel(CACHE_META, 'clean')
+        pipe.execute()
+        return not warm_start
+
+    # an in-process store is not shared, there is nothing to coordinate
+    if isinstance(redis, MemoryStore):
+        if prepare():
+            EventProcessor.rebuild_shard(0, 1)
+        return True
+
+    # the consumers are listed once for the shards this node rebuilds,
+    # and the listing is dropped once the cache is ready
+    listings = {}
+
+    def rebuild(shard, shards):
+        return EventProcessor.rebuild_shard(shard, shards, listings=listings)
+
+    try:
+        return coordinator.initialize(epoch, prepare, rebuild, stall=cluster.get('stall', 60.0))
+    finally:
+        listings.clear()
+
+
+def save_cache_state():
+    """
+    record the high water marks of the cached timelines for a warm restart.
+    the cache is only marked clean when no queued work is left behind.
+    :return: True if the cache was marked clean
+    """
+
+    if EventProcessor.task_queue.unfinished_tasks:
+        return False
+
+    if EventProcessor.ingest_log is not None and len(EventProcessor.ingest_log):
+        return False
+
+    pipe = redis.pipeline()
+    for table_name, mark in EventProcessor.high_water_marks().items():
+        pipe.hset(CACHE_META, f"hwm:{table_name}", mark)
+    pipe.hset(CACHE_META, 'clean', 1)
+    pipe.execute()
+
+    if isinstance(redis, MemoryStore):
+        redis.save()
+    return True
+
+
+def release():
+    """
+    record the cache state for a warm restart and unmap
+    the ingest log, once the server stopped taking requests
+    """
 
-    clear_cache_ns('fs')
-    EventProcessor.preload_data()
+    save_cache_state()
+    if EventProcessor.ingest_log is not None:
+        EventProcessor.ingest_log.close()
 
 
 def setup_database(drop=False):
@@ -62,20 +258,30 @@ def setup_database(drop=False):
         db.drop_tables(Relation.__subclasses__())
         db.drop_tables(FlatEvent.__subclasses__())
         db.drop_tables(ActivityEvent.__subclasses__())
+        db.drop_tables([EventArchive])
 
     db.create_tables(Relation.__subclasses__())
     db.create_tables(FlatEvent.__subclasses__())
     db.create_tables(ActivityEvent.__subclasses__())
+    db.create_tables([EventArchive])
 
 
-def setup_web_server(workers=1):
+def setup_web_server(workers=1, warm_start=False):
     """ setup the web server """
 
     setup_system()
     setup_workers(workers)
     setup_database(drop=False)
-    preload_data()
+    setup_graph_index()
+    preload_data(warm=warm_start)
+    EventProcessor.restore_jobs()
+    setup_ingest_log()
+    setup_retention()
+    setup_sweeper()
+    setup_verifier()
 
     app = Sanic(__name__)
     app.blueprint(mod)
+    app.register_listener(lambda app, loop: drain(), 'before_server_stop')
+    app.register_listener(lambda app, loop: release(), 'after_server_stop')
     return app
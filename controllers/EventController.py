@@ -1,11 +1,34 @@
 from abc import ABC, abstractmethod
-from peewee import chunked
+from heapq import merge
+from itertools import islice
+from math import log10
+from operator import itemgetter
+from peewee import chunked, fn
+from time import time
 from utils import redis
 
 
+def hot_score(period=45000):
+    """
+    ranking score that decays with age and rises with engagement,
+    an item `period` seconds newer is worth ten times the engagement
+    :param period: seconds of recency worth a tenfold engagement
+    :return: score function (timestamp, engagement) -> score
+    """
+    def score(timestamp, engagement):
+        return log10(max(engagement, 1)) + timestamp / period
+
+    score.__name__ = f"hot_score_{period}"
+    return score
+
+
 class BaseEvent(ABC):
 
-    def __init__(self, name, dataset, relations, verbs, include_actor, max_cache):
+    # retracted items are tombstoned and swept later instead of
+    # being removed from every timeline at once
+    lazy_retract = False
+
+    def __init__(self, name, dataset, relations, verbs, include_actor, max_cache, score=None):
         """
         register an event controller
         :param name: name of the event
@@ -14,6 +37,8 @@ class BaseEvent(ABC):
         :param verbs: event verbs
         :param include_actor: include producer's data in their own feed
         :param max_cache: max number of cached events
+        :param score: optional ranking function (timestamp, engagement) -> score,
+            keeps a ranked timeline next to the chronological one
         """
         self._name = name.lower()
         self._dataset = dataset
@@ -21,6 +46,8 @@ class BaseEvent(ABC):
         self._verbs = [verb.lower() for verb in verbs]
         self._include_actor = include_actor
         self._max_cache = max_cache
+        self._score = score
+        self._graph = None
 
     @abstractmethod
     def add_event(self, payload):
@@ -38,6 +65,119 @@ class BaseEvent(ABC):
     def unsubscribe(self, consumer_id, producer_id):
         raise NotImplementedError()
 
+    @abstractmethod
+    def _producers_content(self, consumer_id, producer_ids):
+        raise NotImplementedError()
+
+    @abstractmethod
+    def rescore(self, producer_id, item_id, engagement):
+        raise NotImplementedError()
+
+    @abstractmethod
+    def consumer_ids(self):
+        raise NotImplementedError()
+
+    def use_graph_index(self, graph):
+        """
+        read the relations from an in-memory graph index instead of the database
+        :param graph: graph index of this event's relations
+        """
+        self._graph = graph
+
+    def _followers(self, producer_id):
+        """
+        consumers subscribed to a producer
+        :param producer_id: producer's id
+        :return: iterable of consumer ids
+        """
+        if self._graph is not None:
+            return self._graph.followers(producer_id)
+
+        return (row[0] for row in (self._relations
+                                   .select(self._relations.consumer_id)
+                                   .where(self._relations.producer_id == producer_id)
+                                   .tuples()))
+
+    def _followees(self, consumer_ids):
+        """
+        producers each consumer is subscribed to
+        :param consumer_ids: consumers' ids
+        :return: iterable of (consumer_id, producer_id)
+        """
+        if self._graph is not None:
+            return ((consumer_id, producer_id) for consumer_id in consumer_ids
+                    for producer_id in self._graph.followees(consumer_id))
+
+        return (self._relations
+                .select(self._relations.consumer_id, self._relations.producer_id)
+                .where(self._relations.consumer_id << list(consumer_ids))
+                .tuples())
+
+    def _followed(self, consumer_id, producer_ids):
+        """ record new subscriptions in the graph index """
+        if self._graph is not None:
+            for producer_id in producer_ids:
+                self._graph.add(consumer_id, producer_id)
+
+    def _unfollowed(self, consumer_id, producer_id):
+        """ record a removed subscription in the graph index """
+        if self._graph is not None:
+            self._graph.remove(consumer_id, producer_id)
+
+    def subscribe_many(self, consumer_id, producer_ids):
+        """
+        subscribe a consumer to many producers at once
+        :param consumer_id: consumer's id
+        :param producer_ids: producers' ids
+        :return: True on success
+        """
+        if not producer_ids:
+            return True
+
+        # 1. create every follow in a single statement
+        (self._relations
+         .insert_many([{'producer_id': producer_id, 'consumer_id': consumer_id}
+                       for producer_id in producer_ids])
+         .on_conflict_ignore()
+         .execute())
+        self._followed(consumer_id, producer_ids)
+
+        # 2. merge the producers' most recent content into the timeline once
+        content = self._producers_content(consumer_id, producer_ids)
+
+        pipe = redis.pipeline()
+        self._add_to_timeline(pipe, consumer_id, content, self._rank(content))
+        pipe.execute()
+        return True
+
+    def validate(self, payload):
+        """
+        check a payload holds every field the event stores, so
+        an acknowledged event can always be saved
+        :param payload: json payload
+        """
+        meta = self._dataset._meta
+        for field in meta.sorted_fields:
+            if field is not meta.primary_key and not field.null and payload.get(field.name) is None:
+                raise Exception(f'invalid payload; missing {field.name}')
+
+    def save_events(self, payloads):
+        """
+        bulk save events to the database, events that are
+        already stored are skipped so batches can be replayed
+        :param payloads: list of json payloads
+        :return: True on success
+        """
+        fields = [field.name for field in self._dataset._meta.sorted_fields
+                  if field is not self._dataset._meta.primary_key]
+        rows = [dict((field, payload.get(field)) for field in fields) for payload in payloads]
+
+        with self._dataset._meta.database.atomic():
+            for chunk in chunked(rows, 500):
+                self._dataset.insert_many(chunk).on_conflict_ignore().execute()
+
+        return True
+
     def create_cache_name(self, id):
         """
         create cache name for an id
@@ -46,24 +186,184 @@ class BaseEvent(ABC):
         """
         return f"fs:{id}:{self.name}"
 
-    def clean_excess_from_cache(self, consumer_id):
+    def create_seen_name(self):
+        """
+        create the name of the hash holding the consumers' last seen
+        markers, kept out of the cache namespace to survive rebuilds
+        :return: string hash name
+        """
+        return f"fs_seen:{self.name}"
+
+    def create_ranked_name(self, id):
+        """
+        create ranked cache name for an id
+        :param id: target id
+        :return: string cache name
+        """
+        return f"fs:{id}:{self.name}:ranked"
+
+    def create_engagement_name(self):
+        """
+        create the name of the hash holding the items' engagement
+        :return: string hash name
+        """
+        return f"fs_engagement:{self.name}"
+
+    def create_tombstone_name(self):
+        """
+        create the name of the set of retracted items, scored
+        by their retraction time, until they are swept
+        :return: string set name
+        """
+        return f"fs_tombstones:{self.name}"
+
+    def create_retracted_name(self):
+        """
+        create the name of the hash holding the producers of the
+        tombstoned items, so a sweep only visits their followers
+        :return: string hash name
+        """
+        return f"fs_retracted:{self.name}"
+
+    def _rank(self, content):
+        """
+        calculate the ranking scores of content
+        :param content: { item_id: timestamp }
+        :return: { item_id: score } or None if the event is not ranked
         """
-        clean excess data from the cache
+        if self._score is None or not content:
+            return None
+
+        item_ids = list(content)
+        engagements = redis.hmget(self.create_engagement_name(), item_ids)
+        return dict((item_id, self._score(content[item_id], float(engagement) if engagement else 0.0))
+                    for item_id, engagement in zip(item_ids, engagements))
+
+    def _add_to_timeline(self, pipe, consumer_id, content, ranks=None):
+        """
+        queue adding content to a consumer's cached timelines
+        :param pipe: redis pipeline
         :param consumer_id: consumer's id
-        :return: lua script for this command
+        :param content: { item_id: timestamp }
+        :param ranks: { item_id: score } for ranked events
         """
-        cache_name = self.create_cache_name(consumer_id)
-        lua_script = f"""
-        local count = redis.call('zcount', '{cache_name}', 0, 1000)
-	    if count > {self._max_cache} then
-	  	    local diff = count - {self._max_cache}
-	  	    redis.call('zpopmin', 'scores', diff)
-	  	    return diff
-	    else 
-	        return 0
-	    end
+        consumer_feed = self.create_cache_name(consumer_id)
+        for chunk in chunked(content.items(), 400):
+            pipe.zadd(consumer_feed, dict(chunk))
+        pipe.zremrangebyrank(consumer_feed, 0, -(self._max_cache + 1))
+
+        if ranks:
+            ranked_feed = self.create_ranked_name(consumer_id)
+            for chunk in chunked(ranks.items(), 400):
+                pipe.zadd(ranked_feed, dict(chunk))
+            pipe.zremrangebyrank(ranked_feed, 0, -(self._max_cache + 1))
+
+    def _remove_from_timeline(self, pipe, consumer_id, item_ids):
         """
-        return lua_script
+        queue removing items from a consumer's cached timelines
+        :param pipe: redis pipeline
+        :param consumer_id: consumer's id
+        :param item_ids: list of item ids
+        """
+        if not item_ids:
+            return
+
+        pipe.zrem(self.create_cache_name(consumer_id), *item_ids)
+        if self._score is not None:
+            pipe.zrem(self.create_ranked_name(consumer_id), *item_ids)
+
+    @staticmethod
+    def _tombstoned(pages):
+        """
+        look up which items of pages are retracted but not swept yet,
+        only the pages' own items are checked in a single round trip
+        :param pages: list of (tombstone set name or None if it is empty, item ids)
+        :return: list of sets of retracted item ids in the order of pages
+        """
+        pages = [(name, item_ids if name is not None else []) for name, item_ids in pages]
+        if not any(item_ids for _, item_ids in pages):
+            return [set() for _ in pages]
+
+        pipe = redis.pipeline()
+        for name, item_ids in pages:
+            for item_id in item_ids:
+                pipe.zscore(name, item_id)
+        scores = iter(pipe.execute())
+
+        return [set(item_id for item_id in item_ids if next(scores) is not None)
+                for _, item_ids in pages]
+
+    def _queue_tombstones(self, pipe):
+        """
+        queue counting the tombstones, reads skip their lookups
+        while there are none or for events that never tombstone
+        :param pipe: redis pipeline
+        """
+        if self.lazy_retract:
+            pipe.zcard(self.create_tombstone_name())
+
+    def _tombstones(self, counted):
+        """
+        the tombstone set to check reads against
+        :param counted: replies of the queued count, empty if none was queued
+        :return: string set name or None if there are no tombstones
+        """
+        return self.create_tombstone_name() if any(counted) else None
+
+    @staticmethod
+    def _rank_page(name, tombstones, page, limit, before=False):
+        """
+        read a page of a timeline by rank without the retracted items,
+        the page is refilled past the items that were dropped
+        :param name: list name
+        :param tombstones: tombstone set name, None if there are no tombstones
+        :param page: start, end index
+        :param limit: number of elements
+        :param before: the page ends at its anchor, refill with newer items
+        :return: list of item ids
+        """
+        start, end = page
+        items = []
+        while True:
+            item_ids = [item_id.decode() for item_id in redis.zrevrange(name, start, end)]
+            dead = BaseEvent._tombstoned([(tombstones, item_ids)])[0]
+            live = [item_id for item_id in item_ids if item_id not in dead]
+            items = live + items if before else items + live
+
+            missing = limit - len(items)
+            if missing <= 0 or not dead:
+                break
+            if before:
+                if start == 0:
+                    break
+                start, end = max(start - missing, 0), start - 1
+            else:
+                if len(item_ids) < end - start + 1:
+                    break
+                start, end = end + 1, end + missing
+
+        return items[max(len(items) - limit, 0):] if before else items[:limit]
+
+    @staticmethod
+    def _rank_range(limit, after_rank=None, before_rank=None):
+        """
+        calculate start and end index of list from the anchors' ranks
+        :param limit: number of elements
+        :param after_rank: rank of the after item
+        :param before_rank: rank of the before item
+        :return: start, end index or None if the range is empty
+        """
+        start, end = 0, limit - 1
+        if after_rank is not None:
+            start = after_rank + 1
+            end = start + limit - 1
+        elif before_rank is not None:
+            end = before_rank - 1
+            start = max(end - limit + 1, 0)
+
+        if end < start:
+            return None
+        return start, end
 
     @staticmethod
     def _calculate_start_end(name, limit, after, before):
@@ -73,58 +373,519 @@ class BaseEvent(ABC):
         :param limit: number of elements
         :param after: after id
         :param before: before id
-        :return: start, end index
+        :return: start, end index or None if the range is empty
         """
-        start, end = 0, 0
-        if not after and not before:
-            end = limit - 1
-        elif after is not None:
-            start = redis.zrevrank(name, after) + 1
-            end = start + limit - 1
-        elif before is not None:
-            end = redis.zrevrank(name, before) - 1
-            start = end - limit + 1 if end > limit else 0
-        else:
+        if after is not None and before is not None:
             raise Exception('cant have both after and before')
-        return start, end
 
-    def consume(self, consumer_id, limit=20, after=None, before=None):
+        anchor = after if after is not None else before
+        if anchor is None:
+            return BaseEvent._rank_range(limit)
+
+        rank = redis.zrevrank(name, anchor)
+        if rank is None:
+            raise Exception('item does not exist in timeline')
+
+        if after is not None:
+            return BaseEvent._rank_range(limit, after_rank=rank)
+        return BaseEvent._rank_range(limit, before_rank=rank)
+
+    @staticmethod
+    def _score_range(name, limit, since=None, until=None, since_id=None, until_id=None, tombstones=None):
+        """
+        read a page of a timeline by timestamp, newest first
+        :param name: list name
+        :param limit: number of elements
+        :param since: only items newer than this timestamp, nearest first
+        :param until: only items older than this timestamp, nearest first
+        :param since_id: tie-breaker, include items at `since` ordered after this id
+        :param until_id: tie-breaker, include items at `until` ordered before this id
+        :param tombstones: tombstone set name of the retracted items to skip
+        :return: list of item ids
+        """
+        # timestamps are stored as whole seconds, the bounds are
+        # truncated the same way so an item's own second is its bound
+        since = int(since) if since is not None else None
+        until = int(until) if until is not None else None
+
+        low = '-inf' if since is None else (since if since_id is not None else f"({since}")
+        high = '+inf' if until is None else (until if until_id is not None else f"({until}")
+
+        # over-fetch the items sharing the bound's timestamp, they are
+        # ordered by id and filtered against the tie-breaker below
+        if until is not None:
+            ties = redis.zcount(name, until, until) if until_id is not None else 0
+        else:
+            ties = redis.zcount(name, since, since) if since_id is not None else 0
+
+        # the page is refilled past the tombstoned items that are filtered out as well
+        offset, num, items = 0, limit + ties, []
+        while True:
+            if until is not None:
+                batch = redis.zrevrangebyscore(name, high, low, start=offset, num=num, withscores=True)
+            else:
+                batch = redis.zrangebyscore(name, low, high, start=offset, num=num, withscores=True)
+
+            batch = [(item.decode(), score) for item, score in batch]
+            dead = (BaseEvent._tombstoned([(tombstones, [item for item, _ in batch])])[0]
+                    if tombstones is not None else set())
+            items += [item for item, score in batch
+                      if item not in dead and
+                      not (until_id is not None and score == until and item >= until_id) and
+                      not (since_id is not None and score == since and item <= since_id)]
+
+            if len(items) >= limit or len(batch) < num or not dead:
+                break
+            offset, num = offset + num, limit - len(items)
+
+        items = items[:limit]
+        return items if until is not None else items[::-1]
+
+    def _hydrate(self, item_ids):
+        """
+        load the stored data of cached items
+        :param item_ids: list of item ids
+        :return: query of { item_id, verb }
+        """
+        return (self._dataset
+                .select(self._dataset.item_id, self._dataset.verb)
+                .where(self._dataset.item_id << item_ids)
+                .order_by(self._dataset.timestamp.desc())
+                .dicts())
+
+    def consume(self, consumer_id, limit=20, after=None, before=None, ranked=False,
+                since=None, until=None, since_id=None, until_id=None):
         """
         get data for consumer
         :param consumer_id: consumer's id
         :param limit: number of data to be returned
         :param after: return after (id)
         :param before: return before (id)
+        :param ranked: read the ranked timeline instead of the chronological one
+        :param since: return newer than (timestamp)
+        :param until: return older than (timestamp)
+        :param since_id: tie-breaker (id) for items at `since`
+        :param until_id: tie-breaker (id) for items at `until`
         :return: list of { 'id': item_id, 'verb': verb }
         """
 
-        consumer_feed = self.create_cache_name(consumer_id)
-        start, end = self._calculate_start_end(consumer_feed, limit, after, before)
+        if ranked and self._score is None:
+            raise Exception('event is not ranked')
+
+        by_time = since is not None or until is not None
+        if by_time and (after is not None or before is not None):
+            raise Exception('cant have both item and timestamp bounds')
+        if by_time and ranked:
+            raise Exception('cant use timestamp bounds on a ranked timeline')
+
+        consumer_feed = (self.create_ranked_name(consumer_id) if ranked
+                         else self.create_cache_name(consumer_id))
+
+        pipe = redis.pipeline()
+        pipe.exists(consumer_feed)
+        self._queue_tombstones(pipe)
+        exists, *counted = pipe.execute()
+        tombstones = self._tombstones(counted)
 
         # if consumer feed does not exist, query for creation
-        if not redis.exists(consumer_feed):
+        if not exists:
             self._recreate_user_timeline(consumer_id)
 
-        bin_resp = redis.zrevrange(consumer_feed, start, end)
-        response = list(map(lambda x: x.decode(), bin_resp))
+        # retracted items that were not swept yet are left out
+        # and the page is refilled past them
+        if by_time:
+            response = self._score_range(consumer_feed, limit, since, until, since_id, until_id, tombstones)
+        else:
+            page = self._calculate_start_end(consumer_feed, limit, after, before)
+            if page is None:
+                return []
+
+            response = self._rank_page(consumer_feed, tombstones, page, limit, before is not None)
 
         if not response:
             return []
 
-        return (self._dataset
-                .select(self._dataset.item_id, self._dataset.verb)
-                .where(self._dataset.item_id << response)
-                .order_by(self._dataset.timestamp.desc())
-                .dicts())
+        if ranked or by_time:
+            # keep the timeline's order, ties included, so the page's last
+            # item can be used as the next cursor
+            position = dict((item_id, index) for index, item_id in enumerate(response))
+            return sorted(self._hydrate(response), key=lambda row: position[row['item_id']])
+
+        return self._hydrate(response)
+
+    def mark_seen(self, consumer_id, item_id=None, timestamp=None):
+        """
+        move the consumer's last seen marker
+        :param consumer_id: consumer's id
+        :param item_id: mark up to this item, defaults to the newest item
+        :param timestamp: mark up to this timestamp instead of an item
+        :return: True on success
+        """
+
+        if timestamp is None:
+            consumer_feed = self.create_cache_name(consumer_id)
+            if item_id is not None:
+                timestamp = redis.zscore(consumer_feed, item_id)
+                if timestamp is None:
+                    raise Exception('item does not exist in timeline')
+            else:
+                newest = redis.zrevrange(consumer_feed, 0, 0, withscores=True)
+                if not newest:
+                    return True
+                timestamp = newest[0][1]
+
+        redis.hset(self.create_seen_name(), consumer_id, timestamp)
+        return True
+
+    def unread_count(self, consumer_id):
+        """
+        count the items newer than the consumer's last seen marker
+        :param consumer_id: consumer's id
+        :return: number of unread items
+        """
+
+        consumer_feed = self.create_cache_name(consumer_id)
+        pipe = redis.pipeline()
+        pipe.exists(consumer_feed)
+        pipe.hget(self.create_seen_name(), consumer_id)
+        self._queue_tombstones(pipe)
+        exists, seen, *counted = pipe.execute()
+
+        if not exists:
+            self._recreate_user_timeline(consumer_id)
+
+        low = f"({seen.decode()}" if seen else '-inf'
+        count = redis.zcount(consumer_feed, low, '+inf')
+        if not count or not any(counted):
+            return count
+
+        # unswept retracted items are not unread, whichever of the
+        # unread items and the tombstones is smaller is checked
+        if counted[0] <= count:
+            retracted = redis.zrange(self.create_tombstone_name(), 0, -1)
+            pipe = redis.pipeline()
+            for item_id in retracted:
+                pipe.zscore(consumer_feed, item_id)
+            return count - sum(1 for score in pipe.execute()
+                               if score is not None and (not seen or score > float(seen)))
+
+        unread = [item_id.decode() for item_id in redis.zrangebyscore(consumer_feed, low, '+inf')]
+        return count - len(self._tombstoned([(self.create_tombstone_name(), unread)])[0])
+
+    @staticmethod
+    def consume_many(consumer_id, pages):
+        """
+        get data of several events for a consumer, reading every timeline
+        in pipelined round trips and hydrating with one query per dataset
+        :param consumer_id: consumer's id
+        :param pages: list of (event, limit, after, before)
+        :return: list of [{ 'item_id', 'verb' }] in the order of pages
+        """
+
+        if any(after is not None and before is not None for _, _, after, before in pages):
+            raise Exception('cant have both after and before')
+
+        feeds = [event.create_cache_name(consumer_id) for event, *_ in pages]
+        anchors = [after if after is not None else before for _, _, after, before in pages]
+
+        # 1. check the timelines and tombstones and look up the anchors at once
+        pipe = redis.pipeline()
+        for (event, *_), feed, anchor in zip(pages, feeds, anchors):
+            pipe.exists(feed)
+            pipe.zrevrank(feed, anchor if anchor is not None else '')
+            event._queue_tombstones(pipe)
+        replies = iter(pipe.execute())
+        exists, ranks, tombstones = [], [], []
+        for event, *_ in pages:
+            exists.append(next(replies))
+            ranks.append(next(replies))
+            tombstones.append(event._tombstones([next(replies)] if event.lazy_retract else []))
+
+        # 2. recreate missing timelines and look their anchors up again
+        missing = [index for index, found in enumerate(exists) if not found]
+        if missing:
+            pipe = redis.pipeline()
+            for index in missing:
+                pages[index][0]._recreate_user_timeline(consumer_id)
+                pipe.zrevrank(feeds[index], anchors[index] if anchors[index] is not None else '')
+            for index, rank in zip(missing, pipe.execute()):
+                ranks[index] = rank
+
+        # 3. read every page at once
+        ranges = []
+        for anchor, rank, (_, limit, after, before) in zip(anchors, ranks, pages):
+            if anchor is not None and rank is None:
+                raise Exception('item does not exist in timeline')
+
+            ranges.append(BaseEvent._rank_range(limit,
+                                                after_rank=rank if after is not None else None,
+                                                before_rank=rank if before is not None else None))
+
+        pipe = redis.pipeline()
+        for feed, page in zip(feeds, ranges):
+            if page is not None:
+                pipe.zrevrange(feed, *page)
+        replies = iter(pipe.execute())
+        item_ids = [[item_id.decode() for item_id in next(replies)] if page is not None else []
+                    for page in ranges]
+
+        # 4. check the pages' items against the tombstones at once, the
+        # few pages that lost retracted items are read again and refilled
+        dead = BaseEvent._tombstoned(list(zip(tombstones, item_ids)))
+        for index, (feed, page, (_, limit, _, before)) in enumerate(zip(feeds, ranges, pages)):
+            if dead[index]:
+                item_ids[index] = BaseEvent._rank_page(feed, tombstones[index], page,
+                                                       limit, before is not None)
+
+        # 5. hydrate with a single query per dataset
+        by_dataset = {}
+        for (event, *_), ids in zip(pages, item_ids):
+            by_dataset.setdefault(event.dataset, set()).update(ids)
+
+        rows = {}
+        for dataset, ids in by_dataset.items():
+            if not ids:
+                continue
+            query = (dataset
+                     .select(dataset.item_id, dataset.verb)
+                     .where(dataset.item_id << list(ids))
+                     .dicts())
+            for row in query:
+                rows.setdefault((dataset, row['item_id']), []).append(row)
+
+        return [[row for item_id in ids for row in rows.get((event.dataset, item_id), ())]
+                for (event, *_), ids in zip(pages, item_ids)]
+
+    def consume_batch(self, consumer_ids, limit=20):
+        """
+        get the newest data of many consumers at once
+        :param consumer_ids: consumers' ids
+        :param limit: number of data to be returned per consumer
+        :return: { consumer_id: [{ 'item_id', 'verb' }] }
+        """
+
+        feeds = [self.create_cache_name(consumer_id) for consumer_id in consumer_ids]
+
+        # 1. recreate every missing timeline together
+        pipe = redis.pipeline()
+        for feed in feeds:
+            pipe.exists(feed)
+        self._queue_tombstones(pipe)
+        replies = pipe.execute()
+        exists, tombstones = replies[:len(feeds)], self._tombstones(replies[len(feeds):])
+        missing = [consumer_id for consumer_id, found in zip(consumer_ids, exists) if not found]
+        if missing:
+            self._recreate_user_timelines(missing)
+
+        # 2. read every page at once and check their items against the
+        # tombstones, the few pages that lost retracted items are refilled
+        pipe = redis.pipeline()
+        for feed in feeds:
+            pipe.zrevrange(feed, 0, limit - 1)
+        item_ids = [[item_id.decode() for item_id in resp] for resp in pipe.execute()]
+
+        dead = self._tombstoned([(tombstones, page) for page in item_ids])
+        for index, feed in enumerate(feeds):
+            if dead[index]:
+                item_ids[index] = self._rank_page(feed, tombstones, (0, limit - 1), limit)
+
+        # 3. hydrate with a single query
+        rows = {}
+        ids = set(item_id for page in item_ids for item_id in page)
+        for chunk in chunked(ids, 10000):
+            for row in self._hydrate(chunk):
+                rows.setdefault(row['item_id'], []).append(row)
+
+        return dict((consumer_id, [row for item_id in page for row in rows.get(item_id, ())])
+                    for consumer_id, page in zip(consumer_ids, item_ids))
+
+    def _cache_timelines(self, content):
+        """
+        add content to the cached timelines of their consumers
+        :param content: iterable of (consumer_id, item_id, timestamp)
+        :return: True on success
+        """
+        timelines, timestamps = {}, {}
+        for consumer_id, item_id, timestamp in content:
+            timelines.setdefault(consumer_id, {})[item_id] = timestamp
+            timestamps[item_id] = timestamp
+
+        ranks = self._rank(timestamps) or {}
+        pipe = redis.pipeline()
+        for consumer_id, items in timelines.items():
+            self._add_to_timeline(pipe, consumer_id, items,
+                                  dict((item_id, ranks[item_id]) for item_id in items if item_id in ranks))
+
+        pipe.execute()
+        return True
 
     @abstractmethod
-    def _recreate_user_timeline(self, consumer_id):
+    def _timeline_content(self, consumer_id):
         raise NotImplementedError()
 
+    @abstractmethod
+    def _recreate_user_timelines(self, consumer_ids):
+        raise NotImplementedError()
+
+    def _recreate_user_timeline(self, consumer_id):
+        """
+        for when (server restarts, or a new user logs in)
+        :param consumer_id: consumer's id
+        :return: True on success
+        """
+        content = self._timeline_content(consumer_id)
+
+        pipe = redis.pipeline()
+        self._add_to_timeline(pipe, consumer_id, content, self._rank(content))
+        pipe.execute()
+        return True
+
+    def verify(self, consumer_id, repair=True):
+        """
+        compare a cached timeline with the database and repair the
+        differences in place, timelines that are not cached are skipped
+        :param consumer_id: consumer's id
+        :param repair: fix the cached timeline
+        :return: { missing, extra } number of drifted items
+        """
+        consumer_feed = self.create_cache_name(consumer_id)
+        cached = dict((item_id.decode(), score)
+                      for item_id, score in redis.zrange(consumer_feed, 0, -1, withscores=True))
+        if not cached:
+            return {'missing': 0, 'extra': 0}
+
+        expected = sorted(self._timeline_content(consumer_id).items(), key=lambda x: x[1], reverse=True)
+        expected = dict(expected[:self._max_cache])
+
+        # items tied with the oldest one at a full timeline's cutoff
+        # may be cut either way, they are not drift
+        cutoff = None
+        if len(expected) >= self._max_cache:
+            cutoff = min(expected.values())
+
+        missing = dict((item_id, timestamp) for item_id, timestamp in expected.items()
+                       if cached.get(item_id) != timestamp and timestamp != cutoff)
+        extra = [item_id for item_id, timestamp in cached.items()
+                 if item_id not in expected and timestamp != cutoff]
+
+        if repair and (missing or extra):
+            pipe = redis.pipeline()
+            self._remove_from_timeline(pipe, consumer_id, extra)
+            if missing:
+                self._add_to_timeline(pipe, consumer_id, missing, self._rank(missing))
+            pipe.execute()
+
+        return {'missing': len(missing), 'extra': len(extra)}
+
+    def sweep(self, batch=500):
+        """
+        remove the retracted items from the cached timelines of their
+        producers' followers, a batch of tombstones at a time. the
+        tombstones are dropped once a whole pass went past them
+        :param batch: tombstones and timelines cleaned per round trip
+        :return: number of removed items
+        """
+        started = time()
+        removed, low, seen = 0, '-inf', set()
+        while True:
+            tombstones = redis.zrangebyscore(self.create_tombstone_name(), low, started,
+                                             start=0, num=batch, withscores=True)
+            item_ids = [item_id.decode() for item_id, _ in tombstones if item_id not in seen]
+            if not item_ids:
+                break
+
+            by_producer = {}
+            for item_id, producer_id in zip(item_ids, redis.hmget(self.create_retracted_name(), item_ids)):
+                by_producer.setdefault(producer_id.decode() if producer_id else None, []).append(item_id)
+
+            # tombstones without a known producer are looked for in every timeline
+            unknown = by_producer.pop(None, [])
+            if unknown:
+                removed += self._sweep_timelines(unknown, batch)
+
+            for producer_id, retracted in by_producer.items():
+                consumers = list(self._followers(producer_id))
+                if self._include_actor:
+                    consumers.append(producer_id)
+                for chunk in chunked(consumers, batch):
+                    pipe = redis.pipeline()
+                    for consumer_id in chunk:
+                        self._remove_from_timeline(pipe, consumer_id, retracted)
+                    removed += sum(pipe.execute())
+            redis.hdel(self.create_retracted_name(), *item_ids)
+
+            # continue from the last score, the ones sharing it are skipped
+            low = tombstones[-1][1]
+            seen = set(item_id for item_id, score in tombstones if score == low)
+
+        # tombstones written during the pass wait for the next one
+        redis.zremrangebyscore(self.create_tombstone_name(), '-inf', started)
+        return removed
+
+    def _sweep_timelines(self, item_ids, batch=500):
+        """
+        remove retracted items from every cached timeline
+        :param item_ids: list of item ids
+        :param batch: timelines cleaned per round trip
+        :return: number of removed items
+        """
+        prefix, suffix = 'fs:', f":{self.name}"
+        removed = 0
+        for keys in chunked(redis.scan_iter(match=f"{prefix}*{suffix}", count=batch), batch):
+            pipe = redis.pipeline()
+            for key in keys:
+                self._remove_from_timeline(pipe, key.decode()[len(prefix):-len(suffix)], item_ids)
+            removed += sum(pipe.execute())
+
+        return removed
+
+    def expire_timelines(self, cutoff, batch=500):
+        """
+        drop the content archived from the database out of the cached
+        timelines, so their pages are not hydrated short
+        :param cutoff: events with a timestamp before this are archived
+        :param batch: timelines trimmed per round trip
+        :return: number of dropped items
+        """
+        prefix, suffix = 'fs:', f":{self.name}"
+        removed = 0
+        for keys in chunked(redis.scan_iter(match=f"{prefix}*{suffix}", count=batch), batch):
+            expired = [[]] * len(keys)
+            if self._score is not None:
+                # ranked timelines are not scored by time, their items are removed by id
+                pipe = redis.pipeline()
+                for key in keys:
+                    pipe.zrangebyscore(key, '-inf', f"({cutoff}")
+                expired = pipe.execute()
+
+            pipe = redis.pipeline()
+            for key in keys:
+                pipe.zremrangebyscore(key, '-inf', f"({cutoff}")
+            for key, item_ids in zip(keys, expired):
+                if item_ids:
+                    pipe.zrem(self.create_ranked_name(key.decode()[len(prefix):-len(suffix)]), *item_ids)
+            removed += sum(pipe.execute()[:len(keys)])
+
+        return removed
+
     @property
     def verbs(self):
         return self._verbs
 
+    @property
+    def dataset(self):
+        return self._dataset
+
+    @property
+    def relations(self):
+        return self._relations
+
+    @property
+    def signature(self):
+        """ settings that shape the cached timelines of this event """
+        return (f"{type(self).__name__}:{self.name}:{','.join(sorted(self.verbs))}:"
+                f"{self._include_actor}:{self._max_cache}:{getattr(self._score, '__name__', None)}")
+
     @property
     def name(self):
         return self._name
@@ -132,6 +893,8 @@ class BaseEvent(ABC):
 
 class Flat(BaseEvent):
 
+    lazy_retract = True
+
     def add_event(self, payload, save=True):
         """
         add a new event
@@ -139,14 +902,15 @@ class Flat(BaseEvent):
         :param save: if True, will save to database
         :return: True on success
         """
-        # 1. create a new instance and add to database
+        # 1. create a new instance and add to database, a replayed
+        # or retried event is only stored once
         if save:
-            self._dataset.create(
+            self._dataset.insert(
                 producer_id=payload['producer_id'],
                 item_id=payload['item_id'],
                 timestamp=payload['timestamp'],
                 verb=payload['verb']
-            ).save()
+            ).on_conflict_ignore().execute()
 
         # 2. fan out process
         self._publish_fan_out_from_producer(
@@ -162,10 +926,13 @@ class Flat(BaseEvent):
         :return: True on success
         """
 
-        # 1. delete fan out
-        self._delete_fan_out_from_producer(
-            producer_id=payload.get('producer_id'),
-            item_id=payload.get('item_id'))
+        # 1. tombstone the item, it is skipped by reads
+        # and swept from the timelines in the background
+        pipe = redis.pipeline()
+        pipe.zadd(self.create_tombstone_name(), {payload.get('item_id'): time()})
+        pipe.hset(self.create_retracted_name(), payload.get('item_id'), payload.get('producer_id'))
+        pipe.zrem(self.create_outbox_name(payload.get('producer_id')), payload.get('item_id'))
+        pipe.execute()
 
         # 2. delete instance from database
         (self._dataset
@@ -175,6 +942,9 @@ class Flat(BaseEvent):
             (self._dataset.item_id == payload.get('item_id')))
          .execute())
 
+        if self._score is not None:
+            redis.hdel(self.create_engagement_name(), payload.get('item_id'))
+
         return True
 
     def subscribe(self, consumer_id, producer_id):
@@ -184,11 +954,12 @@ class Flat(BaseEvent):
         :param producer_id:
         :return: True on success
         """
-        # 1. create a new instance of follow
-        self._relations.create(
-            producer_id=producer_id,
-            consumer_id=consumer_id
-        ).save()
+        # 1. create a new instance of follow, a retried subscribe finds it already there
+        (self._relations
+         .insert(producer_id=producer_id, consumer_id=consumer_id)
+         .on_conflict_ignore()
+         .execute())
+        self._followed(consumer_id, [producer_id])
 
         # 2. broadcast update timeline
         self._add_from_producer_to_consumer(
@@ -197,6 +968,43 @@ class Flat(BaseEvent):
 
         return True
 
+    def _producers_content(self, consumer_id, producer_ids):
+        """
+        the most recent content of producers, merged from their outboxes
+        :param consumer_id: consumer's id
+        :param producer_ids: producers' ids
+        :return: { item_id: timestamp }
+        """
+        return self._merge(self._outboxes(producer_ids).values())
+
+    def rescore(self, producer_id, item_id, engagement):
+        """
+        update the ranking score of an item in every timeline holding it
+        :param producer_id: producer's id
+        :param item_id: item's id
+        :param engagement: item's new engagement
+        :return: True on success
+        """
+        if self._score is None:
+            raise Exception('event is not ranked')
+
+        content = self._dataset.get(
+            (self._dataset.producer_id == producer_id) &
+            (self._dataset.item_id == item_id))
+        rank = {item_id: self._score(content.timestamp, engagement)}
+
+        # only update timelines that still hold the item
+        pipe = redis.pipeline()
+        pipe.hset(self.create_engagement_name(), item_id, engagement)
+        for follower in self._followers(producer_id):
+            pipe.zadd(self.create_ranked_name(follower), rank, xx=True)
+
+        if self._include_actor:
+            pipe.zadd(self.create_ranked_name(producer_id), rank, xx=True)
+
+        pipe.execute()
+        return True
+
     def unsubscribe(self, consumer_id, producer_id):
         """
         unsubscribe a consumer from a producer
@@ -216,6 +1024,7 @@ class Flat(BaseEvent):
             (self._relations.consumer_id == consumer_id) &
             (self._relations.producer_id == producer_id))
          .execute())
+        self._unfollowed(consumer_id, producer_id)
 
         return True
 
@@ -226,17 +1035,14 @@ class Flat(BaseEvent):
         :param consumer_id: consumer's id
         :return: True on success
         """
-        # get producer's recent content (need to figure out how many)
-        content_ids = (self._dataset
-                       .select(self._dataset.item_id)
-                       .where((self._dataset.producer_id == producer_id))
-                       .namedtuples())
+        # a timeline only holds a producer's most recent
+        # content, which is all in the producer's outbox
+        content_ids = [item_id for item_id, _ in self._outboxes([producer_id])[producer_id]]
 
-        # inject to consumer's feed list
+        # remove from consumer's feed list
         pipe = redis.pipeline()
-        consumer_feed = self.create_cache_name(consumer_id)
-        for content_id in content_ids:
-            pipe.zrem(consumer_feed, content_id.item_id)
+        for chunk in chunked(content_ids, 400):
+            self._remove_from_timeline(pipe, consumer_id, chunk)
 
         pipe.execute()
         return True
@@ -246,17 +1052,11 @@ class Flat(BaseEvent):
         for subscribe events.
         :return: True on success
         """
-        # get producer's content
-        content = (self._dataset
-                   .select(self._dataset.item_id, self._dataset.timestamp)
-                   .where((self._dataset.producer_id == producer_id)))
+        # get producer's recent content
+        content = dict(self._outboxes([producer_id])[producer_id])
 
         pipe = redis.pipeline()
-        consumer_feed = self.create_cache_name(consumer_id)
-        for chunk in chunked(content, 400):
-            pipe.zadd(consumer_feed, dict((c.item_id, c.timestamp) for c in chunk))
-
-        pipe.eval(self.clean_excess_from_cache(consumer_id), 0)
+        self._add_to_timeline(pipe, consumer_id, content, self._rank(content))
         pipe.execute()
         return True
 
@@ -265,80 +1065,190 @@ class Flat(BaseEvent):
         for when a consumer publishes new content
         :return: True on success
         """
-        # get producer's followers
-        followers = (self._relations
-                     .select(self._relations.consumer_id)
-                     .where(self._relations.producer_id == producer_id)
-                     .namedtuples())
-
         content = self._dataset.get(self._dataset.item_id == item_id)
         content_info = {content.item_id: content.timestamp}
+        ranks = self._rank(content_info)
 
-        # inject content id to their list
+        # inject content id to their list, a republished item is live again
         pipe = redis.pipeline()
-        for follower in followers:
-            pipe.zadd(self.create_cache_name(follower.consumer_id), content_info)
-            pipe.eval(self.clean_excess_from_cache(follower.consumer_id), 0)
+        pipe.zrem(self.create_tombstone_name(), content.item_id)
+        pipe.hdel(self.create_retracted_name(), content.item_id)
+        pipe.zadd(self.create_outbox_name(producer_id), content_info)
+        pipe.zremrangebyrank(self.create_outbox_name(producer_id), 0, -(self._max_cache + 1))
+        for follower in self._followers(producer_id):
+            self._add_to_timeline(pipe, follower, content_info, ranks)
 
         if self._include_actor:
-            pipe.zadd(self.create_cache_name(producer_id), content_info)
-            pipe.eval(self.clean_excess_from_cache(producer_id), 0)
+            self._add_to_timeline(pipe, producer_id, content_info, ranks)
 
         pipe.execute()
         return True
 
-    def _delete_fan_out_from_producer(self, producer_id, item_id):
+    def create_outbox_name(self, producer_id):
         """
-        for when a producer retracts their content
-        :return: True on success
+        create the name of a producer's outbox, its most recent content
+        :param producer_id: producer's id
+        :return: string cache name
         """
-        # get producer's followers
-        followers = (self._relations
-                     .select(self._relations.consumer_id)
-                     .where(self._relations.producer_id == producer_id)
-                     .namedtuples())
+        return f"fs_outbox:{producer_id}:{self.name}"
+
+    def create_outboxes_name(self):
+        """
+        create the name of the hash of the producers whose outbox is loaded
+        :return: string hash name
+        """
+        return f"fs_outboxes:{self.name}"
+
+    def _outboxes(self, producer_ids):
+        """
+        the most recent content of producers from their outboxes,
+        outboxes that are not loaded yet are loaded with a single query
+        :param producer_ids: producers' ids
+        :return: { producer_id: [(item_id, timestamp)] } newest first
+        """
+        producer_ids = list(set(producer_ids))
+        if not producer_ids:
+            return {}
 
-        # inject content id to their list
         pipe = redis.pipeline()
-        for follower in followers:
-            pipe.zrem(self.create_cache_name(follower.consumer_id), item_id)
+        pipe.hmget(self.create_outboxes_name(), producer_ids)
+        for producer_id in producer_ids:
+            pipe.zrevrange(self.create_outbox_name(producer_id), 0, self._max_cache - 1, withscores=True)
+        loaded, *outboxes = pipe.execute()
 
-        if self._include_actor:
-            pipe.zrem(self.create_cache_name(producer_id), item_id)
+        content = dict((producer_id, [(item_id.decode(), timestamp) for item_id, timestamp in outbox])
+                       for producer_id, outbox in zip(producer_ids, outboxes))
+
+        missing = [producer_id for producer_id, found in zip(producer_ids, loaded) if not found]
+        for chunk in chunked(missing, 500):
+            content.update(self._load_outboxes(chunk))
+
+        return content
+
+    def _load_outboxes(self, producer_ids):
+        """
+        load the outboxes of producers from the database, content
+        published meanwhile is merged in rather than overwritten
+        :param producer_ids: producers' ids
+        :return: { producer_id: [(item_id, timestamp)] } newest first
+        """
+        position = fn.ROW_NUMBER().over(
+            partition_by=[self._dataset.producer_id],
+            order_by=[self._dataset.timestamp.desc()])
+
+        ranked = (self._dataset
+                  .select(self._dataset.producer_id, self._dataset.item_id,
+                          self._dataset.timestamp, position.alias('position'))
+                  .where(self._dataset.producer_id << list(producer_ids)))
+
+        content = dict((producer_id, []) for producer_id in producer_ids)
+        for producer_id, item_id, timestamp in (ranked
+                                                .select_from(ranked.c.producer_id, ranked.c.item_id,
+                                                             ranked.c.timestamp)
+                                                .where(ranked.c.position <= self._max_cache)
+                                                .tuples()):
+            content[producer_id].append((item_id, timestamp))
+
+        pipe = redis.pipeline()
+        for producer_id, items in content.items():
+            items.sort(key=itemgetter(1), reverse=True)
+            outbox = self.create_outbox_name(producer_id)
+            if items:
+                pipe.zadd(outbox, dict(items))
+                pipe.zremrangebyrank(outbox, 0, -(self._max_cache + 1))
+            pipe.hset(self.create_outboxes_name(), producer_id, 1)
 
         pipe.execute()
-        return True
+        return content
+
+    def _merge(self, outboxes):
+        """
+        k-way merge of outboxes into the most recent content
+        :param outboxes: iterable of [(item_id, timestamp)] newest first
+        :return: { item_id: timestamp }
+        """
+        return dict(islice(merge(*outboxes, key=itemgetter(1), reverse=True), self._max_cache))
+
+    def expire_outboxes(self, cutoff):
+        """
+        drop the content archived from the database out of the outboxes
+        :param cutoff: events with a timestamp before this are archived
+        :return: number of dropped items
+        """
+        removed = 0
+        for keys in chunked(redis.scan_iter(match=f"fs_outbox:*:{self.name}", count=500), 500):
+            pipe = redis.pipeline()
+            for key in keys:
+                pipe.zremrangebyscore(key, '-inf', f"({cutoff}")
+            removed += sum(pipe.execute())
+
+        return removed
+
+    def _timeline_content(self, consumer_id):
+        """
+        the most recent content of a consumer's timeline in the database
+        :param consumer_id: consumer's id
+        :return: { item_id: timestamp }
+        """
+
+        content = dict(self._relations
+                       .select(self._dataset.item_id, self._dataset.timestamp)
+                       .join(self._dataset, on=(self._relations.producer_id == self._dataset.producer_id))
+                       .where(self._relations.consumer_id == consumer_id)
+                       .order_by(self._dataset.timestamp.desc()).limit(self._max_cache)
+                       .tuples())
+
+        if self._include_actor:
+            content.update(self._dataset
+                           .select(self._dataset.item_id, self._dataset.timestamp)
+                           .where(self._dataset.producer_id == consumer_id)
+                           .order_by(self._dataset.timestamp.desc()).limit(self._max_cache)
+                           .tuples())
+
+        return content
+
+    def consumer_ids(self):
+        """
+        ids of every consumer that can have a timeline
+        :return: iterable of consumer ids
+        """
+        consumers = self._relations.select(self._relations.consumer_id.alias('id')).distinct()
+        if self._include_actor:
+            consumers = consumers | self._dataset.select(self._dataset.producer_id.alias('id')).distinct()
+
+        return (row[0] for row in consumers.tuples())
 
     def _recreate_user_timeline(self, consumer_id):
         """
         for when (server restarts, or a new user logs in)
+        :param consumer_id: consumer's id
         :return: True on success
         """
+        return self._recreate_user_timelines([consumer_id])
 
-        content = (self._relations
-                   .select(self._dataset.item_id, self._dataset.timestamp)
-                   .join(self._dataset, on=(self._relations.producer_id == self._dataset.producer_id))
-                   .where(self._relations.consumer_id == consumer_id)
-                   .order_by(self._dataset.timestamp.desc()).limit(self._max_cache)
-                   .namedtuples())
-
-        consumer_feed = self.create_cache_name(consumer_id)
-        for chunk in chunked(content, 400):
-            redis.zadd(consumer_feed, dict((c.item_id, c.timestamp) for c in chunk))
+    def _recreate_user_timelines(self, consumer_ids):
+        """
+        recreate the timelines of many consumers by merging the
+        outboxes of the producers they follow
+        :param consumer_ids: consumers' ids
+        :return: True on success
+        """
 
-        if not self._include_actor:
-            return True
+        follows = {}
+        for consumer_id, producer_id in self._followees(consumer_ids):
+            follows.setdefault(consumer_id, []).append(producer_id)
 
-        content = (self._dataset
-                   .select(self._dataset.item_id, self._dataset.timestamp)
-                   .where(self._dataset.producer_id == consumer_id))
+        if self._include_actor:
+            for consumer_id in consumer_ids:
+                follows.setdefault(consumer_id, []).append(consumer_id)
 
-        pipe = redis.pipeline()
-        for chunk in chunked(content, 400):
-            pipe.zadd(consumer_id, dict((c.item_id, c.timestamp) for c in chunk))
+        outboxes = self._outboxes(producer_id for producer_ids in follows.values()
+                                  for producer_id in producer_ids)
 
-        pipe.execute()
-        return True
+        return self._cache_timelines((consumer_id, item_id, timestamp)
+                                     for consumer_id, producer_ids in follows.items()
+                                     for item_id, timestamp in self._merge(
+                                         outboxes[producer_id] for producer_id in set(producer_ids)).items())
 
 
 class Activity(BaseEvent):
@@ -350,15 +1260,16 @@ class Activity(BaseEvent):
         :param save: if True will save to db
         :return: True on success
         """
-        # 1. create a new instance and add to database
+        # 1. create a new instance and add to database, a replayed
+        # or retried event is only stored once
         if save:
-            self._dataset.create(
+            self._dataset.insert(
                 producer_id=payload.get('producer_id'),
                 consumer_id=payload.get('consumer_id'),
                 verb=payload.get('verb'),
                 timestamp=payload.get('timestamp'),
                 item_id=payload.get('item_id')
-            ).save()
+            ).on_conflict_ignore().execute()
 
         # 2. process fan out
         self._publish_fan_out_from_producer(
@@ -375,7 +1286,7 @@ class Activity(BaseEvent):
 
         # 1. delete fan out
         self._delete_fan_out_from_producer(
-            consumer_id=payload.get('producer_id'),
+            consumer_id=payload.get('consumer_id'),
             item_id=payload.get('item_id'))
 
         # 2. delete the corresponding instance in database
@@ -387,6 +1298,9 @@ class Activity(BaseEvent):
             (self._dataset.verb == payload.get('verb')) &
             (self._dataset.consumer_id == payload.get('consumer_id')))
          .execute())
+
+        if self._score is not None:
+            redis.hdel(self.create_engagement_name(), payload.get('item_id'))
         return True
 
     def subscribe(self, consumer_id, producer_id):
@@ -397,11 +1311,12 @@ class Activity(BaseEvent):
         :return: True on success
         """
 
-        # 1. create a new instance of follow
-        self._relations.create(
-            producer_id=producer_id,
-            consumer_id=consumer_id
-        ).save()
+        # 1. create a new instance of follow, a retried subscribe finds it already there
+        (self._relations
+         .insert(producer_id=producer_id, consumer_id=consumer_id)
+         .on_conflict_ignore()
+         .execute())
+        self._followed(consumer_id, [producer_id])
 
         # 2. broadcast update timeline
         self._add_from_producer_to_consumer(
@@ -409,6 +1324,49 @@ class Activity(BaseEvent):
             producer_id=producer_id)
         return True
 
+    def _producers_content(self, consumer_id, producer_ids):
+        """
+        the most recent activities of producers towards a consumer
+        :param consumer_id: consumer's id
+        :param producer_ids: producers' ids
+        :return: { item_id: timestamp }
+        """
+        return dict(self._dataset
+                    .select(self._dataset.item_id, self._dataset.timestamp)
+                    .where(
+                        (self._dataset.producer_id << list(producer_ids)) &
+                        (self._dataset.consumer_id == consumer_id))
+                    .order_by(self._dataset.timestamp.desc()).limit(self._max_cache)
+                    .tuples())
+
+    def rescore(self, producer_id, item_id, engagement):
+        """
+        update the ranking score of an item in every timeline holding it
+        :param producer_id: producer's id
+        :param item_id: item's id
+        :param engagement: item's new engagement
+        :return: True on success
+        """
+        if self._score is None:
+            raise Exception('event is not ranked')
+
+        content = (self._dataset
+                   .select(self._dataset.consumer_id, self._dataset.timestamp)
+                   .where(
+                        (self._dataset.producer_id == producer_id) &
+                        (self._dataset.item_id == item_id))
+                   .namedtuples())
+
+        # only update timelines that still hold the item
+        pipe = redis.pipeline()
+        pipe.hset(self.create_engagement_name(), item_id, engagement)
+        for c in content:
+            pipe.zadd(self.create_ranked_name(c.consumer_id),
+                      {item_id: self._score(c.timestamp, engagement)}, xx=True)
+
+        pipe.execute()
+        return True
+
     def unsubscribe(self, consumer_id, producer_id):
         """
         unsubscribe a consumer from a producer
@@ -427,6 +1385,7 @@ class Activity(BaseEvent):
             (self._relations.consumer_id == consumer_id) &
             (self._relations.producer_id == producer_id))
          .execute())
+        self._unfollowed(consumer_id, producer_id)
 
         return True
 
@@ -446,9 +1405,8 @@ class Activity(BaseEvent):
                                .dicts())
 
         pipe = redis.pipeline()
-        consumer_feed = self.create_cache_name(consumer_id)
-        for content_id in content_ids:
-            pipe.zrem(consumer_feed, content_id['item_id'])
+        for chunk in chunked(content_ids, 400):
+            self._remove_from_timeline(pipe, consumer_id, [c['item_id'] for c in chunk])
 
         pipe.execute()
         return True
@@ -460,18 +1418,16 @@ class Activity(BaseEvent):
         :param producer_id: producer's id
         :return: True on success
         """
-        content = (self._dataset
-                       .select(self._dataset.item_id, self._dataset.timestamp)
-                       .where(
-                            (self._dataset.producer_id == producer_id) &
-                            (self._dataset.consumer_id == consumer_id)))
+        content = dict(self._dataset
+                           .select(self._dataset.item_id, self._dataset.timestamp)
+                           .where(
+                                (self._dataset.producer_id == producer_id) &
+                                (self._dataset.consumer_id == consumer_id))
+                           .order_by(self._dataset.timestamp.desc()).limit(self._max_cache)
+                           .tuples())
 
-        consumer_feed = self.create_cache_name(consumer_id)
         pipe = redis.pipeline()
-        for chunk in chunked(content, 400):
-            pipe.zadd(consumer_feed, dict((c.item_id, c.timestamp) for c in chunk))
-
-        pipe.eval(self.clean_excess_from_cache(consumer_id), 0)
+        self._add_to_timeline(pipe, consumer_id, content, self._rank(content))
         pipe.execute()
         return True
 
@@ -484,8 +1440,11 @@ class Activity(BaseEvent):
         """
 
         content = self._dataset.get(self._dataset.item_id == item_id)
-        redis.zadd(self.create_cache_name(consumer_id), {content.item_id: content.timestamp})
-        redis.eval(self.clean_excess_from_cache(consumer_id), 0)
+        content_info = {content.item_id: content.timestamp}
+
+        pipe = redis.pipeline()
+        self._add_to_timeline(pipe, consumer_id, content_info, self._rank(content_info))
+        pipe.execute()
         return True
 
     def _delete_fan_out_from_producer(self, consumer_id, item_id):
@@ -495,26 +1454,52 @@ class Activity(BaseEvent):
         :param item_id: item's id
         :return: True on success
         """
-        redis.zrem(self.create_cache_name(consumer_id), item_id)
+        pipe = redis.pipeline()
+        self._remove_from_timeline(pipe, consumer_id, [item_id])
+        pipe.execute()
         return True
 
-    def _recreate_user_timeline(self, consumer_id):
+    def _timeline_content(self, consumer_id):
         """
-        recreate users timeline
+        the most recent content of a consumer's timeline in the database
         :param consumer_id: consumer's id
-        :return: True on success
+        :return: { item_id: timestamp }
         """
 
         # get all content with consumer_id as target
-        content = (self._dataset
-                   .select(self._dataset.item_id, self._dataset.timestamp)
-                   .where(self._dataset.consumer_id == consumer_id)
-                   .order_by(self._dataset.timestamp.desc()).limit(self._max_cache))
+        return dict(self._dataset
+                    .select(self._dataset.item_id, self._dataset.timestamp)
+                    .where(self._dataset.consumer_id == consumer_id)
+                    .order_by(self._dataset.timestamp.desc()).limit(self._max_cache)
+                    .tuples())
 
-        pipe = redis.pipeline()
-        consumer_feed = self.create_cache_name(consumer_id)
-        for chunk in chunked(content, 400):
-            pipe.zadd(consumer_feed, dict((c.item_id, c.timestamp) for c in chunk))
+    def consumer_ids(self):
+        """
+        ids of every consumer that can have a timeline
+        :return: iterable of consumer ids
+        """
+        consumers = self._dataset.select(self._dataset.consumer_id).distinct()
+        return (row[0] for row in consumers.tuples())
 
-        pipe.execute()
-        return True
+    def _recreate_user_timelines(self, consumer_ids):
+        """
+        recreate the timelines of many consumers with a single query
+        :param consumer_ids: consumers' ids
+        :return: True on success
+        """
+
+        position = fn.ROW_NUMBER().over(
+            partition_by=[self._dataset.consumer_id],
+            order_by=[self._dataset.timestamp.desc()])
+
+        ranked = (self._dataset
+                  .select(self._dataset.consumer_id, self._dataset.item_id,
+                          self._dataset.timestamp, position.alias('position'))
+                  .where(self._dataset.consumer_id << list(consumer_ids)))
+
+        content = (ranked
+                   .select_from(ranked.c.consumer_id, ranked.c.item_id, ranked.c.timestamp)
+                   .where(ranked.c.position <= self._max_cache)
+                   .tuples())
+
+        return self._cache_timelines(content)
@@ -1,5 +1,17 @@
 from controllers.EventController import *
+from controllers.TaskQueue import INTERACTIVE, FAN_OUT, BULK, QueueClosed
 from models import *
+import logging
+from peewee import chunked, DataError, IntegrityError
+from time import time
+from utils.IngestLog import LogClosed
+from zlib import crc32
+
+
+logger = logging.getLogger(__name__)
+
+# bump when the layout of cached timelines changes
+CACHE_VERSION = 1
 
 
 class EventProcessor:
@@ -8,6 +20,8 @@ class EventProcessor:
     event_by_verb = {}
     event_by_name = {}
     task_queue = None
+    ingest_log = None
+    verifier = None
 
     @classmethod
     def register_event_handler(cls, event: BaseEvent):
@@ -37,24 +51,386 @@ class EventProcessor:
         return True
 
     @classmethod
-    def preload_data(cls):
+    def register_ingest_log(cls, ingest_log):
+        """
+        register a write-ahead ingestion log, publish and retract are
+        acknowledged once appended and applied to the database in batches
+        :param ingest_log: ingest log instance
+        :return: True on success
+        """
+
+        if cls.ingest_log:
+            return False
+
+        cls.ingest_log = ingest_log
+        ingest_log.start_applier(cls.apply_ingested, reject=cls._reject_ingested)
+        return True
+
+    @classmethod
+    def register_graph_index(cls, relations, graph):
+        """
+        load a graph index of a relations table and serve the
+        relations of every event using that table from it
+        :param relations: relations model
+        :param graph: graph index instance
+        :return: True on success
+        """
+
+        graph.open(lambda: (relations
+                            .select(relations.consumer_id, relations.producer_id)
+                            .tuples()
+                            .iterator()))
+
+        for event in cls.events:
+            if event.relations is relations:
+                event.use_graph_index(graph)
+
+        return True
+
+    @classmethod
+    def register_verifier(cls, verifier):
+        """
+        register and start a background timeline verifier
+        :param verifier: verifier instance
+        :return: True on success
+        """
+
+        if cls.verifier:
+            return False
+
+        cls.verifier = verifier
+        verifier.start()
+        return True
+
+    @classmethod
+    def drift(cls):
+        """
+        drift metrics of the cached timelines
+        :return: { event_name: metrics }
+        """
+        return cls.verifier.metrics if cls.verifier is not None else {}
+
+    @classmethod
+    def apply_ingested(cls, records):
+        """
+        apply a batch of ingested records, consecutive publishes are saved
+        with a single insert per event. the fan-outs and retractions are
+        queued once the whole batch is saved, so a batch that is retried
+        after a failure does not queue them twice
+        :param records: list of { op, payload }
+        :return: True on success
+        """
+
+        pending, jobs = {}, []
+
+        def flush():
+            for event_handler, payloads in pending.items():
+                for payload in cls._save_ingested(event_handler, payloads):
+                    jobs.append((event_handler.add_event, {'payload': payload, 'save': False},
+                                 cls._job_class(event_handler)))
+            pending.clear()
+
+        for record in records:
+            payload = record['payload']
+            if record['op'] == 'publish':
+                for event_handler in cls.event_by_verb.get(payload['verb'], []):
+                    pending.setdefault(event_handler, []).append(payload)
+            else:
+                # keep retractions ordered after the publishes before them
+                flush()
+                for event_handler in cls.event_by_verb[payload['verb']]:
+                    jobs.append((event_handler.retract_event, {'payload': payload},
+                                 cls._job_class(event_handler)))
+
+        flush()
+        for job, kwargs, job_class in jobs:
+            cls.task_queue.add_task(job, job_class=job_class, **kwargs)
+        return True
+
+    @classmethod
+    def _reject_ingested(cls, record, error):
+        """
+        dead letter an ingested record that keeps failing to apply,
+        to replay it once the cause is fixed
+        :param record: { op, payload }
+        :param error: last error
+        """
+        payload = record['payload']
+        for event_handler in cls.event_by_verb.get(payload.get('verb'), []):
+            job = event_handler.add_event if record['op'] == 'publish' else event_handler.retract_event
+            cls.task_queue.dead_letter(job, (), {'payload': payload},
+                                       cls._job_class(event_handler), 1, error)
+
+    @classmethod
+    def _ingest(cls, record):
+        """
+        append a record to the ingest log
+        :param record: { op, payload }
+        :return: True on success
+        """
+        try:
+            return cls.ingest_log.append(record)
+        except LogClosed as e:
+            raise QueueClosed(str(e))
+
+    @classmethod
+    def _save_ingested(cls, event_handler, payloads):
+        """
+        save a batch of ingested events, events that can never be saved,
+        e.g. logged before they were validated, are dead lettered instead
+        of blocking the log. a rejected batch is saved one event at a time
+        :param event_handler: event the payloads belong to
+        :param payloads: list of json payloads
+        :return: list of the saved payloads
+        """
+
+        def reject(payload, error):
+            cls.task_queue.dead_letter(event_handler.add_event, (), {'payload': payload},
+                                       cls._job_class(event_handler), 1, error)
+
+        valid = []
+        for payload in payloads:
+            try:
+                event_handler.validate(payload)
+                valid.append(payload)
+            except Exception as e:
+                reject(payload, e)
+
+        try:
+            event_handler.save_events(valid)
+            return valid
+        except (IntegrityError, DataError):
+            pass
+
+        saved = []
+        for payload in valid:
+            try:
+                event_handler.save_events([payload])
+                saved.append(payload)
+            except (IntegrityError, DataError) as e:
+                reject(payload, e)
+        return saved
+
+    @staticmethod
+    def _job_class(event_handler):
+        """
+        scheduling class of an event's publish and retract jobs,
+        activities only touch a single timeline
+        """
+        return INTERACTIVE if isinstance(event_handler, Activity) else FAN_OUT
+
+    @staticmethod
+    def _event_models():
+        """ all event dataset models """
+        return FlatEvent.__subclasses__() + ActivityEvent.__subclasses__()
+
+    @classmethod
+    def cache_epoch(cls):
+        """
+        epoch of the cached timelines, changes whenever the
+        registered events are configured differently
+        :return: epoch string
+        """
+        signature = '|'.join(sorted(event.signature for event in cls.events))
+        return f"{CACHE_VERSION}:{crc32(signature.encode())}"
+
+    @classmethod
+    def high_water_marks(cls):
+        """
+        highest event id written to each dataset
+        :return: { table_name: id }
+        """
+        return dict((model._meta.table_name, model.select(fn.MAX(model.id)).scalar() or 0)
+                    for model in cls._event_models())
+
+    @classmethod
+    def preload_data(cls, high_water_marks=None):
         """
         preload data into redis
+        :param high_water_marks: if provided, only events written after
+            these ids are loaded { table_name: id }
+        :return: True on success
+        """
+
+        for model in cls._event_models():
+            query = model.select().order_by(model.id)
+            if high_water_marks is not None:
+                query = query.where(model.id > high_water_marks.get(model._meta.table_name, 0))
+
+            for event in query:
+                cls.add_event(event.make_json(), save=False, job_class=BULK)
+
+        return True
+
+    @classmethod
+    def rebuild_shard(cls, shard, shards, chunk_size=500, listings=None):
+        """
+        rebuild the cached timelines of a shard of the consumers
+        :param shard: shard number
+        :param shards: number of shards, consumers are split by crc32
+        :param chunk_size: number of timelines rebuilt at once
+        :param listings: consumers split by shard, shared by the shards
+            rebuilt during one initialization so they are listed once.
+            None lists them for this shard only
+        :return: True on success
+        """
+
+        listings = {} if listings is None else listings
+        for event in cls.events:
+            members = cls._shard_consumers(event, shards, listings)
+            for chunk in chunked(members.pop(shard, []), chunk_size):
+                event._recreate_user_timelines(chunk)
+
+        return True
+
+    @staticmethod
+    def _shard_consumers(event, shards, listings):
+        """
+        consumers of an event split by shard, listed on first use
+        :param event: event
+        :param shards: number of shards, consumers are split by crc32
+        :param listings: { (event name, shards): { shard: [consumer ids] } }
+        :return: { shard: [consumer ids] } of the shards left to rebuild
+        """
+        key = (event.name, shards)
+        if key not in listings:
+            members = dict((shard, []) for shard in range(shards))
+            for consumer_id in event.consumer_ids():
+                members[crc32(consumer_id.encode()) % shards].append(consumer_id)
+            listings[key] = members
+
+        return listings[key]
+
+    @classmethod
+    def archive_events(cls, horizon, bucket_size=86400):
+        """
+        move events older than the horizon to the cold archive
+        :param horizon: age in seconds after which events are archived
+        :param bucket_size: size of each archive partition in seconds
         :return: True on success
         """
 
-        models = []
-        models += FlatEvent.__subclasses__()
-        models += ActivityEvent.__subclasses__()
+        cutoff = int(time()) - horizon
+        datasets = set(event.dataset for event in cls.events)
+        for dataset in datasets:
+            cls.task_queue.add_task(EventArchive.archive, dataset, job_class=BULK,
+                                    cutoff=cutoff, bucket_size=bucket_size)
 
-        for model in models:
-            for event in model:
-                cls.add_event(event.make_json(), save=False)
+        # the archived content is trimmed off the caches too, a timeline
+        # refilled before its events were archived is trimmed on the next run
+        for event in cls.events:
+            cls.task_queue.add_task(event.expire_timelines, cutoff, job_class=BULK)
+            if isinstance(event, Flat):
+                cls.task_queue.add_task(event.expire_outboxes, cutoff, job_class=BULK)
 
         return True
 
     @classmethod
-    def consume(cls, event_name, consumer_id, limit=20, after=None, before=None):
+    def sweep_tombstones(cls, batch=500):
+        """
+        remove the retracted items from the cached timelines
+        :param batch: timelines cleaned per round trip
+        :return: True on success
+        """
+
+        for event in cls.events:
+            cls.task_queue.add_task(event.sweep, job_class=BULK, batch=batch)
+
+        return True
+
+    @classmethod
+    def failures(cls):
+        """
+        failed attempts per job type since the start
+        :return: { job name: count }
+        """
+        return dict(cls.task_queue.failures)
+
+    @classmethod
+    def dead_letters(cls):
+        """
+        jobs that ran out of attempts
+        :return: { letter id: letter }
+        """
+        if cls.task_queue.dead_letters is None:
+            return {}
+
+        return cls.task_queue.dead_letters.copy()
+
+    @classmethod
+    def replay_dead_letter(cls, letter_id):
+        """
+        queue a dead lettered event job again
+        :param letter_id: dead letter's id
+        :return: True on success
+        """
+        letters = cls.task_queue.dead_letters
+        letter = letters.pop(letter_id) if letters is not None else None
+        if letter is None:
+            raise Exception('dead letter does not exist')
+
+        job = cls._resolve_job(letter)
+        if job is None:
+            letters.set(letter_id, letter)
+            raise Exception('dead letter can not be replayed')
+
+        cls.task_queue.add_task(job, *letter['args'], job_class=letter['job_class'], **letter['kwargs'])
+        return True
+
+    @classmethod
+    def _resolve_job(cls, job):
+        """
+        resolve a stored job to its event's method
+        :param job: serialized job
+        :return: bound method or None
+        """
+        event = cls.event_by_name.get(job['target'])
+        method = getattr(event, job['method'] or '', None) if event is not None else None
+        return method if callable(method) else None
+
+    @classmethod
+    def restore_jobs(cls):
+        """
+        queue the jobs left over by the previous process' shutdown, in
+        the order they were taken. jobs that were interrupted while running
+        may have completed before and are replayed at least once, which the
+        jobs tolerate: publishes and subscribes are stored only once
+        :return: number of restored jobs
+        """
+        spill = cls.task_queue.spill
+        if spill is None:
+            return 0
+
+        restored = 0
+        for job_id in sorted(spill.keys()):
+            job = spill.pop(job_id)
+            method = cls._resolve_job(job)
+            if method is None:
+                logger.warning('can not restore %s', job['job'])
+                continue
+
+            cls.task_queue.add_task(method, *job['args'], job_class=job['job_class'], **job['kwargs'])
+            restored += 1
+
+        return restored
+
+    @classmethod
+    def discard_dead_letter(cls, letter_id):
+        """
+        drop a dead letter
+        :param letter_id: dead letter's id
+        :return: True on success
+        """
+        letters = cls.task_queue.dead_letters
+        if letters is None or letter_id not in letters:
+            raise Exception('dead letter does not exist')
+
+        letters.delete(letter_id)
+        return True
+
+    @classmethod
+    def consume(cls, event_name, consumer_id, limit=20, after=None, before=None, ranked=False,
+                since=None, until=None, since_id=None, until_id=None):
         """
         consume for consumer
         :param event_name: event name
@@ -62,6 +438,11 @@ class EventProcessor:
         :param limit: number of returned data
         :param after: after specific item
         :param before: before specific item
+        :param ranked: return the ranked timeline
+        :param since: newer than specific timestamp
+        :param until: older than specific timestamp
+        :param since_id: tie-breaker item at since
+        :param until_id: tie-breaker item at until
         :return: [{ item_id, verb }]
         """
 
@@ -72,22 +453,110 @@ class EventProcessor:
                    .consume(consumer_id=consumer_id,
                             limit=limit,
                             after=after,
-                            before=before))
+                            before=before,
+                            ranked=ranked,
+                            since=since,
+                            until=until,
+                            since_id=since_id,
+                            until_id=until_id))
+
+    @classmethod
+    def consume_many(cls, consumer_id, events):
+        """
+        consume several events for consumer at once
+        :param consumer_id: consumer's id
+        :param events: { event_name: { limit, after, before } }
+        :return: { event_name: [{ item_id, verb }] }
+        """
+
+        for event_name in events:
+            if event_name not in cls.event_by_name:
+                raise Exception('event does not exist')
+
+        names = list(events)
+        pages = [(cls.event_by_name[name],
+                  int(events[name].get('limit', 20)),
+                  events[name].get('after'),
+                  events[name].get('before')) for name in names]
+
+        return dict(zip(names, BaseEvent.consume_many(consumer_id, pages)))
 
     @classmethod
-    def add_event(cls, payload, save=True):
+    def consume_batch(cls, event_name, consumer_ids, limit=20, chunk_size=500):
+        """
+        consume an event for many consumers, for server-side jobs
+        :param event_name: event name
+        :param consumer_ids: consumers' ids
+        :param limit: number of returned data per consumer
+        :param chunk_size: number of consumers processed at once
+        :return: generator of { consumer_id: [{ item_id, verb }] } chunks
+        """
+
+        if event_name not in cls.event_by_name:
+            raise Exception('event does not exist')
+
+        event = cls.event_by_name[event_name]
+        for chunk in chunked(consumer_ids, chunk_size):
+            yield event.consume_batch(consumer_ids=chunk, limit=limit)
+
+    @classmethod
+    def mark_seen(cls, event_name, consumer_id, item_id=None, timestamp=None):
+        """
+        mark an event as seen by consumer up to an item
+        :param event_name: event name
+        :param consumer_id: consumer's id
+        :param item_id: last seen item, defaults to the newest item
+        :param timestamp: last seen timestamp instead of an item
+        :return: True on success
+        """
+
+        if event_name not in cls.event_by_name:
+            raise Exception('event does not exist')
+
+        return (cls.event_by_name[event_name]
+                   .mark_seen(consumer_id=consumer_id,
+                              item_id=item_id,
+                              timestamp=timestamp))
+
+    @classmethod
+    def unread_count(cls, event_name, consumer_id):
+        """
+        number of unseen items of an event for consumer
+        :param event_name: event name
+        :param consumer_id: consumer's id
+        :return: unread count
+        """
+
+        if event_name not in cls.event_by_name:
+            raise Exception('event does not exist')
+
+        return cls.event_by_name[event_name].unread_count(consumer_id=consumer_id)
+
+    @classmethod
+    def add_event(cls, payload, save=True, job_class=None):
         """
         register new event
         :param payload: json payload
         :param save: save event permanently
+        :param job_class: scheduling class, defaults to the event's
         :return: True on success
         """
         if 'verb' not in payload:
             raise Exception('invalid payload; missing verb')
 
+        if payload['verb'] not in cls.event_by_verb:
+            raise Exception('invalid payload; unknown verb')
+
+        for event_handler in cls.event_by_verb[payload['verb']]:
+            event_handler.validate(payload)
+
+        if save and cls.ingest_log is not None:
+            return cls._ingest({'op': 'publish', 'payload': payload})
+
         for event_handler in cls.event_by_verb[payload['verb']]:
             job = event_handler.add_event
-            cls.task_queue.add_task(job, payload=payload, save=save)
+            cls.task_queue.add_task(job, payload=payload, save=save,
+                                    job_class=job_class or cls._job_class(event_handler))
 
         return True
 
@@ -102,9 +571,45 @@ class EventProcessor:
         if 'verb' not in payload:
             raise Exception('invalid payload; missing verb')
 
+        if payload['verb'] not in cls.event_by_verb:
+            raise Exception('invalid payload; unknown verb')
+
+        if cls.ingest_log is not None:
+            return cls._ingest({'op': 'retract', 'payload': payload})
+
+        return cls._retract_event(payload)
+
+    @classmethod
+    def _retract_event(cls, payload):
+        """
+        queue the retraction of an event
+        :param payload: json payload
+        :return: True on success
+        """
+
         for event_handler in cls.event_by_verb[payload['verb']]:
             job = event_handler.retract_event
-            cls.task_queue.add_task(job, payload=payload)
+            cls.task_queue.add_task(job, payload=payload, job_class=cls._job_class(event_handler))
+
+        return True
+
+    @classmethod
+    def rescore(cls, event_name, producer_id, item_id, engagement):
+        """
+        update an item's engagement and ranking score
+        :param event_name: event name
+        :param producer_id: producer's id
+        :param item_id: item's id
+        :param engagement: item's new engagement
+        :return: True on success
+        """
+
+        if event_name not in cls.event_by_name:
+            raise Exception('event does not exist')
+
+        job = cls.event_by_name[event_name].rescore
+        cls.task_queue.add_task(job, producer_id=producer_id, item_id=item_id,
+                                engagement=engagement, job_class=FAN_OUT)
 
         return True
 
@@ -122,7 +627,27 @@ class EventProcessor:
             raise Exception('invalid event name')
 
         job = cls.event_by_name[event_name].subscribe
-        cls.task_queue.add_task(job, consumer_id=consumer_id, producer_id=producer_id)
+        cls.task_queue.add_task(job, consumer_id=consumer_id, producer_id=producer_id,
+                                job_class=INTERACTIVE)
+
+        return True
+
+    @classmethod
+    def subscribe_many(cls, event_name, consumer_id, producer_ids):
+        """
+        subscribe follower to many producers at once
+        :param event_name: event's name
+        :param consumer_id: consumer's id
+        :param producer_ids: producers' ids
+        :return: True on success
+        """
+
+        if event_name not in cls.event_by_name:
+            raise Exception('invalid event name')
+
+        job = cls.event_by_name[event_name].subscribe_many
+        cls.task_queue.add_task(job, consumer_id=consumer_id, producer_ids=producer_ids,
+                                job_class=INTERACTIVE)
 
         return True
 
@@ -140,6 +665,7 @@ class EventProcessor:
             raise Exception('invalid event name')
 
         job = cls.event_by_name[event_name].unsubscribe
-        cls.task_queue.add_task(job, consumer_id=consumer_id, producer_id=producer_id)
+        cls.task_queue.add_task(job, consumer_id=consumer_id, producer_id=producer_id,
+                                job_class=INTERACTIVE)
 
         return True
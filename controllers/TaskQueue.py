@@ -1,36 +1,209 @@
-from threading import Thread
-from queue import Queue
+from threading import Lock, Thread, Timer, get_ident
+from queue import Queue, Empty
+from collections import Counter, deque
+from random import random
+from time import time, monotonic
+from uuid import uuid4
+import json
+
+
+# job classes, from the most to the least latency sensitive
+INTERACTIVE = 'interactive'
+FAN_OUT = 'fan_out'
+BULK = 'bulk'
+
+
+class QueueClosed(Exception):
+    """ raised when adding a task to a queue that is shutting down """
 
 
 class TaskQueue(Queue):
 
-    def __init__(self, workers=1):
+    def __init__(self, workers=1, weights=None, max_attempts=5, backoff=0.5,
+                 max_backoff=60.0, dead_letters=None, spill=None):
         """
         initialize a new Queue
         :param workers: number of workers
+        :param weights: share of the workers each job class gets
+            while the classes compete { job_class: weight }
+        :param max_attempts: attempts of a failing task before it is dead lettered
+        :param backoff: seconds before the first retry, doubled on every attempt
+        :param max_backoff: max seconds between two attempts
+        :param dead_letters: key value store of the tasks out of attempts
+        :param spill: key value store of the tasks left over by a shutdown
         """
+        self.weights = weights or {INTERACTIVE: 16, FAN_OUT: 4, BULK: 1}
         Queue.__init__(self)
         self.workers_count = workers
         self.workers = []
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.dead_letters = dead_letters
+        self.spill = spill
+        self.failures = Counter()
+        self.closed = False
+        self._stopped = False
+        self._failures_lock = Lock()
+        self._retries = {}
+        self._running = {}
+
+    def _init(self, maxsize):
+        # one fifo lane per job class, served by smooth weighted round robin
+        self.lanes = dict((job_class, deque()) for job_class in self.weights)
+        self.credits = dict((job_class, 0) for job_class in self.weights)
+
+    def _qsize(self):
+        return sum(len(lane) for lane in self.lanes.values())
+
+    def _put(self, item):
+        job_class, task = item
+        self.lanes[job_class].append(task)
 
-    def add_task(self, task, *args, **kwargs):
+    def _get(self):
+        total, chosen = 0, None
+        for job_class, lane in self.lanes.items():
+            # idle lanes do not bank credits for later
+            if not lane:
+                self.credits[job_class] = 0
+                continue
+
+            self.credits[job_class] += self.weights[job_class]
+            total += self.weights[job_class]
+            if chosen is None or self.credits[job_class] > self.credits[chosen]:
+                chosen = job_class
+
+        self.credits[chosen] -= total
+        return self.lanes[chosen].popleft()
+
+    def add_task(self, task, *args, job_class=FAN_OUT, **kwargs):
         """
         add a new task to the queue
         :param task: callable task
         :param args: task args
+        :param job_class: scheduling class of the task
         :param kwargs: task kwargs
         :return: True on success
         """
-        self.put((task, args or (), kwargs or {}))
+        if job_class not in self.lanes:
+            raise Exception('invalid job class')
+
+        if self.closed:
+            raise QueueClosed('task queue is shutting down')
+
+        self.put((job_class, (task, args or (), kwargs or {}, job_class, 1)))
         return True
 
+    @staticmethod
+    def job_name(task):
+        """
+        name of a task's job type, e.g. Flat.add_event
+        :param task: callable task
+        :return: job name
+        """
+        return getattr(task, '__qualname__', type(task).__name__)
+
+    @classmethod
+    def serialize(cls, task, args, kwargs, job_class, attempt):
+        """
+        serialize a task to store it, bound event methods are
+        stored by their event's name to be replayed
+        :return: json serializable dict
+        """
+        target = getattr(getattr(task, '__self__', None), 'name', None)
+        return {
+            'job': cls.job_name(task),
+            'target': target if isinstance(target, str) else None,
+            'method': getattr(task, '__name__', None),
+            'args': json.loads(json.dumps(args, default=repr)),
+            'kwargs': json.loads(json.dumps(kwargs, default=repr)),
+            'job_class': job_class,
+            'attempts': attempt
+        }
+
+    def _retry(self, key):
+        """
+        put a failed task back in its lane, the failed attempt stays
+        unfinished until the retry is done so join keeps waiting
+        :param key: key of the delayed retry
+        """
+        with self.not_empty:
+            # retries collected by a shutdown are already persisted
+            retry = self._retries.pop(key, None)
+            if retry is None:
+                return
+
+            item = retry[1]
+            self._put((item[3], item))
+            self.not_empty.notify()
+
+    def dead_letter(self, task, args, kwargs, job_class, attempt, error):
+        """
+        store a task that ran out of attempts, or can never succeed,
+        to inspect and replay it later
+        """
+        if self.dead_letters is None:
+            return
+
+        letter = self.serialize(task, args, kwargs, job_class, attempt)
+        letter.update(error=repr(error), failed_at=time())
+        self.dead_letters.set(uuid4().hex, letter)
+
+    def _failed(self, task, args, kwargs, job_class, attempt, error):
+        """
+        account a failed attempt and retry with exponential backoff,
+        or dead letter the task once it is out of attempts
+        """
+        with self._failures_lock:
+            self.failures[self.job_name(task)] += 1
+
+        if attempt < self.max_attempts:
+            item = (task, args, kwargs, job_class, attempt + 1)
+            with self.mutex:
+                stopped = self._stopped
+                if not stopped:
+                    key = uuid4().hex
+                    delay = min(self.backoff * 2 ** (attempt - 1), self.max_backoff)
+                    retry = Timer(delay * (0.5 + random() / 2), self._retry, (key,))
+                    retry.daemon = True
+                    self._retries[key] = (retry, item)
+                    retry.start()
+
+            if not stopped:
+                return
+
+            # the queue was shut down while the task ran
+            if self.spill is not None:
+                self._spill([item])
+                self.task_done()
+            return
+
+        try:
+            self.dead_letter(task, args, kwargs, job_class, attempt, error)
+        finally:
+            self.task_done()
+
+    def _spill(self, items, interrupted=0):
+        """
+        persist tasks to the spill store, keyed by the time and their
+        position so they are replayed in the order they were taken
+        :param items: tasks in order
+        :param interrupted: number of leading tasks that were still
+            running, they may have completed and run again when replayed
+        """
+        spilled_at = f"{time():017.6f}"
+        for index, item in enumerate(items):
+            job = self.serialize(*item)
+            job.update(interrupted=index < interrupted)
+            self.spill.set(f"{spilled_at}:{index:06d}:{uuid4().hex[:8]}", job)
+
     def start_workers(self):
         """
         start workers in the background
         :return: number of workers
         """
         for _ in range(self.workers_count):
-            worker = Thread(target=self.worker)
+            worker = Thread(target=self.worker, daemon=True)
             self.workers.append(worker)
             worker.start()
 
@@ -40,12 +213,71 @@ class TaskQueue(Queue):
         """
         worker's task
         """
-        while True:
-            task, args, kwargs = self.get(block=True)
+        while not self._stopped:
+            try:
+                item = self.get(block=True, timeout=0.1)
+            except Empty:
+                continue
+
+            task, args, kwargs, job_class, attempt = item
+            with self.mutex:
+                self._running[get_ident()] = item
+
+            error = None
             try:
                 task(*args, **kwargs)
-                self.task_done()
             except Exception as e:
-                print(e)
+                error = e
+                print(f"{self.job_name(task)} failed, attempt {attempt}: {e!r}")
                 # todo implement logging
-                pass
+
+            # tasks outliving a shutdown's deadline were already persisted
+            with self.mutex:
+                if self._running.pop(get_ident(), None) is None:
+                    continue
+
+            if error is not None:
+                self._failed(task, args, kwargs, job_class, attempt, error)
+            else:
+                self.task_done()
+
+    def shutdown(self, timeout=10.0):
+        """
+        refuse new tasks and drain the queued ones up to a deadline,
+        tasks still left are persisted to the spill store to be
+        replayed by the next process. running tasks are not waited
+        for, they are persisted too and replayed at least once
+        :param timeout: seconds to drain the queue
+        :return: number of tasks left over
+        """
+        self.closed = True
+        deadline = monotonic() + timeout
+        with self.all_tasks_done:
+            while self.unfinished_tasks and monotonic() < deadline:
+                self.all_tasks_done.wait(deadline - monotonic())
+
+        # stop taking tasks, then collect them in the order they were
+        # taken: the tasks that are still running, the delayed retries
+        # and the queued ones
+        with self.mutex:
+            self._stopped = True
+            running = list(self._running.values())
+            self._running.clear()
+            leftovers = list(running)
+            for retry, item in self._retries.values():
+                retry.cancel()
+                leftovers.append(item)
+            self._retries.clear()
+            leftovers.extend(task for lane in self.lanes.values() for task in lane)
+            for lane in self.lanes.values():
+                lane.clear()
+
+        if leftovers and self.spill is not None:
+            self._spill(leftovers, len(running))
+
+            # persisted tasks no longer hold the queue back
+            with self.all_tasks_done:
+                self.unfinished_tasks = max(self.unfinished_tasks - len(leftovers), 0)
+                self.all_tasks_done.notify_all()
+
+        return len(leftovers)
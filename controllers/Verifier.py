@@ -0,0 +1,112 @@
+import logging
+from threading import Lock, Thread
+from time import sleep, time
+from utils import redis
+
+
+logger = logging.getLogger(__name__)
+
+
+class Verifier:
+
+    def __init__(self, events, rate=10.0, batch=100, interval=60.0, repair=True):
+        """
+        background checker of the cached timelines, walks them
+        incrementally, compares them with the database and repairs drift
+        :param events: registered events
+        :param rate: max timelines checked per second, each one is a query
+        :param batch: timelines checked per event on every pass
+        :param interval: seconds between passes
+        :param repair: fix the drifted timelines
+        """
+        self._events = events
+        self._rate = rate
+        self._batch = batch
+        self._interval = interval
+        self._repair = repair
+        self._cursors = {}
+        self._overflow = {}
+        self._lock = Lock()
+        self._metrics = {}
+        self._stopped = False
+
+    @property
+    def metrics(self):
+        """drift metrics per event since the start"""
+        with self._lock:
+            return dict((name, dict(metrics)) for name, metrics in self._metrics.items())
+
+    def _record(self, event, **counts):
+        """ add to an event's metrics """
+        with self._lock:
+            metrics = self._metrics.setdefault(event.name, {
+                'checked': 0, 'drifted': 0, 'missing': 0, 'extra': 0,
+                'errors': 0, 'passes': 0, 'last_pass': None})
+            for key, count in counts.items():
+                metrics[key] += count
+            metrics['last_pass'] = time()
+
+    def _sample(self, event):
+        """
+        next consumers whose timeline is cached, continues the
+        previous scan so every timeline is eventually checked
+        :param event: event handler
+        :return: list of consumer ids
+        """
+        prefix, suffix = 'fs:', f":{event.name}"
+        cursor = self._cursors.get(event.name, 0)
+
+        consumers = self._overflow.pop(event.name, [])
+        while len(consumers) < self._batch:
+            cursor, keys = redis.scan(cursor, match=f"{prefix}*{suffix}", count=self._batch)
+            consumers.extend(key.decode()[len(prefix):-len(suffix)] for key in keys)
+            if not cursor:
+                self._record(event, passes=1)
+                break
+
+        # the cursor is past the keys scanned beyond the batch, they are kept for the next call
+        self._cursors[event.name] = cursor
+        self._overflow[event.name] = consumers[self._batch:]
+        return consumers[:self._batch]
+
+    def run_once(self):
+        """
+        check a batch of timelines of every event
+        :return: number of checked timelines
+        """
+        checked = 0
+        for event in self._events:
+            for consumer_id in self._sample(event):
+                if self._stopped:
+                    return checked
+
+                try:
+                    drift = event.verify(consumer_id, repair=self._repair)
+                except Exception:
+                    logger.exception('verifying %s of %s failed', consumer_id, event.name)
+                    self._record(event, errors=1)
+                    continue
+
+                self._record(event, checked=1, drifted=int(any(drift.values())), **drift)
+                checked += 1
+                sleep(1 / self._rate)
+
+        return checked
+
+    def start(self):
+        """
+        run the verifier in the background
+        :return: verifier thread
+        """
+        def loop():
+            while not self._stopped:
+                self.run_once()
+                sleep(self._interval)
+
+        thread = Thread(target=loop, daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        """ stop after the timeline being checked """
+        self._stopped = True
@@ -1,3 +1,4 @@
-from .EventController import Flat, Activity
+from .EventController import Flat, Activity, hot_score
 from .EventProcessor import EventProcessor
-from .TaskQueue import TaskQueue
\ No newline at end of file
+from .TaskQueue import TaskQueue, QueueClosed
+from .Verifier import Verifier
\ No newline at end of file
@@ -2,12 +2,13 @@
 
 Usage:
     main.py
-    main.py [--h=<host>] [--p=<port] [--w=workers]
+    main.py [--h=<host>] [--p=<port] [--w=workers] [--warm]
 
 Options:
     --h=<str>  Host [default: 0.0.0.0]
     --p=<Int>  Port [default: 1234]
     --w=<Int>  Workers [default: 1]
+    --warm     Keep cached timelines from the last clean shutdown
 
 """
 
@@ -19,6 +20,6 @@ if __name__ == '__main__':
 
     docs = docopt(__doc__)
 
-    (setup_web_server(workers=int(docs['--w']))
+    (setup_web_server(workers=int(docs['--w']), warm_start=docs['--warm'])
         .run(host=docs['--h'], port=int(docs['--p']), debug=True))
 
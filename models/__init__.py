@@ -1,5 +1,7 @@
 from peewee import *
 from utils import db
+import json
+import zlib
 
 
 class BaseModel(Model):
@@ -16,6 +18,7 @@ class Relation(BaseModel):
     class Meta:
         indexes = (
             (('consumer_id', 'producer_id'), True),
+            (('producer_id',), False),
         )
 
 
@@ -30,6 +33,8 @@ class FlatEvent(BaseModel):
     class Meta:
         indexes = (
             (('producer_id', 'item_id', 'verb'), True),
+            (('producer_id', 'timestamp'), False),
+            (('timestamp',), False),
         )
 
     def make_json(self):
@@ -53,6 +58,8 @@ class ActivityEvent(BaseModel):
     class Meta:
         indexes = (
             (('producer_id', 'item_id', 'verb', 'consumer_id'), True),
+            (('consumer_id', 'timestamp'), False),
+            (('timestamp',), False),
         )
 
     def make_json(self):
@@ -64,3 +71,88 @@ class ActivityEvent(BaseModel):
             "item_id": self.item_id
         }
 
+
+class EventArchive(BaseModel):
+    """ cold storage for events older than the retention horizon """
+
+    dataset = TextField()
+    producer_id = TextField()
+    bucket = IntegerField()
+    count = IntegerField()
+    payload = BlobField()
+
+    class Meta:
+        indexes = (
+            (('dataset', 'producer_id', 'bucket'), False),
+        )
+
+    @classmethod
+    def archive(cls, dataset, cutoff, bucket_size=86400, batch_size=5000):
+        """
+        move events older than cutoff from the hot dataset into the archive.
+        events are grouped by producer and time bucket, and every group is
+        stored as a single zlib compressed row.
+        :param dataset: event dataset (FlatEvent or ActivityEvent subclass)
+        :param cutoff: events with a timestamp before this are archived
+        :param bucket_size: size of each archive partition in seconds
+        :param batch_size: number of events moved per transaction
+        :return: number of archived events
+        """
+        archived = 0
+        while True:
+            with cls._meta.database.atomic():
+                rows = list(dataset
+                            .select()
+                            .where(dataset.timestamp < cutoff)
+                            .order_by(dataset.id)
+                            .limit(batch_size))
+                if not rows:
+                    break
+
+                buckets = {}
+                for row in rows:
+                    bucket = int(row.timestamp) // bucket_size * bucket_size
+                    buckets.setdefault((row.producer_id, bucket), []).append(row.make_json())
+
+                partitions = [{
+                    'dataset': dataset._meta.table_name,
+                    'producer_id': producer_id,
+                    'bucket': bucket,
+                    'count': len(items),
+                    'payload': zlib.compress(json.dumps(items).encode())
+                } for (producer_id, bucket), items in buckets.items()]
+
+                for chunk in chunked(partitions, 100):
+                    cls.insert_many(chunk).execute()
+
+                for chunk in chunked([row.id for row in rows], 1000):
+                    dataset.delete().where(dataset.id << chunk).execute()
+
+                archived += len(rows)
+
+        return archived
+
+    @classmethod
+    def restore(cls, dataset, producer_id, since=None, until=None):
+        """
+        read archived events of a producer back from cold storage
+        :param dataset: event dataset the events were archived from
+        :param producer_id: producer's id
+        :param since: only events at or after this timestamp
+        :param until: only events before this timestamp
+        :return: generator of event json payloads
+        """
+        query = (cls
+                 .select()
+                 .where(
+                    (cls.dataset == dataset._meta.table_name) &
+                    (cls.producer_id == producer_id))
+                 .order_by(cls.bucket))
+
+        for partition in query:
+            for item in json.loads(zlib.decompress(partition.payload)):
+                if since is not None and item['timestamp'] < since:
+                    continue
+                if until is not None and item['timestamp'] >= until:
+                    continue
+                yield item
@@ -1,41 +1,162 @@
 from sanic import Blueprint, response
 from sanic.exceptions import abort
-from schema import Schema, Optional
-from controllers import EventProcessor
+from controllers import EventProcessor, QueueClosed
+from utils.Validator import Validator, Optional
+import ujson
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 
 mod = Blueprint('routes', version=1)
 
+# compact binary encoding of pages, negotiated with the accept header
+MSGPACK = 'application/msgpack'
+
 
-publish_schema = Schema({
+publish_schema = Validator({
     'verb': str, 'producer_id': str, 'item_id': str, 'timestamp': float, Optional('consumer_id'): str
 })
 
-retract_schema = Schema({
+retract_schema = Validator({
     'verb': str, 'producer_id': str, 'item_id': str, Optional('consumer_id'): str
 })
 
-consume_schema = Schema({
-    'event_name': str, 'consumer_id': str, Optional('before'): str, Optional('after'): str, Optional('limit'): str
+consume_schema = Validator({
+    'event_name': str, 'consumer_id': str, Optional('before'): str, Optional('after'): str, Optional('limit'): str,
+    Optional('ranked'): str, Optional('since'): str, Optional('until'): str,
+    Optional('since_id'): str, Optional('until_id'): str
+})
+
+consume_many_schema = Validator({
+    'consumer_id': str,
+    'events': {str: {Optional('before'): str, Optional('after'): str, Optional('limit'): int}}
+})
+
+consume_batch_schema = Validator({
+    'event_name': str, 'consumer_ids': [str], Optional('limit'): int
+})
+
+mark_seen_schema = Validator({
+    'event_name': str, 'consumer_id': str, Optional('item_id'): str, Optional('timestamp'): float
+})
+
+unread_schema = Validator({
+    'event_name': str, 'consumer_id': str
+})
+
+rescore_schema = Validator({
+    'event_name': str, 'producer_id': str, 'item_id': str, 'engagement': float
 })
 
-subscribe_schema = Schema({
+dead_letter_schema = Validator({
+    'letter_id': str
+})
+
+subscribe_schema = Validator({
     'consumer_id': str, 'producer_id': str, 'event_name': str
 })
 
-unsubscribe_schema = Schema({
+subscribe_many_schema = Validator({
+    'consumer_id': str, 'producer_ids': [str], 'event_name': str
+})
+
+unsubscribe_schema = Validator({
     'consumer_id': str, 'producer_id': str, 'event_name': str
 })
 
 
+def json_body(request, validator):
+    """
+    parse the raw request body and validate it, aborts when invalid
+    :param request: request
+    :param validator: validator of the body
+    :return: parsed body
+    """
+    try:
+        if msgpack is not None and request.headers.get('content-type', '').startswith(MSGPACK):
+            body = msgpack.unpackb(request.body, raw=False)
+        else:
+            body = ujson.loads(request.body)
+    except Exception:
+        body = None
+
+    if not validator.is_valid(body):
+        abort(400, message='invalid request body')
+    return body
+
+
+def query_args(request, validator):
+    """
+    read the first value of every query argument and validate them, aborts when invalid
+    :param request: request
+    :param validator: validator of the arguments
+    :return: { name: value }
+    """
+    args = dict((name, values[0]) for name, values in request.args.items())
+    if not validator.is_valid(args):
+        abort(400, message='invalid request body')
+    return args
+
+
+def json_rows(rows, **fields):
+    """
+    serialize a response with rows written straight from a query
+    :param rows: iterable of json serializable rows
+    :param fields: other fields of the response
+    :return: json response
+    """
+    # the rows are written between the brackets of an empty data list
+    head = ujson.dumps(dict(fields, data=[]))[:-2]
+    return response.HTTPResponse(head + ','.join(map(ujson.dumps, rows)) + ']}',
+                                 content_type='application/json')
+
+
+def wants_msgpack(request):
+    """
+    whether the client accepts msgpack responses
+    :param request: request
+    :return: bool
+    """
+    return msgpack is not None and MSGPACK in request.headers.get('accept', '')
+
+
+def columns(rows):
+    """
+    columnar form of a page, the field names are sent once
+    :param rows: iterable of rows with the same fields
+    :return: { 'fields': [names], 'values': [[row values]] }
+    """
+    rows = list(rows)
+    fields = list(rows[0]) if rows else []
+    return {'fields': fields, 'values': [[row[field] for field in fields] for row in rows]}
+
+
+def msgpack_response(body):
+    """
+    serialize a response with msgpack
+    :param body: response body
+    :return: msgpack response
+    """
+    return response.raw(msgpack.packb(body, use_bin_type=True), content_type=MSGPACK)
+
+
+@mod.exception(QueueClosed)
+def queue_closed(request, exception):
+    """ the server is shutting down, clients should retry on another node """
+
+    return response.json({'ok': False, 'message': str(exception)}, status=503)
+
+
 @mod.post('/publish')
 def publish(request):
     """ publish an event """
 
-    if not publish_schema.is_valid(request.json):
-        return abort(400, message='invalid request body')
+    body = json_body(request, publish_schema)
 
-    status = EventProcessor.add_event(request.json)
+    status = EventProcessor.add_event(body)
     return response.json({'ok': True, 'published': status})
 
 
@@ -43,25 +164,53 @@ def publish(request):
 def retract(request):
     """ retract an event """
 
-    if not retract_schema.is_valid(request.json):
-        return abort(400, message='invalid request body')
+    body = json_body(request, retract_schema)
 
-    status = EventProcessor.retract_event(request.json)
+    status = EventProcessor.retract_event(body)
     return response.json({'ok': True, 'retracted': status})
 
 
+@mod.post('/rescore')
+def rescore(request):
+    """ update an item's engagement and ranking score """
+
+    body = json_body(request, rescore_schema)
+
+    status = EventProcessor.rescore(
+        event_name=body['event_name'],
+        producer_id=body['producer_id'],
+        item_id=body['item_id'],
+        engagement=body['engagement']
+    )
+
+    return response.json({'ok': True, 'rescored': status})
+
+
 @mod.post('/subscribe')
 def subscribe(request):
     """ subscribe to a publisher """
 
-    print(request.json)
-    if not subscribe_schema.is_valid(request.json):
-        abort(400, message='invalid request body')
+    body = json_body(request, subscribe_schema)
 
     status = EventProcessor.subscribe(
-        event_name=request.json['event_name'],
-        consumer_id=request.json['consumer_id'],
-        producer_id=request.json['producer_id']
+        event_name=body['event_name'],
+        consumer_id=body['consumer_id'],
+        producer_id=body['producer_id']
+    )
+
+    return response.json({'ok': True, 'subscribed': status})
+
+
+@mod.post('/subscribe/batch')
+def subscribe_many(request):
+    """ subscribe to many publishers at once """
+
+    body = json_body(request, subscribe_many_schema)
+
+    status = EventProcessor.subscribe_many(
+        event_name=body['event_name'],
+        consumer_id=body['consumer_id'],
+        producer_ids=body['producer_ids']
     )
 
     return response.json({'ok': True, 'subscribed': status})
@@ -71,13 +220,12 @@ def subscribe(request):
 def unsubscribe(request):
     """ unsubscribe from a publisher """
 
-    if not unsubscribe_schema.is_valid(request.json):
-        abort(400, message='invalid request body')
+    body = json_body(request, unsubscribe_schema)
 
     status = EventProcessor.unsubscribe(
-        event_name=request.json['event_name'],
-        consumer_id=request.json['consumer_id'],
-        producer_id=request.json['producer_id']
+        event_name=body['event_name'],
+        consumer_id=body['consumer_id'],
+        producer_id=body['producer_id']
     )
 
     return response.json({'ok': True, 'unsubscribed': status})
@@ -87,20 +235,160 @@ def unsubscribe(request):
 def consume(request):
     """ consume a feed by user """
 
-    if not consume_schema.is_valid(request.raw_args):
-        abort(400, message='invalid request body')
-
-    after = request.raw_args.get('after', None)
-    before = request.raw_args.get('before', None)
-    limit = int(request.raw_args.get('limit', 20))
-    event_name = request.raw_args.get('event_name')
-    consumer_id = request.raw_args.get('consumer_id')
+    args = query_args(request, consume_schema)
+
+    after = args.get('after', None)
+    before = args.get('before', None)
+    limit = int(args.get('limit', 20))
+    event_name = args.get('event_name')
+    consumer_id = args.get('consumer_id')
+    ranked = args.get('ranked', 'false').lower() == 'true'
+    since_id = args.get('since_id', None)
+    until_id = args.get('until_id', None)
+
+    try:
+        since = args.get('since', None)
+        since = float(since) if since is not None else None
+        until = args.get('until', None)
+        until = float(until) if until is not None else None
+    except ValueError:
+        abort(400, message='since and until must be timestamps')
 
     if after and before:
         abort(400, message='cant use after and before at once')
 
+    if (after or before) and (since is not None or until is not None):
+        abort(400, message='cant use item and timestamp bounds at once')
+
     resp = EventProcessor.consume(event_name=event_name, limit=limit,
                                   after=after, before=before,
-                                  consumer_id=consumer_id)
+                                  consumer_id=consumer_id, ranked=ranked,
+                                  since=since, until=until,
+                                  since_id=since_id, until_id=until_id)
+
+    if wants_msgpack(request):
+        return msgpack_response({'ok': True, 'data': columns(resp)})
+    return json_rows(resp, ok=True)
+
+
+@mod.post('/consume/multi')
+def consume_many(request):
+    """ consume several feeds by user at once """
+
+    body = json_body(request, consume_many_schema)
+
+    for page in body['events'].values():
+        if 'after' in page and 'before' in page:
+            abort(400, message='cant use after and before at once')
+
+    resp = EventProcessor.consume_many(consumer_id=body['consumer_id'],
+                                       events=body['events'])
+
+    if wants_msgpack(request):
+        return msgpack_response({'ok': True, 'data': dict((event_name, columns(rows))
+                                                          for event_name, rows in resp.items())})
+    return response.json({'ok': True, 'data': resp})
+
+
+@mod.post('/consume/batch')
+def consume_batch(request):
+    """ consume a feed for many users, streamed one user per line or msgpack object """
+
+    body = json_body(request, consume_batch_schema)
+
+    if body['event_name'] not in EventProcessor.event_by_name:
+        abort(400, message='event does not exist')
+
+    pages = EventProcessor.consume_batch(event_name=body['event_name'],
+                                         consumer_ids=body['consumer_ids'],
+                                         limit=body.get('limit', 20))
+
+    if wants_msgpack(request):
+        async def stream_packed(resp):
+            for chunk in pages:
+                await resp.write(b''.join(msgpack.packb({'consumer_id': consumer_id, 'data': columns(data)},
+                                                        use_bin_type=True)
+                                          for consumer_id, data in chunk.items()))
+
+        return response.stream(stream_packed, content_type=MSGPACK)
+
+    async def stream_pages(resp):
+        for chunk in pages:
+            await resp.write(''.join(ujson.dumps({'consumer_id': consumer_id, 'data': data}) + '\n'
+                                     for consumer_id, data in chunk.items()))
+
+    return response.stream(stream_pages, content_type='application/x-ndjson')
+
+
+@mod.post('/mark_seen')
+def mark_seen(request):
+    """ mark a feed as seen by user """
+
+    body = json_body(request, mark_seen_schema)
+
+    if 'item_id' in body and 'timestamp' in body:
+        abort(400, message='cant use item_id and timestamp at once')
+
+    status = EventProcessor.mark_seen(
+        event_name=body['event_name'],
+        consumer_id=body['consumer_id'],
+        item_id=body.get('item_id'),
+        timestamp=body.get('timestamp')
+    )
+
+    return response.json({'ok': True, 'seen': status})
+
+
+@mod.get('/unread')
+def unread(request):
+    """ count unseen items of a feed by user """
+
+    args = query_args(request, unread_schema)
+
+    count = EventProcessor.unread_count(event_name=args['event_name'],
+                                        consumer_id=args['consumer_id'])
+
+    return response.json({'ok': True, 'unread': count})
+
+
+@mod.get('/dead_letters')
+def dead_letters(request):
+    """ inspect failed jobs and failure counts per job type """
+
+    return response.json({'ok': True, 'data': EventProcessor.dead_letters(),
+                          'failures': EventProcessor.failures()})
+
+
+@mod.post('/dead_letters/replay')
+def replay_dead_letter(request):
+    """ queue a failed job again """
+
+    body = json_body(request, dead_letter_schema)
+
+    try:
+        status = EventProcessor.replay_dead_letter(body['letter_id'])
+    except Exception as e:
+        abort(404, message=str(e))
+
+    return response.json({'ok': True, 'replayed': status})
+
+
+@mod.post('/dead_letters/discard')
+def discard_dead_letter(request):
+    """ drop a failed job """
+
+    body = json_body(request, dead_letter_schema)
+
+    try:
+        status = EventProcessor.discard_dead_letter(body['letter_id'])
+    except Exception as e:
+        abort(404, message=str(e))
+
+    return response.json({'ok': True, 'discarded': status})
+
+
+@mod.get('/drift')
+def drift(request):
+    """ drift metrics of the cached timelines """
 
-    return response.json({'ok': True, 'data': list(resp)})
+    return response.json({'ok': True, 'data': EventProcessor.drift()})
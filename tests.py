@@ -2,9 +2,23 @@ from app import setup_database, setup_workers, setup_system, db, BaseModel
 from controllers import *
 from time import time, sleep
 from random import choice, sample, randint
-from utils import redis
+from utils import redis, Orange, create_database
 import unittest
 from uuid import uuid4
+from threading import Thread
+from utils.IngestLog import IngestLog
+from utils.Coordinator import Coordinator
+from utils.MemoryStore import MemoryStore
+from utils.GraphIndex import GraphIndex
+from utils.Validator import Validator, Optional
+from models import EventArchive
+from routes import columns
+from api_wrapper import _rows, AsyncMultiEventStream, BaseEventStream, EndpointPool
+import asyncio
+import json
+import msgpack
+import os
+import tempfile
 
 item_id = 0
 
@@ -59,6 +73,33 @@ class TestSubscribe(unittest.TestCase):
         for user in self.users:
             self.assertRaises(Exception, EventProcessor.unsubscribe, "invalid_event", user, "publisher_id")
 
+    def test_retried_subscribe(self):
+
+        publisher, user = create_users(2)
+        for _ in range(3):
+            EventProcessor.add_event(create_event('podcast', publisher))
+
+        sleep(1)
+
+        feed = EventProcessor.event_by_name['feed']
+        backfill, failures = feed._add_from_producer_to_consumer, []
+
+        def flaky_backfill(**kwargs):
+            if not failures:
+                failures.append(kwargs)
+                raise ConnectionError('redis went away')
+            return backfill(**kwargs)
+
+        # the retry finds the follow already stored and still backfills the timeline
+        feed._add_from_producer_to_consumer = flaky_backfill
+        try:
+            self.assertRaises(ConnectionError, feed.subscribe, user, publisher)
+            self.assertTrue(feed.subscribe(user, publisher))
+        finally:
+            del feed._add_from_producer_to_consumer
+
+        self.assertEqual(len(list(EventProcessor.consume('feed', user))), 3)
+
 
 class TestPublish(unittest.TestCase):
 
@@ -128,6 +169,742 @@ class TestPublish(unittest.TestCase):
             self.assertTrue(int(event['item_id']) in self.event_ids)
 
 
+class TestSubscribeMany(unittest.TestCase):
+
+    publishers = create_users(3)
+    user = create_users(1)[0]
+
+    def test_subscribe_many(self):
+
+        events = []
+        for publisher in self.publishers:
+            for _ in range(3):
+                event = create_event('podcast', publisher)
+                events.append(event)
+                EventProcessor.add_event(event)
+
+        sleep(1)
+
+        self.assertTrue(EventProcessor.subscribe_many('feed', self.user, self.publishers))
+        self.assertRaises(Exception, EventProcessor.subscribe_many, 'invalid_event', self.user, self.publishers)
+
+        sleep(1)
+
+        items = list(EventProcessor.consume('feed', self.user))
+        self.assertEqual(len(items), len(events))
+        for item in items:
+            self.assertTrue(int(item['item_id']) in list(map(lambda x: x['item_id'], events)))
+
+
+class TestConsumeMany(unittest.TestCase):
+
+    publisher = "publisher_id_multi"
+    user = create_users(1)[0]
+
+    def test_consume_many(self):
+
+        EventProcessor.subscribe('feed', self.user, self.publisher)
+
+        podcasts = [create_event('podcast', self.publisher) for _ in range(3)]
+        likes = [create_event('like', self.publisher, consumer_id=self.user) for _ in range(2)]
+        for event in podcasts + likes:
+            EventProcessor.add_event(event)
+
+        sleep(1)
+
+        data = EventProcessor.consume_many(self.user, {'feed': {'limit': 2}, 'notification': {'limit': 5}})
+        self.assertEqual(len(data['feed']), 2)
+        self.assertEqual(len(data['notification']), len(likes))
+        for item in data['feed']:
+            self.assertTrue(int(item['item_id']) in list(map(lambda x: x['item_id'], podcasts)))
+
+        self.assertRaises(Exception, EventProcessor.consume_many, self.user, {'invalid_event': {}})
+
+    def test_consume_batch(self):
+
+        publisher, users = "publisher_id_batch", create_users(3)
+        for user in users:
+            EventProcessor.subscribe('feed', user, publisher)
+        for _ in range(3):
+            EventProcessor.add_event(create_event('podcast', publisher))
+
+        sleep(1)
+
+        pages = {}
+        for chunk in EventProcessor.consume_batch('feed', users, limit=2, chunk_size=2):
+            pages.update(chunk)
+
+        self.assertEqual(set(pages), set(users))
+        for user in users:
+            self.assertEqual(len(pages[user]), 2)
+
+
+class TestUnread(unittest.TestCase):
+
+    publisher = "publisher_id_unread"
+    user = create_users(1)[0]
+
+    def test_unread_count(self):
+
+        events = [create_event('like', self.publisher, consumer_id=self.user) for _ in range(4)]
+        for event in events:
+            EventProcessor.add_event(event)
+
+        sleep(1)
+
+        self.assertEqual(EventProcessor.unread_count('notification', self.user), len(events))
+
+        newest = list(EventProcessor.consume('notification', self.user, limit=2))
+        self.assertTrue(EventProcessor.mark_seen('notification', self.user, item_id=newest[-1]['item_id']))
+        self.assertEqual(EventProcessor.unread_count('notification', self.user), 1)
+
+        self.assertTrue(EventProcessor.mark_seen('notification', self.user))
+        self.assertEqual(EventProcessor.unread_count('notification', self.user), 0)
+
+
+class TestRanked(unittest.TestCase):
+
+    publisher = "publisher_id_ranked"
+    user = create_users(1)[0]
+
+    def test_rescore(self):
+
+        self.assertTrue(EventProcessor.subscribe('feed', self.user, self.publisher))
+        events = [create_event('podcast', self.publisher) for _ in range(3)]
+        for event in events:
+            EventProcessor.add_event(event)
+
+        sleep(1)
+
+        ranked = list(EventProcessor.consume('feed', self.user, limit=3, ranked=True))
+        self.assertEqual(len(ranked), len(events))
+
+        oldest = min(events, key=lambda x: x['timestamp'])
+        self.assertTrue(EventProcessor.rescore('feed', self.publisher, oldest['item_id'], 10 ** 6))
+
+        sleep(1)
+
+        ranked = list(EventProcessor.consume('feed', self.user, limit=3, ranked=True))
+        self.assertEqual(int(ranked[0]['item_id']), oldest['item_id'])
+        self.assertRaises(Exception, EventProcessor.consume, 'notification', self.user, ranked=True)
+
+
+class TestConsumeRange(unittest.TestCase):
+
+    publisher = "publisher_id_range"
+    user = create_users(1)[0]
+
+    def test_since_until(self):
+
+        self.assertTrue(EventProcessor.subscribe('feed', self.user, self.publisher))
+        events = [create_event('podcast', self.publisher) for _ in range(5)]
+        for n, event in enumerate(events):
+            # fractional timestamps a second apart, they are stored as whole seconds
+            event['timestamp'] = int(time()) - 100 + n + 0.6
+            EventProcessor.add_event(event)
+
+        sleep(1)
+
+        newer = list(EventProcessor.consume('feed', self.user, since=events[1]['timestamp']))
+        self.assertEqual([int(x['item_id']) for x in newer], [x['item_id'] for x in events[:1:-1]])
+
+        older = list(EventProcessor.consume('feed', self.user, until=events[1]['timestamp']))
+        self.assertEqual([int(x['item_id']) for x in older], [events[0]['item_id']])
+
+        self.assertRaises(Exception, EventProcessor.consume, 'feed', self.user,
+                          since=events[0]['timestamp'], after=str(events[0]['item_id']))
+
+
+class TestTombstones(unittest.TestCase):
+
+    publisher = "publisher_id_tombstones"
+    user = create_users(1)[0]
+
+    def test_lazy_retract(self):
+
+        self.assertTrue(EventProcessor.subscribe('feed', self.user, self.publisher))
+        events = [create_event('podcast', self.publisher) for _ in range(6)]
+        for event in events:
+            EventProcessor.add_event(event)
+
+        sleep(1)
+
+        # the retracted items are spread over the timeline so pages are refilled more than once
+        retracted, kept = events[1::2], events[0::2]
+        for event in retracted:
+            EventProcessor.retract_event(event)
+
+        sleep(1)
+
+        # retracted items are still cached but pages are filled past them
+        feed = EventProcessor.event_by_name['feed']
+        kept_ids = sorted(event['item_id'] for event in kept)
+        self.assertEqual(len(redis.zrange(feed.create_cache_name(self.user), 0, -1)), 6)
+        items = list(EventProcessor.consume('feed', self.user, limit=3))
+        self.assertEqual(sorted(int(item['item_id']) for item in items), kept_ids)
+        batch = next(EventProcessor.consume_batch('feed', [self.user], limit=3))[self.user]
+        self.assertEqual(sorted(int(item['item_id']) for item in batch), kept_ids)
+        many = EventProcessor.consume_many(self.user, {'feed': {'limit': 3}})['feed']
+        self.assertEqual(sorted(int(item['item_id']) for item in many), kept_ids)
+        self.assertEqual(EventProcessor.unread_count('feed', self.user), 3)
+
+        # with fewer unread items than tombstones the unread items are checked instead
+        seen = sorted(int(event['timestamp']) for event in events)[-2]
+        EventProcessor.mark_seen('feed', self.user, timestamp=seen)
+        self.assertEqual(EventProcessor.unread_count('feed', self.user),
+                         sum(1 for event in kept if int(event['timestamp']) > seen))
+
+        # only the followers of the retracted items' producer are swept
+        feed.sweep(batch=2)
+        self.assertEqual(len(redis.zrange(feed.create_cache_name(self.user), 0, -1)), 3)
+        self.assertFalse(redis.zrange(feed.create_tombstone_name(), 0, -1))
+        self.assertFalse(redis.hgetall(feed.create_retracted_name()))
+
+
+class TestOutbox(unittest.TestCase):
+
+    publishers = ["publisher_id_outbox_1", "publisher_id_outbox_2"]
+    user = create_users(1)[0]
+
+    def test_rebuild_from_outboxes(self):
+
+        for publisher in self.publishers:
+            EventProcessor.subscribe('feed', self.user, publisher)
+            for _ in range(3):
+                EventProcessor.add_event(create_event('podcast', publisher))
+
+        sleep(1)
+
+        feed = EventProcessor.event_by_name['feed']
+        for publisher in self.publishers:
+            self.assertEqual(len(redis.zrange(feed.create_outbox_name(publisher), 0, -1)), 3)
+
+        # a rebuilt timeline merges the outboxes and matches the database
+        redis.delete(feed.create_cache_name(self.user))
+        self.assertEqual(len(list(EventProcessor.consume('feed', self.user))), 6)
+        self.assertEqual(feed.verify(self.user, repair=False), {'missing': 0, 'extra': 0})
+
+
+class TestArchive(unittest.TestCase):
+
+    publisher = "publisher_id_archive"
+    user = create_users(1)[0]
+
+    def test_archive_and_restore(self):
+
+        EventProcessor.subscribe('feed', self.user, self.publisher)
+        for timestamp in (1000, 2000, int(time())):
+            event = create_event('podcast', self.publisher)
+            event['timestamp'] = timestamp
+            EventProcessor.add_event(event)
+
+        sleep(1)
+
+        feed = EventProcessor.event_by_name['feed']
+        self.assertEqual(EventArchive.archive(feed.dataset, cutoff=10000), 2)
+        self.assertGreaterEqual(feed.expire_timelines(10000), 2)
+        self.assertEqual(redis.zcount(feed.create_cache_name(self.user), '-inf', '+inf'), 1)
+
+        # the archived items are gone from the cached timeline instead of shortening its pages
+        self.assertEqual(len(list(EventProcessor.consume('feed', self.user))), 1)
+        restored = list(EventArchive.restore(feed.dataset, self.publisher))
+        self.assertEqual(sorted(item['timestamp'] for item in restored), [1000, 2000])
+        self.assertEqual(len(list(EventArchive.restore(feed.dataset, self.publisher, since=1500))), 1)
+
+
+class TestOrange(unittest.TestCase):
+
+    def test_journal(self):
+
+        path = os.path.join(tempfile.mkdtemp(), 'orange.json')
+        db = Orange(path, journal=True, fsync_interval=0)
+        db.lcreate('jobs')
+        for job in range(200):
+            db.lappend('jobs', {'job': job})
+        db.lpop('jobs')
+        db.ldelindex('jobs', 0)
+        db['meta'] = {'count': 198}
+
+        # appending journals the new item, not the whole list
+        with open(path + '.journal') as journal:
+            self.assertLess(max(map(len, journal)), 100)
+        self.assertEqual(Orange(path, journal=True).copy(), db.copy())
+
+        # writers go on during a compaction, and both halves are replayed
+        db.lappend('jobs', {'job': 200})
+        self.assertTrue(db._compact())
+        db.lappend('jobs', {'job': 201})
+        reloaded = Orange(path, journal=True)
+        self.assertEqual(reloaded['jobs'], db['jobs'])
+        self.assertEqual(len(reloaded['jobs']), 200)
+
+
+class TestTaskQueue(unittest.TestCase):
+
+    def test_priority_lanes(self):
+
+        queue, done = TaskQueue(), []
+        for _ in range(20):
+            queue.add_task(done.append, 'bulk', job_class='bulk')
+        queue.add_task(done.append, 'interactive', job_class='interactive')
+
+        while queue.qsize():
+            task, args, kwargs, *_ = queue.get()
+            task(*args, **kwargs)
+            queue.task_done()
+
+        self.assertEqual(done[0], 'interactive')
+        self.assertEqual(len(done), 21)
+        self.assertRaises(Exception, queue.add_task, print, job_class='invalid')
+
+
+    def test_dead_letters(self):
+
+        attempts = []
+
+        def failing(item):
+            attempts.append(item)
+            raise Exception('failed')
+
+        dead_letters = Orange(os.path.join(tempfile.mkdtemp(), 'dead_letters.json'), journal=True)
+        queue = TaskQueue(max_attempts=3, backoff=0.01, dead_letters=dead_letters)
+        Thread(target=queue.worker, daemon=True).start()
+
+        queue.add_task(failing, 'item')
+        queue.join()
+
+        self.assertEqual(len(attempts), 3)
+        self.assertEqual(queue.failures[TaskQueue.job_name(failing)], 3)
+        self.assertEqual([letter['args'] for letter in dead_letters.values()], [['item']])
+
+    def test_shutdown(self):
+
+        spill = Orange(os.path.join(tempfile.mkdtemp(), 'spilled_jobs.json'), journal=True)
+        queue = TaskQueue(spill=spill)
+        for n in range(5):
+            queue.add_task(sleep, 0.2 + n / 1000)
+        queue.start_workers()
+
+        # jobs that miss the deadline are persisted in the order they were
+        # taken, the running one first, and new ones are refused
+        left = queue.shutdown(timeout=0.1)
+        self.assertEqual(left, 5)
+        jobs = [spill[key] for key in sorted(spill.keys())]
+        self.assertEqual([job['args'] for job in jobs], [[0.2 + n / 1000] for n in range(5)])
+        self.assertEqual([job['interrupted'] for job in jobs], [True, False, False, False, False])
+        self.assertEqual(queue.unfinished_tasks, 0)
+        self.assertRaises(QueueClosed, queue.add_task, sleep, 0)
+
+
+class TestVerifier(unittest.TestCase):
+
+    publisher = "publisher_id_verifier"
+    user = create_users(1)[0]
+
+    def test_repair(self):
+
+        self.assertTrue(EventProcessor.subscribe('feed', self.user, self.publisher))
+        events = [create_event('podcast', self.publisher) for _ in range(3)]
+        for event in events:
+            EventProcessor.add_event(event)
+
+        sleep(1)
+
+        feed = EventProcessor.event_by_name['feed']
+        self.assertEqual(feed.verify(self.user), {'missing': 0, 'extra': 0})
+
+        redis.zrem(feed.create_cache_name(self.user), events[0]['item_id'])
+        redis.zadd(feed.create_cache_name(self.user), {'retracted_item': 1})
+        self.assertEqual(feed.verify(self.user), {'missing': 1, 'extra': 1})
+        self.assertEqual(feed.verify(self.user), {'missing': 0, 'extra': 0})
+
+    def test_sample(self):
+
+        feed = EventProcessor.event_by_name['feed']
+        expected = set(key.decode()[len('fs:'):-len(':feed')] for key in redis.scan_iter(match='fs:*:feed'))
+
+        # a whole pass samples every timeline, the keys scanned past a batch included
+        verifier, sampled = Verifier([feed], batch=3), set()
+        while not verifier.metrics.get('feed', {}).get('passes'):
+            sampled.update(verifier._sample(feed))
+        sampled.update(verifier._overflow.get('feed', []))
+        self.assertTrue(expected <= sampled)
+
+
+class TestCoordinator(unittest.TestCase):
+
+    def test_initialize_once(self):
+
+        prepared, rebuilt = [], []
+        nodes = [Coordinator(redis, namespace='fs_cluster_test', ttl=2.0, shards=8, poll=0.05)
+                 for _ in range(3)]
+
+        threads = [Thread(target=node.initialize,
+                          args=('epoch', lambda: prepared.append(True) or True,
+                                lambda shard, shards: rebuilt.append(shard)))
+                   for node in nodes]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(prepared), 1)
+        self.assertEqual(sorted(rebuilt), list(range(8)))
+        self.assertTrue(all(node.ready('epoch') for node in nodes))
+
+    def test_rebuild_shards(self):
+
+        publisher, user = create_users(2)
+        EventProcessor.subscribe('feed', user, publisher)
+        EventProcessor.add_event(create_event('podcast', publisher))
+
+        sleep(1)
+
+        feed = EventProcessor.event_by_name['feed']
+        redis.delete(feed.create_cache_name(user))
+
+        # the consumers are listed once for the whole initialization, not once per shard
+        consumer_ids, calls, listings = feed.consumer_ids, [], {}
+        feed.consumer_ids = lambda: calls.append(True) or consumer_ids()
+        try:
+            for shard in range(8):
+                EventProcessor.rebuild_shard(shard, 8, listings=listings)
+        finally:
+            del feed.consumer_ids
+
+        self.assertEqual(len(calls), 1)
+        self.assertFalse(any(listings.values()))
+        self.assertEqual(redis.zcount(feed.create_cache_name(user), '-inf', '+inf'), 1)
+
+
+class TestMemoryStore(unittest.TestCase):
+
+    def test_redis_parity(self):
+
+        path = os.path.join(tempfile.mkdtemp(), 'timelines.json')
+        memory, key = MemoryStore(snapshot=path, snapshot_interval=0), 'fs:memory_test'
+        redis.delete(key)
+
+        for store in (redis, memory):
+            pipe = store.pipeline()
+            pipe.zadd(key, dict((f"item_{n}", n % 7) for n in range(50)))
+            pipe.zrem(key, 'item_3', 'item_missing')
+            pipe.zremrangebyrank(key, 0, -41)
+            pipe.zadd(key, {'item_49': 100}, xx=True)
+            pipe.execute()
+
+        memory.save()
+        memory = MemoryStore(snapshot=path, snapshot_interval=0)
+        for command, args in (('zrevrange', (key, 0, -1)),
+                              ('zrevrange', (key, 3, 7)),
+                              ('zrangebyscore', (key, '-inf', '+inf', 4, 6)),
+                              ('zrevrank', (key, 'item_49')),
+                              ('zcount', (key, '(2', '+inf')),
+                              ('zrangebyscore', (key, 1, '(4')),
+                              ('zrevrangebyscore', (key, '+inf', '-inf', 5, 10))):
+            self.assertEqual(getattr(memory, command)(*args), getattr(redis, command)(*args))
+
+        redis.delete(key)
+
+    def test_scan(self):
+
+        memory = MemoryStore(snapshot_interval=0)
+        for n in range(20):
+            memory.set(f"scan_{n}", n)
+
+        # keys present for the whole iteration are returned once, deleted keys are not
+        cursor, seen = 0, []
+        while True:
+            cursor, keys = memory.scan(cursor, match='scan_1*', count=3)
+            seen += keys
+            if len(seen) == 1:
+                memory.delete('scan_19')
+                memory.set('scan_new', 0)
+            if cursor == 0:
+                break
+
+        self.assertEqual(sorted(seen), sorted(f"scan_{n}".encode() for n in [1] + list(range(10, 19))))
+        self.assertEqual(len(list(memory.scan_iter(count=7))), 20)
+        self.assertEqual(memory._scans, {})
+
+
+class TestDatabase(unittest.TestCase):
+
+    def test_engines(self):
+
+        path = os.path.join(tempfile.mkdtemp(), 'stream.db')
+        sqlite = create_database({'engine': 'sqlite', 'path': path})
+        self.assertEqual(sqlite.execute_sql('pragma journal_mode').fetchone()[0], 'wal')
+
+        # every thread sees the same in-memory database
+        memory = create_database({'engine': 'memory', 'name': 'stream_test'})
+        memory.connect()
+        memory.execute_sql('create table items (id integer)')
+        thread = Thread(target=lambda: memory.execute_sql('insert into items values (1)'))
+        thread.start()
+        thread.join()
+        self.assertEqual(memory.execute_sql('select count(*) from items').fetchone()[0], 1)
+        memory.close()
+
+
+class TestGraphIndex(unittest.TestCase):
+
+    def test_snapshot_and_deltas(self):
+
+        path = os.path.join(tempfile.mkdtemp(), 'relations.graph')
+        edges = [('consumer_%d' % n, 'producer_%d' % (n % 3)) for n in range(30)]
+        graph = GraphIndex(path, redis=redis, channel='fs_graph_test').open(lambda: edges)
+
+        # a second process receives the changes of the first one
+        other = GraphIndex(path, redis=redis, channel='fs_graph_test').open(lambda: edges)
+        self.assertEqual(sorted(other.followers('producer_1')),
+                         sorted(consumer for consumer, producer in edges if producer == 'producer_1'))
+
+        graph.remove('consumer_1', 'producer_1')
+        graph.add('consumer_1', 'producer_2')
+        sleep(0.5)
+
+        for index in (graph, other):
+            self.assertNotIn('consumer_1', index.followers('producer_1'))
+            self.assertEqual(index.followees('consumer_1'), ['producer_2'])
+
+        graph.close()
+        other.close()
+
+    def test_fold_and_reconnect(self):
+
+        path = os.path.join(tempfile.mkdtemp(), 'relations.graph')
+        edges = [('consumer_%d' % n, 'producer_%d' % (n % 3)) for n in range(30)]
+        graph = GraphIndex(path, redis=redis, channel='fs_graph_fold', fold_after=3).open(lambda: edges)
+        other = GraphIndex(path, redis=redis, channel='fs_graph_fold').open(lambda: edges)
+
+        # the overlay is folded into a new snapshot once it holds enough changes
+        for n in range(30, 33):
+            edges.append(('consumer_%d' % n, 'producer_0'))
+            graph.add('consumer_%d' % n, 'producer_0')
+        sleep(0.5)
+        self.assertEqual(len(graph), 36)
+        self.assertEqual((graph._followers_added, graph._removed), ({}, set()))
+        self.assertEqual(len(graph.followers('producer_0')), 13)
+
+        # after the listener failed, changes it may have missed are picked up from a rebuilt snapshot
+        edges.remove(('consumer_0', 'producer_0'))
+        redis.publish('fs_graph_fold', 'not a change')
+        sleep(2)
+        self.assertNotIn('consumer_0', graph.followers('producer_0'))
+
+        graph.add('consumer_0', 'producer_1')
+        sleep(0.5)
+        self.assertIn('consumer_0', other.followers('producer_1'))
+
+        graph.close()
+        other.close()
+
+
+class TestValidator(unittest.TestCase):
+
+    def test_schemas(self):
+
+        validator = Validator({
+            'consumer_id': str, Optional('limit'): int, 'producer_ids': [str],
+            'events': {str: {Optional('before'): str}}
+        })
+
+        body = {'consumer_id': 'a', 'producer_ids': ['b', 'c'], 'events': {'feed': {'before': 'd'}}}
+        self.assertTrue(validator.is_valid(body))
+        self.assertTrue(validator.is_valid(dict(body, limit=5)))
+        self.assertFalse(validator.is_valid(dict(body, limit='5')))
+        self.assertFalse(validator.is_valid(dict(body, unknown=1)))
+        self.assertFalse(validator.is_valid(dict(body, producer_ids=['b', 1])))
+        self.assertFalse(validator.is_valid(dict(body, events={})))
+        self.assertFalse(validator.is_valid({'consumer_id': 'a'}))
+        self.assertFalse(validator.is_valid(None))
+
+
+class TestWireFormat(unittest.TestCase):
+
+    def test_columnar_pages(self):
+
+        rows = [{'item_id': uuid4().hex, 'verb': choice(['podcast', 'post'])} for _ in range(50)]
+        body = {'ok': True, 'data': {'feed': columns(rows), 'empty': columns([])}}
+
+        packed = msgpack.packb(body, use_bin_type=True)
+        self.assertLess(len(packed), len(msgpack.packb({'ok': True, 'data': {'feed': rows}}, use_bin_type=True)))
+
+        decoded = msgpack.unpackb(packed, raw=False, object_hook=_rows)
+        self.assertEqual(decoded, {'ok': True, 'data': {'feed': rows, 'empty': []}})
+
+
+class TestEndpointPool(unittest.TestCase):
+
+    endpoints = ['node_1:8000', 'node_2:8000', 'node_3:8000']
+
+    def test_affinity_and_ejection(self):
+
+        pool = EndpointPool(self.endpoints, failure_threshold=2)
+        endpoint = pool.acquire('consumer')
+        pool.release(endpoint)
+        self.assertEqual(pool.acquire('consumer'), endpoint)
+        pool.release(endpoint)
+
+        # a retry leaves the failed endpoint out, unless nothing else is left
+        self.assertNotEqual(pool.acquire('consumer', exclude=[endpoint]), endpoint)
+        self.assertIn(pool.acquire('consumer', exclude=self.endpoints), self.endpoints)
+
+        for _ in range(2):
+            pool.release(pool.acquire('consumer'), failed=True)
+        for _ in range(20):
+            self.assertNotEqual(pool.acquire(), endpoint)
+
+    def test_retries(self):
+
+        class Response:
+            def __init__(self, status_code):
+                self.status_code = status_code
+
+            def close(self):
+                pass
+
+        class Session:
+            def __init__(self, statuses):
+                self.statuses, self.endpoints = list(statuses), []
+
+            def request(self, http_method, url, **kwargs):
+                self.endpoints.append(url.split('/')[2])
+                return Response(self.statuses.pop(0))
+
+        client = BaseEventStream(self.endpoints, backoff=0)
+
+        # reads move away from their affinity endpoint when it fails
+        client._session = Session([502, 502, 200])
+        self.assertEqual(client._request('GET', 'consume', affinity='consumer').status_code, 200)
+        self.assertEqual(len(set(client._session.endpoints)), 3)
+
+        # writes are only sent again when the node refused them
+        client._session = Session([502, 200])
+        self.assertEqual(client._request('POST', 'subscribe').status_code, 502)
+        client._session = Session([503, 200])
+        self.assertEqual(client._request('POST', 'subscribe').status_code, 200)
+
+
+class TestClient(unittest.TestCase):
+
+    def test_async_stream(self):
+
+        body = b''.join(json.dumps({'consumer_id': str(consumer), 'data': []}).encode() + b'\n'
+                        for consumer in range(3))
+        chunks = [body[offset:offset + 7] for offset in range(0, len(body), 7)]
+
+        class Response:
+            status_code, headers, read = 200, {'Content-Type': 'application/x-ndjson'}, 0
+
+            async def iter_content(self, chunk_size=None):
+                for chunk in chunks:
+                    self.read += 1
+                    yield chunk
+
+        class Session:
+            response = Response()
+
+            async def request(self, *args, **kwargs):
+                return self.response
+
+        client = AsyncMultiEventStream(['localhost:8000'])
+        client._session = Session()
+
+        async def consume():
+            pages, reads = [], []
+            async for consumer_id, data in client._consume_batch('feed', ['0', '1', '2']):
+                pages.append(consumer_id)
+                reads.append(client._session.response.read)
+            return pages, reads
+
+        # the first page arrives before the rest of the body is read
+        pages, reads = asyncio.new_event_loop().run_until_complete(consume())
+        self.assertEqual(pages, ['0', '1', '2'])
+        self.assertLess(reads[0], len(chunks))
+
+
+class TestIngestLog(unittest.TestCase):
+
+    def test_replay(self):
+
+        path = os.path.join(tempfile.mkdtemp(), 'ingest.log')
+        log = IngestLog(path, size=4096)
+        for n in range(100):
+            log.append({'n': n})
+            position, records = log.read()
+            self.assertEqual(records, [{'n': n}])
+            if n < 99:
+                log.checkpoint(position)
+        log.close()
+
+        # the unapplied record is replayed after a restart
+        log = IngestLog(path, size=4096)
+        self.assertEqual(log.read()[1], [{'n': 99}])
+        log.close()
+
+    def test_invalid_records(self):
+
+        publisher, consumer = create_users(2)
+        invalid = create_event('like', publisher)
+        self.assertRaises(Exception, EventProcessor.add_event, invalid)
+
+        # a record that can never be saved does not block the records after it
+        log = IngestLog(os.path.join(tempfile.mkdtemp(), 'ingest.log'), size=4096)
+        log.append({'op': 'publish', 'payload': invalid})
+        log.append({'op': 'publish', 'payload': create_event('like', publisher, consumer_id=consumer)})
+        log.start_applier(EventProcessor.apply_ingested)
+        for _ in range(50):
+            if not log.read()[1]:
+                break
+            sleep(0.1)
+
+        self.assertEqual(log.read()[1], [])
+        log.close()
+
+        sleep(1)
+        self.assertEqual(len(list(EventProcessor.consume('notification', consumer))), 1)
+
+    def test_poison_record(self):
+
+        applied, rejected = [], []
+
+        def apply(records):
+            if {'n': 1} in records:
+                raise Exception('constraint violated')
+            applied.extend(records)
+
+        # a record that keeps failing is rejected after its attempts and the log moves past it
+        log = IngestLog(os.path.join(tempfile.mkdtemp(), 'ingest.log'), size=4096)
+        for n in range(3):
+            log.append({'n': n})
+        log.start_applier(apply, interval=0.01, max_attempts=2,
+                          reject=lambda record, error: rejected.append(record))
+        for _ in range(50):
+            if not log.read()[1]:
+                break
+            sleep(0.1)
+
+        self.assertEqual(log.read()[1], [])
+        self.assertEqual(applied, [{'n': 0}, {'n': 2}])
+        self.assertEqual(rejected, [{'n': 1}])
+        log.close()
+
+    def test_shutdown(self):
+
+        log = IngestLog(os.path.join(tempfile.mkdtemp(), 'ingest.log'), size=4096)
+        log.stop()
+
+        # a publish racing the shutdown is refused instead of hitting an unmapped log
+        ingest_log, EventProcessor.ingest_log = EventProcessor.ingest_log, log
+        try:
+            self.assertRaises(QueueClosed, EventProcessor.add_event, create_event('podcast', 'publisher_id'))
+        finally:
+            EventProcessor.ingest_log = ingest_log
+        log.close()
+
+
 class TestActivity(unittest.TestCase):
 
     publisher_1 = "publisher_id_1"
@@ -0,0 +1,213 @@
+from threading import Event, Thread
+from time import monotonic, sleep
+from uuid import uuid4
+
+
+# renew or release a key only while it still holds our token
+RENEW = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('pexpire', KEYS[1], ARGV[2]) end return 0"
+RELEASE = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0"
+
+
+class Lease:
+
+    def __init__(self, redis, name, ttl=30.0):
+        """
+        a redis lease, renewed in the background while held
+        :param redis: redis client
+        :param name: lease key
+        :param ttl: seconds the lease outlives its holder
+        """
+        self._redis = redis
+        self._name = name
+        self._ttl = int(ttl * 1000)
+        self._token = uuid4().hex
+        self._released = Event()
+
+    @property
+    def held(self):
+        """whether the lease is still held by us"""
+        token = self._redis.get(self._name)
+        return token is not None and token.decode() == self._token
+
+    def acquire(self):
+        """
+        try to take the lease
+        :return: True if the lease is held
+        """
+        if not self._redis.set(self._name, self._token, nx=True, px=self._ttl):
+            return False
+
+        self._released.clear()
+        Thread(target=self._renew, daemon=True).start()
+        return True
+
+    def _renew(self):
+        """ keep the lease alive until it is released or lost """
+        while not self._released.wait(self._ttl / 3000):
+            if not self._redis.eval(RENEW, 1, self._name, self._token, self._ttl):
+                return
+
+    def release(self):
+        """ give the lease up if it is still held """
+        self._released.set()
+        self._redis.eval(RELEASE, 1, self._name, self._token)
+
+
+class Coordinator:
+
+    def __init__(self, redis, namespace='fs_cluster', ttl=30.0, shards=64, poll=0.5):
+        """
+        coordinate the cache initialisation of the nodes sharing a redis,
+        one elected node prepares the cache, then every node rebuilds
+        shards of the consumers until all of them are done
+        :param redis: redis client
+        :param namespace: key namespace, kept out of the cache namespace
+        :param ttl: seconds a lease or the readiness flag outlives its nodes
+        :param shards: number of consumer shards to split rebuilds in
+        :param poll: seconds between checks while waiting on other nodes
+        """
+        self._redis = redis
+        self._ns = namespace
+        self._ttl = ttl
+        self._shards = shards
+        self._poll = poll
+        self._leader = Lease(redis, f"{namespace}:leader", ttl)
+        self._heartbeat = None
+
+    @property
+    def _ready_key(self):
+        return f"{self._ns}:ready"
+
+    @property
+    def _plan_key(self):
+        return f"{self._ns}:plan"
+
+    def ready(self, epoch):
+        """
+        whether the cache is initialised for an epoch and served by live nodes
+        :param epoch: cache epoch
+        :return: bool
+        """
+        value = self._redis.get(self._ready_key)
+        return value is not None and value.decode() == epoch
+
+    def _plan(self):
+        """
+        the current rebuild plan
+        :return: { generation, epoch, shards } or None
+        """
+        plan = self._redis.hgetall(self._plan_key)
+        if not plan:
+            return None
+
+        plan = dict((k.decode(), v.decode()) for k, v in plan.items())
+        plan['shards'] = int(plan['shards'])
+        return plan
+
+    def _work(self, plan, rebuild):
+        """
+        claim and rebuild shards of a plan until none are left
+        :param plan: rebuild plan
+        :param rebuild: callable (shard, shards) rebuilding a shard
+        :return: number of rebuilt shards
+        """
+        claimed_key = f"{self._ns}:{plan['generation']}:claimed"
+        done_key = f"{self._ns}:{plan['generation']}:done"
+
+        rebuilt = 0
+        while True:
+            shard = self._redis.incr(claimed_key) - 1
+            if shard >= plan['shards']:
+                return rebuilt
+
+            rebuild(shard, plan['shards'])
+            self._redis.sadd(done_key, shard)
+            rebuilt += 1
+
+    def _finish(self, plan, rebuild, stall):
+        """
+        wait for the other nodes to rebuild their shards, shards that
+        make no progress within the stall timeout are rebuilt here
+        :param plan: rebuild plan
+        :param rebuild: callable (shard, shards) rebuilding a shard
+        :param stall: seconds without progress before taking shards over
+        """
+        done_key = f"{self._ns}:{plan['generation']}:done"
+        done, progress = -1, monotonic()
+        while True:
+            count = self._redis.scard(done_key)
+            if count >= plan['shards']:
+                return
+
+            if count != done:
+                done, progress = count, monotonic()
+            elif monotonic() - progress > stall:
+                finished = set(int(shard) for shard in self._redis.smembers(done_key))
+                for shard in range(plan['shards']):
+                    if shard not in finished:
+                        rebuild(shard, plan['shards'])
+                        self._redis.sadd(done_key, shard)
+
+            sleep(self._poll)
+
+    def initialize(self, epoch, prepare, rebuild, stall=60.0):
+        """
+        initialise the cache once for the whole cluster, blocks until ready
+        :param epoch: cache epoch
+        :param prepare: callable run by the elected node, returns True
+            if the cache has to be rebuilt shard by shard
+        :param rebuild: callable (shard, shards) rebuilding a shard
+        :param stall: seconds without progress before the leader
+            takes over the shards of unresponsive nodes
+        :return: True once the cache is ready
+        """
+        while not self.ready(epoch):
+            plan = self._plan()
+            if plan is not None and plan['epoch'] == epoch:
+                self._work(plan, rebuild)
+
+            if not self._leader.acquire():
+                sleep(self._poll)
+                continue
+
+            try:
+                # another leader may have finished while we were waiting
+                if self.ready(epoch):
+                    break
+
+                if prepare():
+                    plan = {'generation': uuid4().hex, 'epoch': epoch, 'shards': self._shards}
+                    pipe = self._redis.pipeline()
+                    pipe.delete(self._plan_key)
+                    pipe.hmset(self._plan_key, plan)
+                    pipe.execute()
+
+                    self._work(plan, rebuild)
+                    self._finish(plan, rebuild, stall)
+                    self._redis.delete(f"{self._ns}:{plan['generation']}:claimed",
+                                       f"{self._ns}:{plan['generation']}:done")
+
+                self._redis.set(self._ready_key, epoch, px=int(self._ttl * 1000))
+                self._redis.delete(self._plan_key)
+            finally:
+                self._leader.release()
+
+        self.start_heartbeat(epoch)
+        return True
+
+    def start_heartbeat(self, epoch):
+        """
+        keep the readiness flag alive while this node runs, once every
+        node is gone the flag expires and the next start rebuilds
+        :param epoch: cache epoch
+        """
+        if self._heartbeat is not None:
+            return
+
+        def heartbeat():
+            while True:
+                sleep(self._ttl / 3)
+                self._redis.eval(RENEW, 1, self._ready_key, epoch, int(self._ttl * 1000))
+
+        self._heartbeat = Thread(target=heartbeat, daemon=True)
+        self._heartbeat.start()
@@ -0,0 +1,409 @@
+import fcntl
+import json
+import logging
+import mmap
+import os
+import struct
+from array import array
+from itertools import accumulate
+from threading import Lock, Thread
+from time import sleep, time
+from uuid import uuid4
+
+
+logger = logging.getLogger(__name__)
+
+# snapshot header: magic, build time, number of ids, number of edges, size of the ids
+HEADER = struct.Struct('<8sdIII')
+MAGIC = b'FSGRAPH1'
+
+
+class GraphIndex:
+
+    def __init__(self, file_path, redis=None, channel='fs_graph', fold_after=10000):
+        """
+        in-memory index of the relations, ids are interned to integers
+        and edges are kept in compressed sparse rows, loaded from a memory
+        mapped snapshot shared by the processes of a host. changes since
+        the snapshot are kept in an overlay and broadcast to the other processes
+        :param file_path: path to the snapshot file
+        :param redis: redis client to exchange changes with the other
+            processes, None for a single process
+        :param channel: pubsub channel of the changes
+        :param fold_after: number of changes in the overlay after which
+            the snapshot is rebuilt to fold them in
+        """
+        self._file_path = os.path.expanduser(file_path)
+        self._redis = redis
+        self._channel = channel
+        self._node = uuid4().hex
+        self._lock = Lock()
+        self._mm = None
+        self._views = []
+        self._size = 0
+        self._names = None
+        self._blob_start = 0
+        self._followers = self._followees = None
+        self._followers_added = {}
+        self._followees_added = {}
+        self._removed = set()
+        self._changes = 0
+        self._fold_after = fold_after
+        self._folding = False
+        self._recorded = None
+        self._refreshing = Lock()
+        self._edges = None
+        self._pubsub = None
+        self._listener = None
+        self._closed = False
+
+    def __len__(self):
+        """number of indexed ids in the snapshot"""
+        return self._size
+
+    @staticmethod
+    def build(file_path, edges, built_at=None):
+        """
+        atomically write a snapshot of a graph
+        :param file_path: path to the snapshot file
+        :param edges: iterable of (consumer_id, producer_id)
+        :param built_at: time the edges were read at
+        :return: number of edges
+        """
+        built_at = time() if built_at is None else built_at
+        pairs = set((str(consumer_id), str(producer_id)) for consumer_id, producer_id in edges)
+
+        # ids are interned by their rank in a sorted string table
+        names = sorted(set(name.encode() for pair in pairs for name in pair))
+        ids = dict((name.decode(), index) for index, name in enumerate(names))
+        pairs = [(ids[consumer_id], ids[producer_id]) for consumer_id, producer_id in pairs]
+
+        name_offsets, offset = array('I', [0]), 0
+        for name in names:
+            offset += len(name)
+            name_offsets.append(offset)
+        blob = b''.join(names)
+
+        def rows(pairs):
+            pairs = sorted(pairs)
+            counts = [0] * (len(names) + 1)
+            for source, _ in pairs:
+                counts[source + 1] += 1
+            return array('I', accumulate(counts)), array('I', (target for _, target in pairs))
+
+        followers = rows((producer_id, consumer_id) for consumer_id, producer_id in pairs)
+        followees = rows(pairs)
+
+        tmp_path = file_path + '.tmp'
+        with open(tmp_path, 'wb') as snapshot:
+            snapshot.write(HEADER.pack(MAGIC, built_at, len(names), len(pairs), len(blob)))
+            snapshot.write(name_offsets.tobytes())
+            snapshot.write(blob + b'\0' * (-len(blob) % 4))
+            for offsets, targets in (followers, followees):
+                snapshot.write(offsets.tobytes())
+                snapshot.write(targets.tobytes())
+            snapshot.flush()
+            os.fsync(snapshot.fileno())
+        os.replace(tmp_path, file_path)
+        return len(pairs)
+
+    def _built_at(self):
+        """ build time of the snapshot file, None if missing """
+        if not os.path.exists(self._file_path):
+            return None
+
+        with open(self._file_path, 'rb') as snapshot:
+            magic, built_at, *_ = HEADER.unpack(snapshot.read(HEADER.size))
+            return built_at if magic == MAGIC else None
+
+    def _load(self, reset=False):
+        """
+        memory map the snapshot file
+        :param reset: drop the overlay instead of keeping the changes the snapshot misses
+        """
+        with open(self._file_path, 'rb') as snapshot:
+            mm = mmap.mmap(snapshot.fileno(), 0, access=mmap.ACCESS_READ)
+
+        _, _, size, count, blob_size = HEADER.unpack_from(mm, 0)
+        view, position = memoryview(mm), HEADER.size
+
+        def take(length, format='I'):
+            nonlocal position
+            part = view[position:position + length * (4 if format == 'I' else 1)]
+            position += len(part)
+            return part.cast(format) if format == 'I' else part
+
+        name_offsets = take(size + 1)
+        blob_start = position
+        blob = take(blob_size, 'B')
+        position += -blob_size % 4
+        followers = take(size + 1), take(count)
+        followees = take(size + 1), take(count)
+
+        with self._lock:
+            self._release()
+            self._mm, self._size, self._blob_start = mm, size, blob_start
+            self._names = name_offsets, blob
+            self._followers, self._followees = followers, followees
+            self._views = [view, name_offsets, blob, *followers, *followees]
+
+            if reset:
+                self._followers_added, self._followees_added, self._removed = {}, {}, set()
+
+            # changes received while loading may already be in the snapshot
+            for producer_id, consumer_ids in self._followers_added.items():
+                for consumer_id in [c for c in consumer_ids if self._has_edge(c, producer_id)]:
+                    consumer_ids.discard(consumer_id)
+                    self._followees_added[consumer_id].discard(producer_id)
+            self._removed = set(edge for edge in self._removed if self._has_edge(*edge))
+
+            # the ones made while rebuilding are applied again on top of it,
+            # in order, so a removal of an edge the snapshot holds is kept
+            for change in self._recorded or ():
+                self._change(*change)
+            self._recorded = None
+
+            for added in (self._followers_added, self._followees_added):
+                for name in [name for name, neighbours in added.items() if not neighbours]:
+                    del added[name]
+            self._changes = sum(map(len, self._followers_added.values())) + len(self._removed)
+
+    def _release(self):
+        """ unmap the current snapshot """
+        for view in reversed(self._views):
+            view.release()
+        self._views = []
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+        self._size = 0
+
+    def open(self, edges):
+        """
+        listen to the changes of the other processes, then load the
+        snapshot, it is rebuilt unless another process built it since
+        :param edges: callable returning the current (consumer_id, producer_id) edges
+        :return: self
+        """
+        self._edges = edges
+        listening = time()
+        if self._redis is not None:
+            self._listen()
+
+        # changes made before listening are only in a newer snapshot
+        self._refresh(listening)
+        return self
+
+    def _refresh(self, since, reset=False):
+        """
+        load the snapshot, it is rebuilt unless another process built it since
+        :param since: snapshots built before this time are rebuilt
+        :param reset: drop the overlay, changes may have been missed
+        """
+        with self._refreshing:
+            with self._lock:
+                self._recorded = []
+
+            try:
+                with open(self._file_path + '.lock', 'w') as lock:
+                    fcntl.flock(lock, fcntl.LOCK_EX)
+                    built_at = self._built_at()
+                    if built_at is None or built_at < since:
+                        self.build(self._file_path, self._edges(), time())
+
+                self._load(reset)
+            finally:
+                with self._lock:
+                    self._recorded = None
+
+    def _fold(self):
+        """ fold the overlay into a new snapshot in the background """
+        try:
+            self._refresh(time())
+        except Exception:
+            # wait for as many changes again before the next attempt
+            with self._lock:
+                self._changes = 0
+            logger.exception('folding the overlay of %s failed', self._file_path)
+        finally:
+            self._folding = False
+
+    def _name(self, index):
+        """ id of an interned index """
+        offsets, start = self._names[0], self._blob_start
+        return self._mm[start + offsets[index]:start + offsets[index + 1]].decode()
+
+    def _index(self, name):
+        """ interned index of an id or None, by binary search """
+        offsets = self._names[0]
+        name, low, high = name.encode(), 0, self._size
+        while low < high:
+            middle = (low + high) // 2
+            current = self._mm[self._blob_start + offsets[middle]:self._blob_start + offsets[middle + 1]]
+            if current == name:
+                return middle
+            if current < name:
+                low = middle + 1
+            else:
+                high = middle
+
+        return None
+
+    def _row(self, rows, name):
+        """ interned neighbours of an id in the snapshot """
+        index = self._index(name) if self._size else None
+        if index is None:
+            return []
+
+        offsets, targets = rows
+        return targets[offsets[index]:offsets[index + 1]]
+
+    def _has_edge(self, consumer_id, producer_id):
+        """ whether the snapshot holds an edge """
+        producer = self._index(producer_id) if self._size else None
+        if producer is None:
+            return False
+
+        row = self._row(self._followees, consumer_id)
+        low, high = 0, len(row)
+        while low < high:
+            middle = (low + high) // 2
+            if row[middle] < producer:
+                low = middle + 1
+            else:
+                high = middle
+        return low < len(row) and row[low] == producer
+
+    def _neighbours(self, rows, added, name, edge):
+        """
+        neighbours of an id in the snapshot and the overlay
+        :param rows: snapshot rows
+        :param added: overlay { id: set of ids }
+        :param name: id
+        :param edge: callable (name, neighbour) -> (consumer_id, producer_id)
+        :return: list of ids
+        """
+        with self._lock:
+            neighbours = [self._name(index) for index in self._row(rows, name)]
+            neighbours = [neighbour for neighbour in neighbours if edge(name, neighbour) not in self._removed]
+            neighbours.extend(added.get(name, ()))
+            return neighbours
+
+    def followers(self, producer_id):
+        """
+        consumers subscribed to a producer
+        :param producer_id: producer's id
+        :return: list of consumer ids
+        """
+        return self._neighbours(self._followers, self._followers_added, producer_id,
+                                lambda producer, consumer: (consumer, producer))
+
+    def followees(self, consumer_id):
+        """
+        producers a consumer is subscribed to
+        :param consumer_id: consumer's id
+        :return: list of producer ids
+        """
+        return self._neighbours(self._followees, self._followees_added, consumer_id,
+                                lambda consumer, producer: (consumer, producer))
+
+    def _change(self, op, consumer_id, producer_id):
+        """ change the overlay, the lock is held """
+        in_snapshot = self._has_edge(consumer_id, producer_id)
+        if op == 'add':
+            self._removed.discard((consumer_id, producer_id))
+            if not in_snapshot:
+                self._followers_added.setdefault(producer_id, set()).add(consumer_id)
+                self._followees_added.setdefault(consumer_id, set()).add(producer_id)
+            return
+
+        self._followers_added.get(producer_id, set()).discard(consumer_id)
+        self._followees_added.get(consumer_id, set()).discard(producer_id)
+        if in_snapshot:
+            self._removed.add((consumer_id, producer_id))
+
+    def _apply(self, op, consumer_id, producer_id):
+        """ apply a change to the overlay, it is folded into a new snapshot once it grew large """
+        with self._lock:
+            self._change(op, consumer_id, producer_id)
+            if self._recorded is not None:
+                self._recorded.append((op, consumer_id, producer_id))
+
+            self._changes += 1
+            fold = self._changes >= self._fold_after and not self._folding and self._edges is not None
+            if fold:
+                self._folding = True
+
+        if fold:
+            Thread(target=self._fold, daemon=True).start()
+
+    def _publish(self, op, consumer_id, producer_id):
+        """ apply a change and broadcast it to the other processes """
+        self._apply(op, consumer_id, producer_id)
+        if self._redis is not None:
+            self._redis.publish(self._channel, json.dumps(
+                {'op': op, 'consumer_id': consumer_id, 'producer_id': producer_id, 'node': self._node}))
+
+    def add(self, consumer_id, producer_id):
+        """
+        add an edge
+        :param consumer_id: consumer's id
+        :param producer_id: producer's id
+        """
+        self._publish('add', consumer_id, producer_id)
+
+    def remove(self, consumer_id, producer_id):
+        """
+        remove an edge
+        :param consumer_id: consumer's id
+        :param producer_id: producer's id
+        """
+        self._publish('remove', consumer_id, producer_id)
+
+    def _subscribe(self):
+        """ subscribe to the changes of the other processes """
+        pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(self._channel)
+        return pubsub
+
+    def _listen(self):
+        """
+        apply the changes of the other processes in the background, the
+        changes sent while the connection was lost are missed, so the
+        snapshot is rebuilt and the overlay dropped once it is back
+        """
+        self._pubsub = self._subscribe()
+
+        def listener():
+            lost = False
+            while not self._closed:
+                try:
+                    if lost:
+                        self._pubsub.close()
+                        self._pubsub = self._subscribe()
+                        self._refresh(time(), reset=True)
+                        lost = False
+
+                    for message in self._pubsub.listen():
+                        change = json.loads(message['data'])
+                        if change['node'] != self._node:
+                            self._apply(change['op'], change['consumer_id'], change['producer_id'])
+                except Exception:
+                    if not self._closed:
+                        logger.exception('listening to %s failed, reconnecting', self._channel)
+
+                lost = True
+                if not self._closed:
+                    sleep(1)
+
+        self._listener = Thread(target=listener, daemon=True)
+        self._listener.start()
+
+    def close(self):
+        """ stop listening and unmap the snapshot """
+        self._closed = True
+        if self._pubsub is not None:
+            self._pubsub.close()
+
+        with self._lock:
+            self._release()
@@ -0,0 +1,280 @@
+import json
+import logging
+import mmap
+import os
+import struct
+from threading import Condition, Thread
+from time import sleep
+from zlib import crc32
+
+
+logger = logging.getLogger(__name__)
+
+# record header: payload length, lap of the ring and crc32 of lap + payload
+HEADER = struct.Struct('<III')
+LAP = struct.Struct('<I')
+
+# header length marking that the log continues at the start of the next lap
+WRAP = 0xFFFFFFFF
+
+
+class LogClosed(Exception):
+    """ the log was stopped and takes no more records """
+
+
+class IngestLog:
+
+    def __init__(self, file_path, size=64 * 1024 * 1024, sync=True):
+        """
+        open a memory mapped, append-only ingestion log used as a ring,
+        records of older laps left behind in the file are never replayed
+        :param file_path: path to the log file
+        :param size: size of the log in bytes
+        :param sync: msync every append before acknowledging it
+        """
+        self._file_path = os.path.expanduser(file_path)
+        self._checkpoint_path = self._file_path + '.checkpoint'
+        self._sync = sync
+        self._cond = Condition()
+        self._closed = False
+        self._applier = None
+
+        fd = os.open(self._file_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size < size:
+                os.ftruncate(fd, size)
+            self._size = os.fstat(fd).st_size
+            self._mm = mmap.mmap(fd, self._size)
+        finally:
+            os.close(fd)
+
+        # replay starts at the checkpoint, the end of the log
+        # is right after the last intact record
+        self._applied = self._load_checkpoint()
+        self._end = self._applied
+        for self._end, _ in self._scan(self._applied):
+            pass
+
+    def __len__(self):
+        """number of bytes waiting to be applied"""
+        (end, end_lap), (applied, applied_lap) = self._end, self._applied
+        return end - applied if end_lap == applied_lap else self._size - applied + end
+
+    def _load_checkpoint(self):
+        """
+        read the position of the last applied record
+        :return: (offset, lap)
+        """
+        if not os.path.exists(self._checkpoint_path):
+            return 0, 1
+
+        with open(self._checkpoint_path, 'r') as checkpoint:
+            offset, lap = checkpoint.read().split()
+            return int(offset), int(lap)
+
+    def _save_checkpoint(self, position):
+        """
+        atomically persist the position of the last applied record
+        :param position: (offset, lap)
+        """
+        tmp_path = self._checkpoint_path + '.tmp'
+        with open(tmp_path, 'w') as checkpoint:
+            checkpoint.write('%d %d' % position)
+            checkpoint.flush()
+            os.fsync(checkpoint.fileno())
+        os.replace(tmp_path, self._checkpoint_path)
+
+    def _scan(self, position, limit=None):
+        """
+        iterate over the intact records from a position, stops at the end
+        of the log, at a record of an older lap or at a torn record
+        :param position: starting (offset, lap)
+        :param limit: max number of records
+        :return: generator of (next position, record)
+        """
+        (offset, lap), count = position, 0
+        while limit is None or count < limit:
+            length, record_lap, checksum = HEADER.unpack_from(self._mm, offset)
+            if record_lap != lap:
+                return
+
+            if length == WRAP:
+                if checksum != crc32(LAP.pack(lap)):
+                    return
+                offset, lap = 0, lap + 1
+                continue
+
+            start, end = offset + HEADER.size, offset + HEADER.size + length
+            if not length or end > self._size or crc32(self._mm[start:end], crc32(LAP.pack(lap))) != checksum:
+                return
+
+            offset, count = end, count + 1
+            yield (offset, lap), json.loads(self._mm[start:end])
+
+    def _write(self, offset, header, data=b''):
+        """
+        write a framed entry, msync-ed when the log is synchronous
+        :param offset: entry offset
+        :param header: packed header
+        :param data: payload
+        """
+        end = offset + len(header) + len(data)
+        self._mm[offset + len(header):end] = data
+        self._mm[offset:offset + len(header)] = header
+        if self._sync:
+            page = offset - offset % mmap.PAGESIZE
+            self._mm.flush(page, end - page)
+
+    def _reserve(self, size):
+        """
+        find room for a record, wrapping to the next lap if needed
+        :param size: framed record size
+        :return: (offset, lap) or None if the log is full
+        """
+        (end, lap), (applied, applied_lap) = self._end, self._applied
+        if lap != applied_lap:
+            return (end, lap) if end + size <= applied else None
+
+        # keep room at the tail for a wrap marker
+        if end + size + HEADER.size <= self._size:
+            return end, lap
+        if size > applied:
+            return None
+
+        self._write(end, HEADER.pack(WRAP, lap, crc32(LAP.pack(lap))))
+        self._end = (0, lap + 1)
+        return self._end
+
+    def append(self, record, timeout=5.0):
+        """
+        durably append a record, waits for the applier to free
+        space when the log is full
+        :param record: json serializable record
+        :param timeout: seconds to wait for space
+        :return: True on success
+        """
+        data = json.dumps(record).encode()
+        size = HEADER.size + len(data)
+        if size + HEADER.size > self._size // 2:
+            raise Exception('record is larger than the ingest log')
+
+        with self._cond:
+            if self._closed:
+                raise LogClosed('ingest log is closed')
+
+            position = self._reserve(size)
+            if position is None and not self._cond.wait_for(
+                    lambda: self._closed or self._reserve(size) is not None, timeout):
+                raise Exception('ingest log is full')
+            if self._closed:
+                raise LogClosed('ingest log is closed')
+
+            offset, lap = position or self._end
+            self._write(offset, HEADER.pack(len(data), lap, crc32(data, crc32(LAP.pack(lap)))), data)
+            self._end = (offset + size, lap)
+            self._cond.notify_all()
+
+        return True
+
+    def read(self, limit=500):
+        """
+        read the next batch of unapplied records
+        :param limit: max number of records
+        :return: (position to checkpoint once applied, list of records)
+        """
+        records = self._read(limit)
+        return (records[-1][0] if records else self._applied), [record for _, record in records]
+
+    def _read(self, limit):
+        """
+        read the next unapplied records with their positions
+        :param limit: max number of records
+        :return: list of (position to checkpoint once applied, record)
+        """
+        with self._cond:
+            return list(self._scan(self._applied, limit))
+
+    def checkpoint(self, position):
+        """
+        mark every record before a position as applied
+        :param position: position returned by read
+        """
+        with self._cond:
+            self._save_checkpoint(position)
+            self._applied = position
+            self._cond.notify_all()
+
+    def start_applier(self, apply, batch_size=500, interval=0.05, max_attempts=5, reject=None):
+        """
+        drain the log in the background, batches are checkpointed
+        only once applied and retried on failure. a batch out of attempts
+        is applied one record at a time, and the records that are still
+        failing are handed to reject and skipped so they do not block the log
+        :param apply: callable applying a list of records
+        :param batch_size: max records per batch
+        :param interval: seconds to wait for new records, doubled between attempts
+        :param max_attempts: attempts of a failing batch or record
+        :param reject: callable (record, error) keeping a record that can not be applied
+        :return: applier thread
+        """
+        def apply_each(limit):
+            for position, record in self._read(limit):
+                for attempt in range(1, max_attempts + 1):
+                    if self._closed:
+                        return
+                    try:
+                        apply([record])
+                        break
+                    except Exception as e:
+                        if attempt == max_attempts:
+                            if reject is not None:
+                                reject(record, e)
+                        else:
+                            sleep(interval * 2 ** attempt)
+                self.checkpoint(position)
+
+        def applier():
+            attempts = 0
+            while not self._closed:
+                with self._cond:
+                    self._cond.wait_for(lambda: self._closed or self._end != self._applied, interval)
+
+                position, records = self.read(batch_size)
+                if not records:
+                    continue
+
+                try:
+                    if attempts < max_attempts:
+                        apply(records)
+                        self.checkpoint(position)
+                    else:
+                        apply_each(len(records))
+                    attempts = 0
+                except Exception:
+                    attempts += 1
+                    logger.exception('applying %d ingested records failed, attempt %d', len(records), attempts)
+                    sleep(interval * 2 ** min(attempts, max_attempts))
+
+        self._applier = Thread(target=applier, daemon=True)
+        self._applier.start()
+        return self._applier
+
+    def stop(self):
+        """
+        take no more records and stop the applier, the log stays
+        mapped for the appends still in flight to fail cleanly
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+        if self._applier is not None:
+            self._applier.join()
+
+    def close(self):
+        """ stop the log and unmap it """
+        self.stop()
+        with self._cond:
+            if not self._mm.closed:
+                self._mm.flush()
+                self._mm.close()
@@ -0,0 +1,510 @@
+import itertools
+import json
+import os
+from bisect import bisect_left, bisect_right, insort
+from fnmatch import fnmatchcase
+from threading import RLock, Thread
+from time import monotonic, sleep
+
+
+# unfinished scans whose key snapshots are kept for their cursors
+MAX_SCANS = 64
+
+
+def _encode(value):
+    """ encode a key, member or value the way redis-py does """
+    if isinstance(value, bytes):
+        return value
+    if isinstance(value, float):
+        return repr(value).encode()
+    return str(value).encode()
+
+
+def _bound(value):
+    """
+    parse a score bound
+    :param value: score, '(score', '-inf' or '+inf'
+    :return: (score, exclusive)
+    """
+    if isinstance(value, bytes):
+        value = value.decode()
+    if isinstance(value, str) and value.startswith('('):
+        return float(value[1:]), True
+    return float(value), False
+
+
+def _range(size, start, end):
+    """
+    convert an inclusive redis index range to a slice
+    :return: (start, stop)
+    """
+    start = max(size + start, 0) if start < 0 else start
+    end = size + end if end < 0 else min(end, size - 1)
+    return start, max(end + 1, start)
+
+
+def _page(first, stop, start, num, desc=False):
+    """
+    narrow an index slice to a redis LIMIT page
+    :param first: slice start
+    :param stop: slice stop
+    :param start: page offset, from the end of the slice when descending
+    :param num: page size, negative for the rest of the slice
+    :return: (start, stop)
+    """
+    size = stop - first if num < 0 else num
+    if desc:
+        return max(stop - start - size, first), max(stop - start, first)
+    return min(first + start, stop), min(first + start + size, stop)
+
+
+class SortedSet:
+
+    def __init__(self):
+        """ members ordered by (score, member), like a redis sorted set """
+        self.scores = {}
+        self.index = []
+
+    def __len__(self):
+        return len(self.scores)
+
+    def add(self, member, score):
+        """
+        add or update a member
+        :return: True if the member is new
+        """
+        current = self.scores.get(member)
+        if current == score:
+            return False
+        if current is not None:
+            self.remove(member)
+
+        self.scores[member] = score
+        insort(self.index, (score, member))
+        return current is None
+
+    def remove(self, member):
+        """
+        remove a member
+        :return: True if it existed
+        """
+        score = self.scores.pop(member, None)
+        if score is None:
+            return False
+
+        del self.index[bisect_left(self.index, (score, member))]
+        return True
+
+    def rank(self, member):
+        """ ascending rank of a member or None """
+        score = self.scores.get(member)
+        if score is None:
+            return None
+        return bisect_left(self.index, (score, member))
+
+    def between(self, low, high):
+        """
+        slice of the index within score bounds
+        :param low: (score, exclusive)
+        :param high: (score, exclusive)
+        :return: (start, stop)
+        """
+        (low, low_exclusive), (high, high_exclusive) = low, high
+        # members are bytes, they sort after b'' and before a run of 0xff
+        start = (bisect_right(self.index, (low, b'\xff' * 64)) if low_exclusive
+                 else bisect_left(self.index, (low, b'')))
+        stop = (bisect_left(self.index, (high, b'')) if high_exclusive
+                else bisect_right(self.index, (high, b'\xff' * 64)))
+        return start, max(stop, start)
+
+
+class MemoryStore:
+    """
+    in-process store for single node deployments and tests, implements
+    the redis-py commands used by FeedStream: sorted sets, hashes, sets,
+    strings with expiry, scan and pipelines. timelines can be
+    snapshotted to a json file and loaded back on start
+    """
+
+    def __init__(self, snapshot=None, snapshot_interval=60.0):
+        """
+        initialize a new in-process store
+        :param snapshot: path of the snapshot file, None keeps data in memory only
+        :param snapshot_interval: seconds between background snapshots, 0 disables them
+        """
+        self._lock = RLock()
+        self._data = {}
+        self._expires = {}
+        self._scans = {}
+        self._scan_ids = itertools.count(1)
+        self._snapshot = os.path.expanduser(snapshot) if snapshot else None
+
+        if self._snapshot and os.path.exists(self._snapshot):
+            self._load()
+
+        if self._snapshot and snapshot_interval:
+            def snapshots():
+                while True:
+                    sleep(snapshot_interval)
+                    self.save()
+
+            Thread(target=snapshots, daemon=True).start()
+
+    def _get(self, name, kind=None, create=False):
+        """
+        get a live value of a key
+        :param name: key
+        :param kind: expected type, created if missing and create is set
+        :return: value or None
+        """
+        name = _encode(name)
+        expires = self._expires.get(name)
+        if expires is not None and expires <= monotonic():
+            self._data.pop(name, None)
+            del self._expires[name]
+
+        value = self._data.get(name)
+        if value is None and create:
+            value = self._data[name] = kind()
+        if value is not None and kind is not None and not isinstance(value, kind):
+            raise TypeError('WRONGTYPE Operation against a key holding the wrong kind of value')
+        return value
+
+    def _prune(self, name):
+        """ drop a key once its container is empty, like redis """
+        name = _encode(name)
+        if not self._data.get(name):
+            self._data.pop(name, None)
+            self._expires.pop(name, None)
+
+    # keys
+
+    def exists(self, *names):
+        with self._lock:
+            return sum(1 for name in names if self._get(name) is not None)
+
+    def delete(self, *names):
+        with self._lock:
+            count = 0
+            for name in names:
+                if self._get(name) is not None:
+                    del self._data[_encode(name)]
+                    self._expires.pop(_encode(name), None)
+                    count += 1
+            return count
+
+    def scan(self, cursor=0, match=None, count=None):
+        """
+        page through a snapshot of the key names taken when the iteration
+        starts, the cursor holds the snapshot id and the offset into it
+        """
+        cursor = int(cursor)
+        with self._lock:
+            scan_id, offset = cursor >> 32, cursor & 0xFFFFFFFF
+            keys = self._scans.pop(scan_id, None) if cursor else None
+            if keys is None:
+                scan_id, keys = next(self._scan_ids), list(self._data)
+            page = [key for key in keys[offset:offset + (count or 10)] if self._get(key) is not None]
+            offset += count or 10
+            if offset < len(keys):
+                self._scans[scan_id] = keys
+                while len(self._scans) > MAX_SCANS:
+                    self._scans.pop(next(iter(self._scans)))
+        if match is not None:
+            page = [key for key in page if fnmatchcase(key.decode('latin-1'), match)]
+        return ((scan_id << 32) | offset if offset < len(keys) else 0), page
+
+    def scan_iter(self, match=None, count=None):
+        cursor = None
+        while cursor != 0:
+            cursor, keys = self.scan(cursor or 0, match=match, count=count)
+            yield from keys
+
+    def flushdb(self):
+        with self._lock:
+            self._data.clear()
+            self._expires.clear()
+            return True
+
+    # strings
+
+    def get(self, name):
+        with self._lock:
+            return self._get(name, bytes)
+
+    def set(self, name, value, ex=None, px=None, nx=False, xx=False):
+        with self._lock:
+            exists = self._get(name) is not None
+            if (nx and exists) or (xx and not exists):
+                return None
+
+            name = _encode(name)
+            self._data[name] = _encode(value)
+            self._expires.pop(name, None)
+            if ex is not None or px is not None:
+                self._expires[name] = monotonic() + (ex if ex is not None else px / 1000)
+            return True
+
+    def pexpire(self, name, time):
+        with self._lock:
+            if self._get(name) is None:
+                return False
+            self._expires[_encode(name)] = monotonic() + time / 1000
+            return True
+
+    def incr(self, name, amount=1):
+        with self._lock:
+            value = int(self._get(name, bytes) or 0) + amount
+            self._data[_encode(name)] = _encode(value)
+            return value
+
+    # hashes
+
+    def hset(self, name, key, value):
+        with self._lock:
+            fields = self._get(name, dict, create=True)
+            new = _encode(key) not in fields
+            fields[_encode(key)] = _encode(value)
+            return int(new)
+
+    def hmset(self, name, mapping):
+        with self._lock:
+            fields = self._get(name, dict, create=True)
+            fields.update((_encode(key), _encode(value)) for key, value in mapping.items())
+            return True
+
+    def hget(self, name, key):
+        with self._lock:
+            return (self._get(name, dict) or {}).get(_encode(key))
+
+    def hmget(self, name, keys, *args):
+        with self._lock:
+            fields = self._get(name, dict) or {}
+            keys = list(keys) if isinstance(keys, (list, tuple)) else [keys]
+            return [fields.get(_encode(key)) for key in keys + list(args)]
+
+    def hgetall(self, name):
+        with self._lock:
+            return dict(self._get(name, dict) or {})
+
+    def hdel(self, name, *keys):
+        with self._lock:
+            fields = self._get(name, dict) or {}
+            count = sum(1 for key in keys if fields.pop(_encode(key), None) is not None)
+            self._prune(name)
+            return count
+
+    # sets
+
+    def sadd(self, name, *values):
+        with self._lock:
+            members = self._get(name, set, create=True)
+            size = len(members)
+            members.update(_encode(value) for value in values)
+            return len(members) - size
+
+    def scard(self, name):
+        with self._lock:
+            return len(self._get(name, set) or ())
+
+    def smembers(self, name):
+        with self._lock:
+            return set(self._get(name, set) or ())
+
+    # sorted sets
+
+    def zadd(self, name, mapping, nx=False, xx=False, ch=False, incr=False):
+        with self._lock:
+            timeline = self._get(name, SortedSet, create=not xx)
+            if timeline is None:
+                return 0
+
+            added = changed = 0
+            for member, score in mapping.items():
+                member, score = _encode(member), float(score)
+                exists = member in timeline.scores
+                if (nx and exists) or (xx and not exists):
+                    continue
+                if exists and timeline.scores[member] != score:
+                    changed += 1
+                added += timeline.add(member, score)
+
+            self._prune(name)
+            return added + changed if ch else added
+
+    def zrem(self, name, *values):
+        with self._lock:
+            timeline = self._get(name, SortedSet)
+            if timeline is None:
+                return 0
+
+            count = sum(timeline.remove(_encode(value)) for value in values)
+            self._prune(name)
+            return count
+
+    def zscore(self, name, value):
+        with self._lock:
+            return (self._get(name, SortedSet) or SortedSet()).scores.get(_encode(value))
+
+    def zrevrank(self, name, value):
+        with self._lock:
+            timeline = self._get(name, SortedSet) or SortedSet()
+            rank = timeline.rank(_encode(value))
+            return None if rank is None else len(timeline) - 1 - rank
+
+    def zcard(self, name):
+        with self._lock:
+            return len((self._get(name, SortedSet) or SortedSet()).index)
+
+    def zcount(self, name, min, max):
+        with self._lock:
+            start, stop = (self._get(name, SortedSet) or SortedSet()).between(_bound(min), _bound(max))
+            return stop - start
+
+    def zrange(self, name, start, end, desc=False, withscores=False, score_cast_func=float):
+        with self._lock:
+            index = (self._get(name, SortedSet) or SortedSet()).index
+            start, stop = _range(len(index), start, end)
+            # descending ranks count from the end, only the slice is reversed
+            items = index[len(index) - stop:len(index) - start][::-1] if desc else index[start:stop]
+            return [(member, score_cast_func(score)) if withscores else member
+                    for score, member in items]
+
+    def zrevrange(self, name, start, end, withscores=False, score_cast_func=float):
+        return self.zrange(name, start, end, desc=True, withscores=withscores,
+                           score_cast_func=score_cast_func)
+
+    def zrangebyscore(self, name, min, max, start=None, num=None, withscores=False,
+                      score_cast_func=float, desc=False):
+        with self._lock:
+            timeline = self._get(name, SortedSet) or SortedSet()
+            first, stop = timeline.between(_bound(min), _bound(max))
+            if start is not None and num is not None:
+                first, stop = _page(first, stop, start, num, desc)
+            items = timeline.index[first:stop]
+            if desc:
+                items = items[::-1]
+            return [(member, score_cast_func(score)) if withscores else member
+                    for score, member in items]
+
+    def zrevrangebyscore(self, name, max, min, start=None, num=None, withscores=False,
+                         score_cast_func=float):
+        return self.zrangebyscore(name, min, max, start=start, num=num, withscores=withscores,
+                                  score_cast_func=score_cast_func, desc=True)
+
+    def zremrangebyrank(self, name, min, max):
+        with self._lock:
+            timeline = self._get(name, SortedSet)
+            if timeline is None:
+                return 0
+
+            start, stop = _range(len(timeline), min, max)
+            removed = timeline.index[start:stop]
+            del timeline.index[start:stop]
+            for _, member in removed:
+                del timeline.scores[member]
+
+            self._prune(name)
+            return len(removed)
+
+    def zremrangebyscore(self, name, min, max):
+        with self._lock:
+            timeline = self._get(name, SortedSet)
+            if timeline is None:
+                return 0
+
+            start, stop = timeline.between(_bound(min), _bound(max))
+            removed = timeline.index[start:stop]
+            del timeline.index[start:stop]
+            for _, member in removed:
+                del timeline.scores[member]
+
+            self._prune(name)
+            return len(removed)
+
+    # pipelines and snapshots
+
+    def pipeline(self, transaction=True):
+        return MemoryPipeline(self)
+
+    def save(self):
+        """
+        atomically snapshot the store to its file, keys with
+        an expiry are transient and left out
+        :return: True on success
+        """
+        if not self._snapshot:
+            return False
+
+        with self._lock:
+            data = {}
+            for name, value in list(self._data.items()):
+                if name in self._expires or self._get(name) is None:
+                    continue
+
+                key = name.decode('latin-1')
+                if isinstance(value, SortedSet):
+                    data[key] = ['zset', [[member.decode('latin-1'), score] for score, member in value.index]]
+                elif isinstance(value, dict):
+                    data[key] = ['hash', dict((k.decode('latin-1'), v.decode('latin-1')) for k, v in value.items())]
+                elif isinstance(value, set):
+                    data[key] = ['set', [member.decode('latin-1') for member in value]]
+                else:
+                    data[key] = ['string', value.decode('latin-1')]
+
+        tmp_path = self._snapshot + '.tmp'
+        with open(tmp_path, 'w') as snapshot:
+            json.dump(data, snapshot)
+            snapshot.flush()
+            os.fsync(snapshot.fileno())
+        os.replace(tmp_path, self._snapshot)
+        return True
+
+    def _load(self):
+        """ load the snapshot file """
+        with open(self._snapshot, 'r') as snapshot:
+            data = json.load(snapshot)
+
+        for key, (kind, value) in data.items():
+            name = key.encode('latin-1')
+            if kind == 'zset':
+                timeline = self._data[name] = SortedSet()
+                for member, score in value:
+                    timeline.add(member.encode('latin-1'), score)
+            elif kind == 'hash':
+                self._data[name] = dict((k.encode('latin-1'), v.encode('latin-1')) for k, v in value.items())
+            elif kind == 'set':
+                self._data[name] = set(member.encode('latin-1') for member in value)
+            else:
+                self._data[name] = value.encode('latin-1')
+
+
+class MemoryPipeline:
+
+    def __init__(self, store):
+        """
+        buffer commands and run them at once while holding the store's lock
+        :param store: memory store
+        """
+        self._store = store
+        self._commands = []
+
+    def __getattr__(self, command):
+        method = getattr(self._store, command)
+
+        def buffered(*args, **kwargs):
+            self._commands.append((method, args, kwargs))
+            return self
+
+        return buffered
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self._commands = []
+
+    def execute(self):
+        with self._store._lock:
+            commands, self._commands = self._commands, []
+            return [method(*args, **kwargs) for method, args, kwargs in commands]
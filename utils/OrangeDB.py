@@ -1,6 +1,20 @@
 import json
 import os
-from threading import Thread
+from functools import wraps
+from threading import RLock, Thread
+from time import sleep
+from zlib import crc32
+
+
+def synchronized(method):
+    """ run a database method while holding the database's lock """
+
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            return method(self, *args, **kwargs)
+
+    return wrapper
 
 
 class OrangeBase:
@@ -41,6 +55,7 @@ class OrangeBase:
 
         return self._db[key]
 
+    @synchronized
     def set(self, key, value, overwrite=True, dump=True):
         """
         set a new value for the given key
@@ -54,9 +69,11 @@ class OrangeBase:
             return False
 
         self._db[key] = value
-        self.dump(force=False)
+        if dump:
+            self._changed(key)
         return True
 
+    @synchronized
     def setm(self, *args, overwrite=True):
         """
         set many new value and keys
@@ -67,9 +84,10 @@ class OrangeBase:
         for key, value in args:
             self.set(key, value, overwrite, False)
 
-        self.dump(force=False)
+        self._changed(*(key for key, _ in args))
         return True
 
+    @synchronized
     def delete(self, key):
         """
         delete the value associated with key
@@ -80,16 +98,17 @@ class OrangeBase:
             return False
 
         del self._db[key]
-        self.dump(force=False)
+        self._changed(key)
         return True
 
+    @synchronized
     def clear(self):
         """
         clear the entire database
         :returns: True on success
         """
         self._db.clear()
-        self.dump(force=False)
+        self._cleared()
         return True
 
     def has(self, key):
@@ -100,6 +119,7 @@ class OrangeBase:
         """
         return key in self._db
 
+    @synchronized
     def pop(self, key, default=None):
         """
         pop an item from the database
@@ -107,10 +127,14 @@ class OrangeBase:
         :param default: default value
         :returns: value or default
         """
-        value = self._db.pop(key, default)
-        self.dump(force=False)
+        if key not in self._db:
+            return default
+
+        value = self._db.pop(key)
+        self._changed(key)
         return value
 
+    @synchronized
     def incrby(self, key, increment):
         """
         incremenet the interger value of the given field
@@ -140,6 +164,7 @@ class OrangeBase:
         """
         return [self.get(key, default) for key in args]
 
+    @synchronized
     def setnx(self, key, value):
         """
         set the value for the given key only if the
@@ -195,6 +220,7 @@ class OrangeBase:
         """
         return len(self[key])
 
+    @synchronized
     def lappend(self, key, value):
         """
         append a new value to a list
@@ -203,9 +229,10 @@ class OrangeBase:
         :returns: True on success
         """
         self._db[key].append(value)
-        self.dump(force=False)
+        self._updated('lappend', key, value)
         return True
 
+    @synchronized
     def ldellist(self, key):
         """
         delete a list from the database
@@ -216,6 +243,7 @@ class OrangeBase:
         del self[key]
         return length
 
+    @synchronized
     def ldelvalue(self, key, value):
         """
         delete a value from list
@@ -224,9 +252,10 @@ class OrangeBase:
         :returns: True on success
         """
         self[key].remove(value)
-        self.dump(force=False)
+        self._updated('ldelvalue', key, value)
         return True
 
+    @synchronized
     def ldelindex(self, key, index):
         """
         delete a value from list by its index
@@ -235,7 +264,7 @@ class OrangeBase:
         :returns: True on success
         """
         del self[key][index]
-        self.dump(force=False)
+        self._updated('ldelindex', key, index)
         return True
 
     def lhas(self, key, value):
@@ -247,6 +276,7 @@ class OrangeBase:
         """
         return value in self[key]
 
+    @synchronized
     def lextend(self, key, sec):
         """
         extend the list with a sequence
@@ -255,9 +285,10 @@ class OrangeBase:
         :returns: True on success
         """
         self[key].extend(sec)
-        self.dump(force=False)
+        self._updated('lextend', key, list(sec))
         return True
 
+    @synchronized
     def lpop(self, key):
         """
         pop the last value in the list
@@ -265,7 +296,7 @@ class OrangeBase:
         :returns: popped value from list
         """
         val = self[key].pop()
-        self.dump(force=False)
+        self._updated('lpop', key)
         return val
 
     def copy(self):
@@ -284,37 +315,274 @@ class OrangeBase:
         """:returns: returns a list of tuples of key values"""
         return self._db.items()
 
+    def _changed(self, *keys):
+        """
+        persist the current state of the given keys
+        :param keys: changed keys
+        :returns: True if the change was persisted
+        """
+        if not self._journaling:
+            return self.dump(force=False)
+
+        return self._log([['set', self._db_path, key, self._db[key]] if key in self._db
+                          else ['del', self._db_path, key] for key in keys])
+
+    def _updated(self, op, key, *args):
+        """
+        persist an in-place change of a key's value, only the
+        operation is journaled instead of the whole new value
+        :param op: list operation, e.g. lappend
+        :param key: changed key
+        :param args: operation arguments
+        :returns: True if the change was persisted
+        """
+        if not self._journaling:
+            return self.dump(force=False)
+
+        return self._log([[op, self._db_path, key, *args]])
+
+    def _cleared(self):
+        """
+        persist clearing the database
+        :returns: True if the change was persisted
+        """
+        if not self._journaling:
+            return self.dump(force=False)
+
+        return self._log([['clear', self._db_path]])
+
 
 class Orange(OrangeBase):
 
-    def __init__(self, file_path, auto_dump=True, load=True):
+    def __init__(self, file_path, auto_dump=True, load=True, journal=False,
+                 fsync_interval=1.0, compact_size=4 * 1024 * 1024):
         """
         initialize a new Orange database
         :param file_path: path to the db file
         :param auto_dump: automatically store db on updates
         :param load: will load database if is True
+        :param journal: append changes to a journal instead of
+            rewriting the whole file on every update
+        :param fsync_interval: seconds between journal fsyncs, 0 syncs every write
+        :param compact_size: journal size in bytes that triggers a compaction
         """
         self._file_path = os.path.expanduser(file_path)
+        self._journal_path = self._file_path + '.journal'
+        self._rotated_path = self._journal_path + '.old'
         self._auto_dump = auto_dump
+        self._journal = journal
+        self._fsync_interval = fsync_interval
+        self._compact_size = compact_size
+        self._journal_file = None
+        self._unsynced = False
+        self._closed = False
+        self._snapshot = 0
+        self._lock = RLock()
+        self._compaction = RLock()
+        self._db_path = []
+        self._shards = dict()
         self._db = None
         if load:
             self._load()
 
+        if self._journal:
+            Thread(target=self._maintain_journal, daemon=True).start()
+
+    @property
+    def _journaling(self):
+        return self._journal and self._auto_dump
+
+    def child(self, path, shard=False):
+        """
+        initialize a new child database
+        :param path: url like path for the child database
+        :param shard: keep the child in its own file, loaded on first
+            access and dumped independently of this database
+        :returns: child database instance
+        """
+        if not shard:
+            return OrangeChild(self, path)
+
+        with self._lock:
+            key = '/'.join(OrangeChild._parse_path(path))
+            if key not in self._shards:
+                self._shards[key] = OrangeShard(self, key)
+            return self._shards[key]
+
     def _load(self):
         """
         load the database from local storage
         :returns: True on success
         """
+        data = b''
         if os.path.exists(self._file_path):
-            try:
-                self._db = json.load(open(self._file_path, "r"))
-            except ValueError:
-                # in case the file is empty
-                self._db = dict()
-        else:
+            with open(self._file_path, "rb") as file:
+                data = file.read()
+
+        try:
+            self._db = json.loads(data)
+        except ValueError:
+            # in case the file is empty
             self._db = dict()
+        self._snapshot = crc32(data)
+
+        # changes journaled by an earlier run are never lost, a journal
+        # rotated by an interrupted compaction comes before the current one
+        rotated = self._replay(self._rotated_path)
+        replayed = self._replay(self._journal_path, chained=rotated is not None)
+
+        # the replayed changes are folded into a new snapshot, leaving no
+        # journal that names an older one behind
+        stale = replayed is None and os.path.exists(self._journal_path)
+        if rotated or replayed or stale or os.path.exists(self._rotated_path):
+            self.dump()
+        if not self._journal and os.path.exists(self._journal_path):
+            os.remove(self._journal_path)
         return True
 
+    def _replay(self, path, chained=False):
+        """
+        apply the changes recorded in a journal on top of the loaded
+        file, dropping a partially written trailing entry. a journal is
+        skipped when its header names another snapshot than the loaded
+        one, its changes are already in the file
+        :param path: journal path
+        :param chained: the journal continues a journal that was replayed
+        :returns: number of replayed entries, None if the journal was skipped
+        """
+        if not os.path.exists(path):
+            return None
+
+        count, offset = 0, 0
+        with open(path, "rb") as journal:
+            for line in journal:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break
+                if not line.endswith(b'\n'):
+                    break
+
+                offset += len(line)
+                if isinstance(entry, dict):
+                    if not chained and entry['base'] != self._snapshot:
+                        return None
+                    continue
+
+                self._apply(entry)
+                count += 1
+
+        with open(path, "ab") as journal:
+            journal.truncate(offset)
+        return count
+
+    def _apply(self, entry):
+        """
+        apply a single journal entry to the database
+        :param entry: [operation, path, *args]
+        """
+        op, path = entry[0], entry[1]
+        db = self._db
+        for div in path:
+            db = db.setdefault(div, dict())
+
+        if op == 'set':
+            db[entry[2]] = entry[3]
+        elif op == 'del':
+            db.pop(entry[2], None)
+        elif op == 'clear':
+            db.clear()
+        elif op == 'lappend':
+            db[entry[2]].append(entry[3])
+        elif op == 'lextend':
+            db[entry[2]].extend(entry[3])
+        elif op == 'ldelvalue':
+            db[entry[2]].remove(entry[3])
+        elif op == 'ldelindex':
+            del db[entry[2]][entry[3]]
+        elif op == 'lpop':
+            db[entry[2]].pop()
+
+    @synchronized
+    def _log(self, entries):
+        """
+        append entries to the journal
+        :param entries: journal entries
+        :returns: True on success
+        """
+        if self._journal_file is None:
+            self._journal_file = open(self._journal_path, "a")
+            if not self._journal_file.tell():
+                self._journal_file.write(json.dumps({'base': self._snapshot}) + '\n')
+
+        self._journal_file.write(''.join(json.dumps(entry) + '\n' for entry in entries))
+        self._journal_file.flush()
+        self._unsynced = True
+
+        if not self._fsync_interval:
+            self._sync()
+        return True
+
+    @synchronized
+    def _sync(self):
+        """ fsync the journal if it has unsynced entries """
+        if self._journal_file is not None and self._unsynced:
+            os.fsync(self._journal_file.fileno())
+            self._unsynced = False
+
+    def _maintain_journal(self):
+        """ background loop syncing and compacting the journal """
+        while not self._closed:
+            sleep(self._fsync_interval or 1.0)
+            with self._lock:
+                if self._closed:
+                    return
+
+                self._sync()
+                full = (self._journal_file is not None and
+                        self._journal_file.tell() >= self._compact_size)
+
+            if full:
+                self._compact()
+
+    def _compact(self):
+        """
+        fold the journal into the file. the database is serialized and the
+        journal rotated under the lock, the file is written outside of it
+        while the writers go on with a new journal
+        :returns: True on success
+        """
+        with self._compaction:
+            with self._lock:
+                if self._closed or self._journal_file is None:
+                    return False
+
+                # a journal rotated by a failed compaction is folded by a full dump
+                if os.path.exists(self._rotated_path):
+                    return self.dump()
+
+                data = json.dumps(self._db)
+                self._sync()
+                self._journal_file.close()
+                self._journal_file = None
+                os.replace(self._journal_path, self._rotated_path)
+                # the next journal continues the snapshot being written
+                self._snapshot = crc32(data.encode())
+
+            self._write_file(data, self._file_path)
+            os.remove(self._rotated_path)
+            return True
+
+    @staticmethod
+    def _write_file(data, path):
+        """ atomically replace the file at path with serialized data """
+        tmp_path = path + '.tmp'
+        with open(tmp_path, "w") as tmp_file:
+            tmp_file.write(data)
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        os.replace(tmp_path, path)
+
     def dump(self, force=True, path=None):
         """
         dumps the current database into the file
@@ -322,15 +590,49 @@ class Orange(OrangeBase):
         :param path: optional path could also be provided
         :returns: True on success
         """
-        if force or self._auto_dump:
+        if not (force or self._auto_dump):
+            return False
+
+        with self._compaction, self._lock:
             path = os.path.expanduser(path) if path else self._file_path
-            thread = Thread(target=json.dump,
-                            args=(self._db, open(path, "w")))
-            thread.start()
-            thread.join()
+            data = json.dumps(self._db)
+            self._write_file(data, path)
+            if path != self._file_path:
+                return True
+
+            # the file now holds every journaled change, the journals
+            # naming the previous snapshot are skipped from now on
+            self._snapshot = crc32(data.encode())
+            if self._journal_file is not None:
+                self._journal_file.close()
+                self._journal_file = None
+            if self._journal:
+                with open(self._journal_path, "w") as journal:
+                    journal.write(json.dumps({'base': self._snapshot}) + '\n')
+                    os.fsync(journal.fileno())
+                self._unsynced = False
+            if os.path.exists(self._rotated_path):
+                os.remove(self._rotated_path)
             return True
 
-        return False
+    def close(self):
+        """
+        compact the journal and stop the background maintenance
+        :returns: True on success
+        """
+        with self._compaction, self._lock:
+            if self._journal and self._auto_dump:
+                self.dump()
+
+            if self._journal_file is not None:
+                self._journal_file.close()
+                self._journal_file = None
+
+            for shard in self._shards.values():
+                shard.close()
+
+            self._closed = True
+            return True
 
 
 class OrangeChild(OrangeBase):
@@ -346,9 +648,15 @@ class OrangeChild(OrangeBase):
             raise Exception("path is not valid")
 
         self._parent = parent
+        self._lock = parent._lock
+        self._db_path = parent._db_path + self._path
         self._db = None
         self._load_child_db()
 
+    @property
+    def _journaling(self):
+        return self._parent._journaling
+
     @staticmethod
     def _parse_path(path):
         """ parses the path """
@@ -368,10 +676,15 @@ class OrangeChild(OrangeBase):
             curr_db = curr_db[div]
         self._db = curr_db
 
+    def _log(self, entries):
+        """ append entries to the parent's journal """
+        return self._parent._log(entries)
+
     def dump(self, *args, **kwargs):
         """ dumpt the child database """
         return self._parent.dump(*args, **kwargs)
 
+    @synchronized
     def clear(self):
         """ clear child database """
         parent = self._parent._db
@@ -379,6 +692,52 @@ class OrangeChild(OrangeBase):
             parent = parent[div]
 
         parent[self._path[-1]] = dict()
-        self.dump(force=False)
         self._load_child_db()
+        self._cleared()
         return True
+
+
+class OrangeShard(Orange):
+
+    def __init__(self, parent, path):
+        """
+        initialize a new OrangeDB Shard, a child database kept in its own
+        file next to the parent's and loaded on first access
+        :param parent: parent Database
+        :param path: shard path, url formatted
+        """
+        self._path = OrangeChild._parse_path(path)
+        if not all(self._path) or '..' in self._path:
+            raise Exception("path is not valid")
+
+        self._data = None
+        root = os.path.splitext(parent._file_path)[0] + '.d'
+        super().__init__(os.path.join(root, *self._path) + '.json',
+                         auto_dump=parent._auto_dump, load=False,
+                         journal=parent._journal,
+                         fsync_interval=parent._fsync_interval,
+                         compact_size=parent._compact_size)
+
+    @property
+    def _db(self):
+        if self._data is None:
+            with self._lock:
+                if self._data is None:
+                    os.makedirs(os.path.dirname(self._file_path), exist_ok=True)
+                    self._load()
+        return self._data
+
+    @_db.setter
+    def _db(self, value):
+        self._data = value
+
+    @property
+    def loaded(self):
+        return self._data is not None
+
+    def dump(self, *args, **kwargs):
+        """ dump the shard, unless it was never loaded """
+        if not self.loaded:
+            return False
+
+        return super().dump(*args, **kwargs)
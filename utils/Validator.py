@@ -0,0 +1,69 @@
+class Optional:
+
+    def __init__(self, key):
+        """
+        mark a key of a dict schema as optional
+        :param key: key name
+        """
+        self.key = key
+
+
+class Validator:
+
+    def __init__(self, schema):
+        """
+        compile a schema once into nested checks, so validating a request
+        does not walk the schema again. schemas are types, lists of a
+        type, dicts of named keys (Optional for the optional ones)
+        or dicts with a single type as their key
+        :param schema: schema description
+        """
+        self._check = self._compile(schema)
+
+    def is_valid(self, data):
+        """
+        check data against the schema
+        :param data: data to check
+        :return: bool
+        """
+        return self._check(data)
+
+    @classmethod
+    def _compile(cls, schema):
+        """
+        build the check of a schema
+        :param schema: schema description
+        :return: callable (value) -> bool
+        """
+        if isinstance(schema, type):
+            return lambda value: isinstance(value, schema)
+
+        if isinstance(schema, list) and len(schema) == 1:
+            item = cls._compile(schema[0])
+            return lambda value: isinstance(value, list) and all(map(item, value))
+
+        if isinstance(schema, dict) and len(schema) == 1 and isinstance(next(iter(schema)), type):
+            # like named keys, a type key is required to match at least once
+            (key_type, value_schema), = schema.items()
+            item = cls._compile(value_schema)
+            return lambda value: (isinstance(value, dict) and len(value) > 0 and
+                                  all(isinstance(k, key_type) and item(v) for k, v in value.items()))
+
+        if isinstance(schema, dict):
+            checks = dict((key.key if isinstance(key, Optional) else key, cls._compile(value))
+                          for key, value in schema.items())
+            required = frozenset(key for key in schema if not isinstance(key, Optional))
+
+            def check(value):
+                if not isinstance(value, dict) or not required <= value.keys():
+                    return False
+
+                for key, item in value.items():
+                    item_check = checks.get(key)
+                    if item_check is None or not item_check(item):
+                        return False
+                return True
+
+            return check
+
+        raise Exception('invalid schema')
@@ -1,23 +1,63 @@
 from .OrangeDB import Orange
-from peewee import PostgresqlDatabase
+from peewee import DatabaseProxy, PostgresqlDatabase, SqliteDatabase
 from redis import StrictRedis
+from .MemoryStore import MemoryStore
 
 
 config = Orange('config.json', auto_dump=True, load=True)
 
 
-redis = StrictRedis(
-    db=2,
-    host=config['redis']['host'],
-    port=config['redis']['port'],
-    password=config['redis'].get('password'))
+# single node deployments can keep the timelines in process
+if config['redis'].get('backend') == 'memory':
+    redis = MemoryStore(
+        snapshot=config['redis'].get('snapshot'),
+        snapshot_interval=config['redis'].get('snapshot_interval', 60.0))
+else:
+    redis = StrictRedis(
+        db=2,
+        host=config['redis']['host'],
+        port=config['redis']['port'],
+        password=config['redis'].get('password'))
 
-db = PostgresqlDatabase(
-    config['database']['name'],
-    host=config['database']['host'],
-    port=config['database']['port'],
-    user=config['database']['user'],
-    password=config['database'].get('password'))
+
+def create_database(options):
+    """
+    Creates the database of the events and relations.
+    :param options: dict, database config, the engine is
+        postgres (default), sqlite or memory
+    :return: peewee database
+    """
+    engine = options.get('engine', 'postgres')
+
+    if engine == 'postgres':
+        return PostgresqlDatabase(
+            options['name'],
+            host=options['host'],
+            port=options['port'],
+            user=options['user'],
+            password=options.get('password'))
+
+    if engine == 'sqlite':
+        # wal lets readers run alongside the writer
+        return SqliteDatabase(
+            options['path'],
+            timeout=options.get('timeout', 5.0),
+            pragmas={'journal_mode': 'wal', 'synchronous': 'normal',
+                     'cache_size': -options.get('cache_mb', 64) * 1024})
+
+    if engine == 'memory':
+        # a named in-memory database is shared by the connections
+        # of every thread and lives as long as one is open
+        return SqliteDatabase(
+            f"file:{options.get('name', 'stream')}?mode=memory&cache=shared",
+            uri=True, timeout=options.get('timeout', 5.0),
+            pragmas={'read_uncommitted': 1})
+
+    raise Exception('invalid database engine')
+
+
+db = DatabaseProxy()
+db.initialize(create_database(config['database']))
 
 
 def clear_cache_ns(ns):